@@ -2,7 +2,64 @@
 Simple Accounting module
 """
 
-__revision__ = "2"
+import array
+import heapq
+import os
+import sqlite3
+import sys
+import tempfile
+import weakref
+
+import Sketches
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # pylint: disable=invalid-name
+
+try:
+    import resource
+except ImportError:
+    resource = None  # pylint: disable=invalid-name
+
+__revision__ = "8"
+
+# Increments VectorAccounts collects before adding them up
+BATCH = 65536
+# Sums up to this are exact as floats, see VectorAccounts.flush()
+_EXACT = 1 << 53
+# Keys whose increments SpillAccounts keeps in memory once it has spilled
+SPILLBATCH = 100000
+# New keys between looks at the memory in use, see SpillAccounts
+_RSSCHECK = 65536
+
+
+def rss():
+    """
+    Return the memory this process uses (resident set size) in KiB, or its
+    peak if that is all there is to know. None if neither is known.
+    """
+    try:
+        with open("/proc/self/statm") as fobj:
+            pages = int(fobj.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (EnvironmentError, ValueError, IndexError):
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak //= 1024  # bytes there, KiB everywhere else
+    return peak
+
+
+def _dropdb(database, path):
+    """Close the SQLite database at path and remove it"""
+    database.close()
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
 
 
 class Accounts:
@@ -15,14 +72,17 @@ class Accounts:
         """Initialize book keeping"""
         self.accounts = {}
         self.seencount = 0
+        self.total = 0
 
     def incr(self, k, num=1):
         """Increment 'k' by 'num'"""
-        try:
-            self.accounts[k] = self.accounts[k] + num
-        except KeyError:
-            self.accounts[k] = 0 + num
+        accounts = self.accounts
+        if k in accounts:
+            accounts[k] += num
+        else:
+            accounts[k] = num
             self.seencount += 1
+        self.total += num
 
     def decr(self, k, num=1):
         """Decrement 'k' by 'num'"""
@@ -31,6 +91,12 @@ class Accounts:
         except KeyError:
             self.accounts[k] = 0 - num
             self.seencount += 1
+        self.total -= num
+
+    def merge(self, other):
+        """Add all accounts of 'other' to this one"""
+        for k, num in other.accounts.items():
+            self.incr(k, num)
 
     def val(self, k):
         """Return value of 'k'"""
@@ -53,3 +119,537 @@ class Accounts:
         if desc:
             i.reverse()
         return i
+
+    def top(self, num):
+        '''Returns the num largest (value, key) tuples, largest first.
+        Uses a heap of size num instead of sorting all accounts.'''
+        if num <= 0:
+            return []
+        return heapq.nlargest(num, ((value, key) for key, value
+                                    in self.accounts.items()))
+
+    def topfraction(self, fraction):
+        '''Returns the (value, key) tuples of the largest fraction (0.0 to
+        1.0) of all accounts, largest first.'''
+        return self.top(int(self.seencount * fraction))
+
+
+class SpillAccounts(Accounts):
+
+    """
+    Accounting class that moves its accounts to disk when they get large
+
+    Accounts are kept in memory like Accounts does until there are limit
+    keys or the process uses more than rsslimit KiB, whichever comes
+    first. Then they are moved to an SQLite database in a temporary file
+    (see tempfile, TMPDIR), indexed by value, so top() reads only the rows
+    it returns. Increments are collected in memory for up to batch keys
+    and written at once. Pickles carry all accounts.
+    """
+
+    def __init__(self, limit=None, rsslimit=None, batch=SPILLBATCH):
+        """Initialize book keeping"""
+        self.limit = limit
+        self.rsslimit = rsslimit
+        self.batch = batch
+        # Set up once spilled
+        self.database = None
+        self.path = None
+        self.cache = {}
+        self.counted = True
+        Accounts.__init__(self)
+        self.nextcheck = self._nextcheck()
+
+    # Accounts.__init__() sets these, they are only attributes until the
+    # accounts are spilled
+    @property
+    def accounts(self):
+        """All accounts as a dict"""
+        if self.database is None:
+            return self.memory
+        return dict(self.items())
+
+    @accounts.setter
+    def accounts(self, value):
+        self.memory = value
+
+    @property
+    def seencount(self):
+        """Number of keys seen"""
+        if not self.counted:
+            self.flush()
+            self._seencount = self.database.execute(
+                "SELECT COUNT(*) FROM accounts").fetchone()[0]
+            self.counted = True
+        return self._seencount
+
+    @seencount.setter
+    def seencount(self, value):
+        self._seencount = value
+
+    def __getstate__(self):
+        """Pickle the accounts themselves, not the database"""
+        return {"limit": self.limit, "rsslimit": self.rsslimit,
+                "batch": self.batch, "total": self.total,
+                "items": list(self.items())}
+
+    def __setstate__(self, state):
+        """Unpickle, see __getstate__()"""
+        self.__init__(state["limit"], state["rsslimit"], state["batch"])
+        for k, num in state["items"]:
+            self.incr(k, num)
+        self.total = state["total"]
+
+    def _nextcheck(self):
+        """Return at how many keys to look at the limits next"""
+        checks = []
+        if self.limit:
+            checks.append(self.limit)
+        if self.rsslimit:
+            checks.append(self._seencount + _RSSCHECK)
+        return min(checks) if checks else float("inf")
+
+    def _check(self):
+        """Spill if past a limit"""
+        if (self.limit and self._seencount >= self.limit) or (
+                self.rsslimit and (rss() or 0) > self.rsslimit):
+            self.spill()
+        else:
+            self.nextcheck = self._nextcheck()
+
+    def spill(self):
+        """Move the accounts to disk"""
+        if self.database is not None:
+            return
+        fdesc, self.path = tempfile.mkstemp(prefix="carl-accounts-",
+                                            suffix=".sqlite")
+        os.close(fdesc)
+        database = self.database = sqlite3.connect(
+            self.path, isolation_level=None, check_same_thread=False)
+        weakref.finalize(self, _dropdb, database, self.path)
+        # Scratch data, nothing to keep safe if we crash
+        database.execute("PRAGMA journal_mode = OFF")
+        database.execute("PRAGMA synchronous = OFF")
+        database.execute("CREATE TABLE accounts (key TEXT PRIMARY KEY, "
+                         "value INTEGER NOT NULL) WITHOUT ROWID")
+        self.cache = self.memory
+        self.memory = {}
+        self.flush()
+        # Cheaper to build after the first rows are in
+        database.execute("CREATE INDEX byvalue ON accounts (value, key)")
+
+    def flush(self):
+        """Write the increments collected so far to disk"""
+        if not self.cache:
+            return
+        database = self.database
+        database.execute("BEGIN")
+        database.executemany(
+            "INSERT INTO accounts VALUES (?, ?) ON CONFLICT (key) "
+            "DO UPDATE SET value = value + excluded.value",
+            self.cache.items())
+        database.execute("COMMIT")
+        self.cache = {}
+        self.counted = False
+
+    def incr(self, k, num=1):
+        """Increment 'k' by 'num'"""
+        if self.database is None:
+            memory = self.memory
+            if k in memory:
+                memory[k] += num
+            else:
+                memory[k] = num
+                self._seencount += 1
+                if self._seencount >= self.nextcheck:
+                    self._check()
+        else:
+            cache = self.cache
+            if k in cache:
+                cache[k] += num
+            else:
+                cache[k] = num
+                self.counted = False
+                if len(cache) >= self.batch:
+                    self.flush()
+        self.total += num
+
+    def decr(self, k, num=1):
+        """Decrement 'k' by 'num'"""
+        self.incr(k, -num)
+
+    def merge(self, other):
+        """Add all accounts of 'other' to this one"""
+        if isinstance(other, SpillAccounts):
+            items = other.items()
+        else:
+            items = other.accounts.items()
+        for k, num in items:
+            self.incr(k, num)
+
+    def items(self):
+        """Yield (key, value) for all keys seen"""
+        if self.database is None:
+            return iter(self.memory.items())
+        self.flush()
+        return self.database.execute("SELECT key, value FROM accounts")
+
+    def val(self, k):
+        """Return value of 'k'"""
+        if self.database is None:
+            return self.memory.get(k, 0)
+        row = self.database.execute(
+            "SELECT value FROM accounts WHERE key = ?", (k,)).fetchone()
+        return self.cache.get(k, 0) + (row[0] if row else 0)
+
+    def getkeys(self):
+        """Return all keys"""
+        return [key for key, _ in self.items()]
+
+    def counts(self, desc=False):
+        '''Returns list of keys, sorted by values.
+        If desc is True, return descending list, ascending otherwise.'''
+        if self.database is None:
+            return Accounts.counts(self, desc)
+        self.flush()
+        order = "DESC" if desc else "ASC"
+        return self.database.execute(
+            "SELECT value, key FROM accounts ORDER BY value %s, key %s" %
+            (order, order)).fetchall()
+
+    def top(self, num):
+        '''Returns the num largest (value, key) tuples, largest first.
+        Once spilled, read from the index by value.'''
+        if self.database is None:
+            return Accounts.top(self, num)
+        if num <= 0:
+            return []
+        self.flush()
+        return self.database.execute(
+            "SELECT value, key FROM accounts ORDER BY value DESC, key DESC "
+            "LIMIT ?", (num,)).fetchall()
+
+
+class CompactAccounts:
+
+    """
+    Accounting class for addresses interned in an Addresses.AddressTable
+
+    Values are kept in an array indexed by address id instead of a dict.
+    Keys may be given as address ids or as text; keys handed out are text.
+    """
+
+    def __init__(self, table):
+        """Initialize book keeping"""
+        self.table = table
+        self.values = array.array("q")
+        self.seen = bytearray()
+        self.seencount = 0
+        self.total = 0
+
+    def _addrid(self, k):
+        """Return the address id for k, making room for it"""
+        if isinstance(k, str):
+            k = self.table.intern(k)
+        if k >= len(self.values):
+            grow = max(k + 1 - len(self.values), len(self.values) // 2)
+            self.values.extend(array.array("q", [0]) * grow)
+            self.seen.extend(bytes(grow))
+        return k
+
+    def incr(self, k, num=1):
+        """Increment 'k' by 'num'"""
+        k = self._addrid(k)
+        if not self.seen[k]:
+            self.seen[k] = 1
+            self.seencount += 1
+        self.values[k] += num
+        self.total += num
+
+    def decr(self, k, num=1):
+        """Decrement 'k' by 'num'"""
+        self.incr(k, -num)
+
+    def merge(self, other):
+        """Add all accounts of 'other' (with its own table) to this one"""
+        for addrid, num in other.iditems():
+            self.incr(self.table.internkey(other.table.key(addrid)), num)
+
+    def iditems(self):
+        """Yield (address id, value) for all keys seen"""
+        values = self.values
+        for addrid, seen in enumerate(self.seen):
+            if seen:
+                yield addrid, values[addrid]
+
+    def items(self):
+        """Yield (key, value) for all keys seen"""
+        text = self.table.text
+        for addrid, num in self.iditems():
+            yield text(addrid), num
+
+    @property
+    def accounts(self):
+        """All accounts as a dict, like Accounts.accounts"""
+        return dict(self.items())
+
+    def val(self, k):
+        """Return value of 'k'"""
+        if isinstance(k, str):
+            k = self.table.find(k)
+        if k is None or k >= len(self.values):
+            return 0
+        return self.values[k]
+
+    def getkeys(self):
+        """Return all keys"""
+        return [key for key, _ in self.items()]
+
+    def counts(self, desc=False):
+        '''Returns list of keys, sorted by values.
+        If desc is True, return descending list, ascending otherwise.'''
+        i = [(value, key) for key, value in self.items()]
+        i.sort()
+        if desc:
+            i.reverse()
+        return i
+
+    def top(self, num):
+        '''Returns the num largest (value, key) tuples, largest first.
+        Only the keys that make it are turned into text.'''
+        if num <= 0:
+            return []
+        best = heapq.nlargest(num, ((value, addrid) for addrid, value
+                                    in self.iditems()))
+        if not best:
+            return []
+        # Equal values are ordered by key text, like Accounts.top() does,
+        # so the ties at the bottom have to be looked at as text.
+        text = self.table.text
+        cutoff = best[-1][0]
+        above = [(value, text(addrid)) for value, addrid in best
+                 if value > cutoff]
+        ties = heapq.nlargest(num - len(above), (
+            (value, text(addrid)) for addrid, value in self.iditems()
+            if value == cutoff))
+        return sorted(above, reverse=True) + ties
+
+    def topfraction(self, fraction):
+        '''Returns the (value, key) tuples of the largest fraction (0.0 to
+        1.0) of all accounts, largest first.'''
+        return self.top(int(self.seencount * fraction))
+
+
+class VectorAccounts(CompactAccounts):
+
+    """
+    Accounting class for addresses interned in an Addresses.AddressTable,
+    added up with NumPy
+
+    Increments are collected as (address id, value) in two preallocated
+    arrays and added up a batch at a time with numpy.bincount(). The
+    parser collects its own batches and hands them to addbatch(), so it
+    makes no call per line. Top lists come from
+    numpy.partition() instead of a heap over all accounts. Needs NumPy;
+    see CompactAccounts for everything else.
+    """
+
+    # seencount is a property here, set up without CompactAccounts
+    # pylint: disable=super-init-not-called
+    def __init__(self, table, batch=BATCH):
+        """Initialize book keeping"""
+        self.table = table
+        self.values = numpy.zeros(0, numpy.int64)
+        self.seen = numpy.zeros(0, numpy.bool_)
+        self.total = 0
+        self._seencount = 0
+        self.batch = batch
+        self._newbatch()
+
+    def _newbatch(self):
+        """Set up the arrays increments are collected in"""
+        self.ids = array.array("q", bytes(8 * self.batch))
+        self.nums = array.array("q", bytes(8 * self.batch))
+        self.pending = 0
+
+    def __getstate__(self):
+        """Pickle without the increments still to be added up"""
+        self.flush()
+        state = dict(self.__dict__)
+        del state["ids"], state["nums"]
+        return state
+
+    def __setstate__(self, state):
+        """Unpickle, see __getstate__()"""
+        self.__dict__.update(state)
+        self._newbatch()
+
+    @property
+    def seencount(self):
+        """Number of keys seen"""
+        self.flush()
+        return self._seencount
+
+    def incr(self, k, num=1):
+        """Increment 'k' by 'num'"""
+        if isinstance(k, str):
+            k = self.table.intern(k)
+        pending = self.pending
+        self.ids[pending] = k
+        self.nums[pending] = num
+        self.total += num
+        self.pending = pending + 1
+        if pending + 1 == self.batch:
+            self.flush()
+
+    def flush(self):
+        """Add up the increments collected so far"""
+        pending = self.pending
+        if not pending:
+            return
+        self.pending = 0
+        self._add(numpy.frombuffer(self.ids, numpy.int64, pending),
+                  numpy.frombuffer(self.nums, numpy.int64, pending))
+
+    def addbatch(self, ids, nums=None):
+        """
+        Add up a batch of increments at once: the address ids in ids (an
+        array of 'q'), by the values in nums (another, as long) or by one
+        each. The arrays are left alone, so the caller may reuse them.
+        """
+        if not ids:
+            return
+        ids = numpy.frombuffer(ids, numpy.int64).copy()
+        if nums is not None:
+            nums = numpy.frombuffer(nums, numpy.int64).copy()
+            self.total += int(nums.sum())
+        else:
+            self.total += len(ids)
+        self._add(ids, nums)
+
+    def _add(self, ids, nums):
+        """Add the values nums (None: one each) to the address ids ids"""
+        size = int(ids.max()) + 1
+        if size > len(self.values):
+            grow = max(size, len(self.values) * 3 // 2)
+            self.values = numpy.concatenate(
+                (self.values, numpy.zeros(grow - len(self.values),
+                                          numpy.int64)))
+            self.seen = numpy.concatenate(
+                (self.seen, numpy.zeros(grow - len(self.seen), numpy.bool_)))
+        if nums is None:
+            self.values[:size] += numpy.bincount(ids, minlength=size)
+        elif int(numpy.abs(nums).sum()) < _EXACT:
+            # Weighted bincount() adds up in floats, which is exact here
+            self.values[:size] += numpy.bincount(
+                ids, weights=nums, minlength=size).astype(numpy.int64)
+        else:
+            numpy.add.at(self.values, ids, nums)
+        self._seencount += len(numpy.unique(ids[~self.seen[ids]]))
+        self.seen[ids] = True
+
+    def iditems(self):
+        """Yield (address id, value) for all keys seen"""
+        self.flush()
+        addrids = numpy.flatnonzero(self.seen)
+        return zip(addrids.tolist(), self.values[addrids].tolist())
+
+    def val(self, k):
+        """Return value of 'k'"""
+        self.flush()
+        return int(CompactAccounts.val(self, k))
+
+    def top(self, num):
+        '''Returns the num largest (value, key) tuples, largest first.
+        Only the keys that make it are turned into text.'''
+        self.flush()
+        if num <= 0 or not self._seencount:
+            return []
+        addrids = numpy.flatnonzero(self.seen)
+        values = self.values[addrids]
+        num = min(num, len(values))
+        cutoff = numpy.partition(values, len(values) - num)[-num]
+        # Equal values are ordered by key text, like Accounts.top() does
+        text = self.table.text
+        above = sorted(((value, text(addrid)) for addrid, value in zip(
+            addrids[values > cutoff].tolist(),
+            values[values > cutoff].tolist())), reverse=True)
+        ties = heapq.nlargest(num - len(above), (
+            (int(cutoff), text(addrid))
+            for addrid in addrids[values == cutoff].tolist()))
+        return above + ties
+
+
+class ApproxAccounts:
+
+    """
+    Accounting class that takes the same memory however many keys there are
+
+    seencount is an estimate (see Sketches.HyperLogLog) and only the
+    capacity largest accounts are kept (see Sketches.SpaceSaving). Their
+    values are never too low, but may be too high by error(k).
+    """
+
+    def __init__(self, capacity, precision=14):
+        """Initialize book keeping"""
+        self.summary = Sketches.SpaceSaving(capacity)
+        self.distinct = Sketches.HyperLogLog(precision)
+        self.total = 0
+
+    @property
+    def seencount(self):
+        """Estimated number of keys seen"""
+        return self.distinct.count()
+
+    def incr(self, k, num=1):
+        """Increment 'k' by 'num'"""
+        self.distinct.add(k)
+        self.summary.add(k, num)
+        self.total += num
+
+    def merge(self, other):
+        """Add all accounts of 'other' to this one"""
+        self.distinct.merge(other.distinct)
+        self.summary.merge(other.summary)
+        self.total += other.total
+
+    @property
+    def accounts(self):
+        """The accounts kept as a dict"""
+        return dict(self.summary.counts)
+
+    def val(self, k):
+        """Return value of 'k', 0 if it is not kept"""
+        return self.summary.counts.get(k, 0)
+
+    def error(self, k):
+        """Return by how much the value of 'k' may be too high"""
+        return self.summary.error(k)
+
+    def seenerror(self):
+        """Return the relative standard error of seencount"""
+        return self.distinct.error()
+
+    def getkeys(self):
+        """Return all keys kept"""
+        return list(self.summary.counts)
+
+    def counts(self, desc=False):
+        '''Returns list of keys kept, sorted by values.
+        If desc is True, return descending list, ascending otherwise.'''
+        i = [(value, key) for key, value in self.summary.counts.items()]
+        i.sort()
+        if desc:
+            i.reverse()
+        return i
+
+    def top(self, num):
+        '''Returns the num largest (value, key) tuples, largest first.'''
+        return self.summary.top(num)
+
+    def topfraction(self, fraction):
+        '''Returns the (value, key) tuples of the largest fraction (0.0 to
+        1.0) of all accounts, largest first. No more than the accounts kept
+        are returned.'''
+        return self.top(min(int(self.seencount * fraction),
+                            self.summary.capacity))
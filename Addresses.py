@@ -0,0 +1,277 @@
+"""
+Compact client address module
+
+With many distinct clients, the address strings used as keys in several
+dicts take up most of Carl's memory. An AddressTable stores every address
+once, as a packed integer in flat arrays, and hands out small integer ids
+that other arrays can be indexed with. Lookups go through a sorted index
+(again arrays) instead of a dict, so there is no Python object per address
+at all. Addresses are only turned back into text when a report is written,
+in their canonical form ("2001:db8::1").
+"""
+
+import array
+import bisect
+import socket
+
+__revision__ = "1"
+
+# Address families in AddressTable.families
+_OTHER = 0
+_IPV4 = 4
+_IPV6 = 6
+# Set on the keys of IPv6 addresses, so they never clash with IPv4 ones
+_V6FLAG = 1 << 128
+_LOW64 = (1 << 64) - 1
+# New addresses are kept in a dict until there are this many, or a
+# sixteenth of all, then they are merged into the sorted index
+_REINDEX = 4096
+# HostNames.starts marker for addresses without a name
+_NONAME = -1
+
+
+def packed(text):
+    """
+    Return the address text as an integer key, or text itself if it is
+    not an IP address.
+    """
+    try:
+        if ":" in text:
+            return _V6FLAG | int.from_bytes(
+                socket.inet_pton(socket.AF_INET6, text), "big")
+        return int.from_bytes(socket.inet_pton(socket.AF_INET, text), "big")
+    except (OSError, ValueError, TypeError):
+        return text
+
+
+def _merged(keys, ids, new):
+    """
+    Return copies of the sorted arrays keys (a tuple of arrays sorted
+    together) and ids with the entries in new merged in. new is a sorted
+    list of (position, key tuple, id), positions being those in keys.
+    """
+    merged = tuple(array.array(column.typecode) for column in keys)
+    mergedids = array.array(ids.typecode)
+    prev = 0
+    for pos, key, addrid in new:
+        for column, mcolumn, value in zip(keys, merged, key):
+            mcolumn.extend(column[prev:pos])
+            mcolumn.append(value)
+        mergedids.extend(ids[prev:pos])
+        mergedids.append(addrid)
+        prev = pos
+    for column, mcolumn in zip(keys, merged):
+        mcolumn.extend(column[prev:])
+    mergedids.extend(ids[prev:])
+    return merged, mergedids
+
+
+class AddressTable:
+
+    """
+    Interned client addresses
+
+    Ids are handed out in order, starting at 0. The addresses are kept in
+    flat arrays indexed by id, and, sorted, in an index for lookups.
+    Anything that does not parse as an IP address is kept as it is.
+    """
+
+    def __init__(self):
+        """Setup book keeping"""
+        # By id
+        self.families = array.array("B")
+        self.high = array.array("Q")
+        self.low = array.array("Q")
+        # Sorted IPv4 addresses and IPv6 addresses (by high, low), with
+        # the ids that go with them
+        self.index4 = array.array("I")
+        self.ids4 = array.array("I")
+        self.high6 = array.array("Q")
+        self.low6 = array.array("Q")
+        self.ids6 = array.array("I")
+        # Addresses not in the index yet, by key
+        self.recent = {}
+        # Things that are no IP addresses, by text and by id
+        self.otherids = {}
+        self.other = {}
+
+    def __len__(self):
+        """Return the number of addresses interned"""
+        return len(self.families)
+
+    def intern(self, text):
+        """Return the id of the address text, adding it if it is new"""
+        return self.internkey(packed(text))
+
+    def internkey(self, key):
+        """Return the id of the address with the key (see key())"""
+        addrid = self.lookup(key)
+        if addrid is not None:
+            return addrid
+        addrid = len(self.families)
+        if isinstance(key, str):
+            self.families.append(_OTHER)
+            self.otherids[key] = addrid
+            self.other[addrid] = key
+            key = 0
+        else:
+            self.recent[key] = addrid
+            if key & _V6FLAG:
+                self.families.append(_IPV6)
+                key ^= _V6FLAG
+            else:
+                self.families.append(_IPV4)
+        self.high.append(key >> 64)
+        self.low.append(key & _LOW64)
+        if len(self.recent) >= max(_REINDEX, len(self.families) >> 4):
+            self.reindex()
+        return addrid
+
+    def lookup(self, key):
+        """Return the id of the address with the key, None if unknown"""
+        addrid = self.recent.get(key)
+        if addrid is not None:
+            return addrid
+        if isinstance(key, str):
+            return self.otherids.get(key)
+        if key & _V6FLAG:
+            key ^= _V6FLAG
+            high = key >> 64
+            low = key & _LOW64
+            pos = self._position6(high, low)
+            if (pos < len(self.ids6) and self.high6[pos] == high and
+                    self.low6[pos] == low):
+                return self.ids6[pos]
+            return None
+        index4 = self.index4
+        pos = bisect.bisect_left(index4, key)
+        if pos < len(index4) and index4[pos] == key:
+            return self.ids4[pos]
+        return None
+
+    def _position6(self, high, low):
+        """Return where the IPv6 address (high, low) is or goes in the index"""
+        high6 = self.high6
+        start = bisect.bisect_left(high6, high)
+        if start == len(high6) or high6[start] != high:
+            return start
+        end = bisect.bisect_right(high6, high, start)
+        return bisect.bisect_left(self.low6, low, start, end)
+
+    def reindex(self):
+        """Merge the recently added addresses into the sorted index"""
+        new4 = []
+        new6 = []
+        for key, addrid in self.recent.items():
+            if key & _V6FLAG:
+                key ^= _V6FLAG
+                new6.append(((key >> 64, key & _LOW64), addrid))
+            else:
+                new4.append(((key,), addrid))
+        # Positions refer to the old index, so take them before merging
+        new4 = sorted((bisect.bisect_left(self.index4, key[0]), key, addrid)
+                      for key, addrid in new4)
+        new6 = sorted((self._position6(*key), key, addrid)
+                      for key, addrid in new6)
+        (self.index4,), self.ids4 = _merged((self.index4,), self.ids4, new4)
+        (self.high6, self.low6), self.ids6 = _merged(
+            (self.high6, self.low6), self.ids6, new6)
+        self.recent = {}
+
+    def find(self, text):
+        """Return the id of the address text, None if it is unknown"""
+        return self.lookup(packed(text))
+
+    def key(self, addrid):
+        """Return the key of the address with id addrid"""
+        family = self.families[addrid]
+        if family == _OTHER:
+            return self.other[addrid]
+        key = (self.high[addrid] << 64) | self.low[addrid]
+        if family == _IPV6:
+            key |= _V6FLAG
+        return key
+
+    def text(self, addrid):
+        """Return the address with id addrid as text"""
+        family = self.families[addrid]
+        if family == _OTHER:
+            return self.other[addrid]
+        if family == _IPV4:
+            return socket.inet_ntop(socket.AF_INET,
+                                    self.low[addrid].to_bytes(4, "big"))
+        key = (self.high[addrid] << 64) | self.low[addrid]
+        return socket.inet_ntop(socket.AF_INET6, key.to_bytes(16, "big"))
+
+
+class HostNames:
+
+    """
+    Host names by address, a dict replacement for AddressTable ids
+
+    The names are kept back to back in one buffer, UTF-8 encoded. Keys may
+    be address ids or addresses as text; items() yields text.
+    """
+
+    def __init__(self, table):
+        """Setup book keeping"""
+        self.table = table
+        self.buffer = bytearray()
+        self.starts = array.array("q")
+        self.lengths = array.array("H")
+
+    def _addrid(self, key, add=False):
+        """Return the address id for key, None if it is unknown"""
+        if isinstance(key, str):
+            if add:
+                return self.table.intern(key)
+            return self.table.find(key)
+        return key
+
+    def get(self, key, default=None):
+        """Return the host name for key, default if there is none"""
+        addrid = self._addrid(key)
+        if addrid is None or addrid >= len(self.starts):
+            return default
+        start = self.starts[addrid]
+        if start == _NONAME:
+            return default
+        return self.buffer[start:start + self.lengths[addrid]].decode(
+            "utf-8", "surrogateescape")
+
+    def __getitem__(self, key):
+        """Return the host name for key"""
+        name = self.get(key)
+        if name is None:
+            raise KeyError(key)
+        return name
+
+    def __setitem__(self, key, name):
+        """Set the host name for key"""
+        addrid = self._addrid(key, True)
+        starts = self.starts
+        if addrid >= len(starts):
+            grow = max(addrid + 1 - len(starts), len(starts) // 2)
+            starts.extend(array.array("q", [_NONAME]) * grow)
+            self.lengths.extend(array.array("H", [0]) * grow)
+        name = name.encode("utf-8", "surrogateescape")[:0xffff]
+        starts[addrid] = len(self.buffer)
+        self.lengths[addrid] = len(name)
+        self.buffer.extend(name)
+
+    def __len__(self):
+        """Return the number of addresses with a host name"""
+        return len(self.starts) - self.starts.count(_NONAME)
+
+    def items(self):
+        """Yield (address text, host name) pairs"""
+        for addrid, start in enumerate(self.starts):
+            if start != _NONAME:
+                yield self.table.text(addrid), self.get(addrid)
+
+    def __eq__(self, other):
+        """Compare by content, also with plain dicts"""
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        return not self == other
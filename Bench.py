@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+"""
+Carl benchmark
+
+Writes synthetic rsyncd logs of various sizes and times the parts of Carl
+on them separately: parsedata(), mkreport() and the Accounts and Sessions
+operations. Every log size is measured in a fresh process, so the peak RSS
+recorded for it is its own. Results are appended to a file as one JSON
+object per line, which makes runs of different versions easy to compare.
+
+The generator can also be used on its own (--generate) to get test logs.
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None  # pylint: disable=invalid-name
+
+import Accounts
+import Carl
+import Logfiles
+import Sessions
+
+__revision__ = "1"
+
+# Where the synthetic log starts (2012/12/01 00:00:00 UTC)
+EPOCH = 1354320000
+# Files that sessions send
+FILES = ["metadata/timestamp.chk", "app-misc/foo/Manifest",
+         "dev-lang/python/python-3.11.ebuild", "sys-apps/portage/Manifest",
+         "profiles/use.desc", "net-misc/rsync/rsync-3.2.7.ebuild"]
+# Modules that sessions use; by default, Carl only counts Carl.__MODULE__
+MODULES = [Carl.__MODULE__, Carl.__MODULE__, Carl.__MODULE__, "distfiles"]
+# Pids wrap around like on a stock Linux system, so they get reused
+PIDBASE = 1000
+PIDMAX = 32768
+# Suffixes for log sizes
+SUFFIXES = {"k": 10 ** 3, "M": 10 ** 6, "G": 10 ** 9}
+
+DEFAULTS = {
+    "ips": 5000,         # Unique client addresses
+    "sessions": None,    # Sessions in the log, default: one per 10 lines
+    "interleave": 20,    # Sessions open at the same time
+    "errors": 0.02,      # Fraction of sessions ending in an rsync error
+    "commas": 0.3,       # Fraction of "sent" lines with 1,234 numbers
+    "span": 86400,       # Seconds of log time
+    "seed": 0,
+}
+
+
+def addresses(num, rng):
+    """Return num distinct client addresses, about a tenth of them IPv6"""
+    ips = []
+    seen = set()
+    while len(ips) < num:
+        if rng.random() < 0.1:
+            ipaddr = "2001:db8:%x:%x::%x" % (rng.getrandbits(16),
+                                             rng.getrandbits(16),
+                                             rng.getrandbits(16))
+        else:
+            ipaddr = "10.%d.%d.%d" % (rng.getrandbits(8), rng.getrandbits(8),
+                                      rng.getrandbits(8))
+        if ipaddr not in seen:
+            seen.add(ipaddr)
+            ips.append(ipaddr)
+    return ips
+
+
+def clients(count, **params):
+    """
+    Return count client addresses picked like synthlog() picks them for
+    its sessions.
+    """
+    for key, value in DEFAULTS.items():
+        params.setdefault(key, value)
+    rng = random.Random(params["seed"])
+    ips = addresses(max(1, params["ips"]), rng)
+    hot = ips[:max(1, len(ips) // 100)]
+    return [pickaddress(ips, hot, rng) for _ in range(count)]
+
+
+def pickaddress(ips, hot, rng):
+    """Return a client address, a fifth of the time a busy one"""
+    if rng.random() < 0.2:
+        return rng.choice(hot)
+    return rng.choice(ips)
+
+
+def session(pid, ipaddr, hname, module, nfiles, rng, params):
+    """Yield the messages (without stamp) of one rsync session"""
+    prefix = "[%d] " % pid
+    yield prefix + "connect from %s (%s)" % (hname, ipaddr)
+    yield prefix + "rsync on %s/ from %s (%s)" % (module, hname, ipaddr)
+    yield prefix + "building file list"
+    for _ in range(nfiles):
+        yield prefix + "send %s [%s] %s () %s %d" % (
+            hname, ipaddr, module, rng.choice(FILES), rng.randint(10, 99999))
+    if rng.random() < params["errors"]:
+        yield prefix + ("rsync error: error in socket IO (code 10) at "
+                        "io.c(785) [sender=3.2.7]")
+        return
+    sent = rng.randint(0, 10 ** 7)
+    received = rng.randint(0, 10 ** 5)
+    if rng.random() < params["commas"]:
+        fmt = "{:,}"
+    else:
+        fmt = "{}"
+    yield prefix + "sent %s bytes  received %s bytes  total size %s" % (
+        fmt.format(sent), fmt.format(received), fmt.format(267597297))
+
+
+def synthlog(lines, **params):
+    """
+    Yield exactly 'lines' lines (as bytes) of a synthetic rsyncd log.
+
+    See DEFAULTS for the parameters. The same parameters always give the
+    same log. A fifth of the sessions come from the busiest one percent
+    of the addresses, so the top lists are not just noise.
+    """
+    for key, value in DEFAULTS.items():
+        params.setdefault(key, value)
+    rng = random.Random(params["seed"])
+    ips = addresses(max(1, params["ips"]), rng)
+    hot = ips[:max(1, len(ips) // 100)]
+    sessions = params["sessions"] or max(1, lines // 10)
+    # Lines per session besides connect, rsync on, file list and sent
+    nfiles = max(0, lines // sessions - 4)
+    span = params["span"]
+
+    pids = itertools.cycle(range(PIDBASE, PIDMAX))
+
+    def newsession():
+        """Start the next session"""
+        ipaddr = pickaddress(ips, hot, rng)
+        if rng.random() < 0.2:
+            hname = "UNKNOWN"
+        else:
+            hname = "host-%s.example.com" % ipaddr.replace(":", "-")
+        return session(next(pids), ipaddr, hname, rng.choice(MODULES),
+                       rng.randint(0, 2 * nfiles), rng, params)
+
+    running = [newsession() for _ in range(max(1, params["interleave"]))]
+    laststamp = None
+    stamp = None
+    for num in range(lines):
+        when = EPOCH + span * num // lines
+        if when != laststamp:
+            laststamp = when
+            stamp = time.strftime("%Y/%m/%d %H:%M:%S ", time.gmtime(when))
+        slot = rng.randrange(len(running))
+        while True:
+            try:
+                msg = next(running[slot])
+                break
+            except StopIteration:
+                # Session over, the next one takes its place
+                running[slot] = newsession()
+        yield (stamp + msg + "\n").encode("ascii")
+
+
+def writelog(fname, lines, **params):
+    """Write a synthetic log (see synthlog()) to fname"""
+    with open(fname, "wb") as fobj:
+        fobj.writelines(synthlog(lines, **params))
+
+
+def timed(func, *args, **kwargs):
+    """Call func, return (its result, wall seconds, CPU seconds)"""
+    wall = time.time()
+    cpu = time.process_time()
+    result = func(*args, **kwargs)
+    return result, time.time() - wall, time.process_time() - cpu
+
+
+def timing(wall, cpu, count, unit):
+    """Return a dict with timings and the rate of count units"""
+    rate = None
+    if wall > 0:
+        rate = count / wall
+    return {"wall": wall, "cpu": cpu, unit: count, unit + "_per_sec": rate}
+
+
+def peakrss():
+    """Return the peak resident set size of this process in KiB"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak //= 1024  # bytes there, KiB everywhere else
+    return peak
+
+
+def accountsops(keys):
+    """Exercise Accounts like a parse and report does"""
+    accounts = Accounts.Accounts()
+    incr = accounts.incr
+    for key in keys:
+        incr(key, 1024)
+    accounts.top(10)
+    accounts.topfraction(0.05)
+    return accounts
+
+
+def sessionsops(keys, interleave, maxage):
+    """Exercise Sessions like a parse does: push, then pop later"""
+    sessions = Sessions.Sessions(maxage)
+    push = sessions.push
+    pop = sessions.pop
+    when = float(EPOCH)
+    sids = [b"[%d]" % pid for pid in range(PIDBASE, PIDBASE + interleave)]
+    for num, key in enumerate(keys):
+        sid = sids[num % interleave]
+        when += 1.0
+        pop(sid, when)
+        push(sid, key, when)
+    return sessions
+
+
+def runbench(job):
+    """
+    Benchmark one log size, usually in a worker process of its own.
+
+    job is a tuple (lines, params, repeat, tmpdir). Returns a dict that
+    can be written as JSON.
+    """
+    lines, params, repeat, tmpdir = job
+    fdesc, fname = tempfile.mkstemp(prefix="carl-bench-", suffix=".log",
+                                    dir=tmpdir)
+    os.close(fdesc)
+    record = {"carl": Carl.__version__,
+              "python": "%s %s" % (platform.python_implementation(),
+                                   platform.python_version()),
+              "machine": platform.machine(),
+              "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "lines": lines,
+              "params": dict(DEFAULTS, **params)}
+    try:
+        _, wall, cpu = timed(writelog, fname, lines, **params)
+        record["generate"] = timing(wall, cpu, lines, "lines")
+        record["bytes"] = os.path.getsize(fname)
+
+        args = Carl.parse_cmdline([])[0]
+        best = None
+        for _ in range(repeat):
+            stats, wall, cpu = timed(
+                Carl.parsedata, Logfiles.readlogs([fname]), args)
+            if best is None or wall < best[0]:
+                best = (wall, cpu)
+        record["parsedata"] = timing(best[0], best[1], lines, "lines")
+        record["sessions"] = stats["sessions"].seencount
+        record["unique_ips"] = stats["ipb"].seencount
+
+        _, wall, cpu = timed(Carl.mkreport, args, stats)
+        record["mkreport"] = timing(wall, cpu, 1, "reports")
+        record["peak_rss_kb"] = peakrss()
+
+        del stats
+        keys = clients(record["sessions"], **params)
+        _, wall, cpu = timed(accountsops, keys)
+        record["accounts"] = timing(wall, cpu, len(keys), "ops")
+        _, wall, cpu = timed(sessionsops, keys,
+                             record["params"]["interleave"],
+                             args.sessiontimeout or None)
+        record["sessions_ops"] = timing(wall, cpu, 2 * len(keys), "ops")
+    finally:
+        os.unlink(fname)
+    return record
+
+
+def parsesize(text):
+    """Turn a log size like "10k" or "100M" into a number of lines"""
+    text = text.strip()
+    factor = SUFFIXES.get(text[-1:], 1)
+    if text[-1:] in SUFFIXES:
+        text = text[:-1]
+    return int(float(text) * factor)
+
+
+def parse_cmdline(argv):
+    """
+    Parse commandline stored in argv
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark Carl on synthetic rsyncd logs.")
+    parser.add_argument("-s", "--sizes", default="10k,100k,1M",
+                        help="comma-separated log sizes in lines, with "
+                        "optional k/M/G suffix (default: %(default)s)")
+    parser.add_argument("-o", "--output", default="bench_output.txt",
+                        help="file the results are appended to as JSON "
+                        "lines (default: %(default)s)")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="parse each log this often and keep the best "
+                        "time (default: %(default)s)")
+    parser.add_argument("--tmpdir", default=None,
+                        help="directory for the generated logs; 100M lines "
+                        "take about 8 GB")
+    parser.add_argument("--generate", type=parsesize, metavar="LINES",
+                        help="only write a log of this many lines to "
+                        "stdout")
+    helps = {
+        "ips": "unique client addresses (default: %(default)s)",
+        "sessions": "sessions in the log (default: one per 10 lines)",
+        "interleave": "sessions open at the same time (default: "
+                      "%(default)s)",
+        "span": "seconds of log time (default: %(default)s)",
+        "seed": "seed of the random numbers (default: %(default)s)",
+        "errors": "fraction of sessions ending in an rsync error "
+                  "(default: %(default)s)",
+        "commas": "fraction of \"sent\" lines with 1,234 numbers "
+                  "(default: %(default)s)",
+    }
+    for key in ("ips", "sessions", "interleave", "span", "seed"):
+        parser.add_argument("--%s" % key, type=int, default=DEFAULTS[key],
+                            help=helps[key])
+    for key in ("errors", "commas"):
+        parser.add_argument("--%s" % key, type=float, default=DEFAULTS[key],
+                            help=helps[key])
+    args = parser.parse_args(argv)
+    args.params = dict((key, getattr(args, key)) for key in DEFAULTS)
+    return args
+
+
+def main():
+    """
+    Main program.
+    """
+    args = parse_cmdline(sys.argv[1:])
+
+    if args.generate is not None:
+        out = sys.stdout.buffer
+        out.writelines(synthlog(args.generate, **args.params))
+        out.flush()
+        return
+
+    sizes = [parsesize(size) for size in args.sizes.split(",")]
+    jobs = [(lines, args.params, args.repeat, args.tmpdir)
+            for lines in sizes]
+    # A fresh process for every size, so peak RSS is not inherited
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        with open(args.output, "a") as output:
+            for record in pool.imap(runbench, jobs):
+                output.write(json.dumps(record, sort_keys=True) + "\n")
+                output.flush()
+                print("%10d lines: parsedata %8.0f lines/s, mkreport "
+                      "%.3fs, peak RSS %s KiB" %
+                      (record["lines"],
+                       record["parsedata"]["lines_per_sec"] or 0,
+                       record["mkreport"]["wall"], record["peak_rss_kb"]))
+    finally:
+        pool.close()
+        pool.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,440 @@
+"""
+Time bucket module
+
+Bytes, sessions and unique client addresses per hour and per day of log
+time, for finding the peak load. Times are wall clock seconds as they are
+written in the log (see Carl.logclock()), so buckets line up with the
+hours and days of the log whatever its time zone. The series are kept in
+arrays, one entry per bucket.
+"""
+
+import array
+import json
+import time
+
+import Sketches
+
+__revision__ = "4"
+
+HOUR = 3600
+DAY = 86400
+# Bucket widths by name, for --bucket
+WIDTHS = {"hour": HOUR, "day": DAY}
+# Columns of rows() and of the exports
+COLUMNS = ["start", "bytes", "sessions", "ips"]
+
+
+def stamp(wall):
+    """Return the wall clock seconds wall in the log's stamp format"""
+    return time.strftime("%Y/%m/%d %H:%M:%S", time.gmtime(wall))
+
+
+class Buckets:
+
+    """
+    Bytes, sessions and unique addresses per bucket of width seconds
+
+    The log is expected to be in order. Sessions count in the bucket they
+    start in, addresses in the one their bytes are counted in (see
+    transfer()), like the accounts count them. An address is counted once
+    per bucket; for that, only the addresses of the latest bucket are kept
+    (and, if tail is set, those of the first, for merge()). Transfers that
+    are older than the latest bucket count their bytes, but not their
+    addresses.
+
+    With precision set, addresses are counted with a HyperLogLog of that
+    precision per kept bucket instead of a set, so memory stays fixed. The
+    count of the latest bucket is then brought up to date by settle().
+
+    With keep set, the addresses of every bucket are kept instead, so the
+    log need not be in order and gather() can count addresses seen in
+    several logs once. Those of buckets no log will see again can be
+    moved elsewhere by handover() and dropped by release(); connects
+    older than that count as sessions only.
+    """
+
+    # Defaults for buckets pickled before there were these
+    precision = None
+    tail = False
+    seen = None
+    released = None
+    _counted = 0
+
+    def __init__(self, width, precision=None, tail=False, keep=False):
+        """Setup book keeping"""
+        self.width = width
+        self.precision = precision
+        self.tail = tail
+        # Addresses by bucket number, with keep
+        self.seen = {} if keep else None
+        # Bucket number before which no addresses are kept, with keep
+        self.released = None
+        # Bucket number (wall clock seconds // width) of the first entry
+        self.first = None
+        self.bytes = array.array("q")
+        self.sessions = array.array("q")
+        self.ips = array.array("q")
+        # Addresses seen in the latest bucket and, for merge(), in the
+        # first one (with precision, the same sketch until the first
+        # bucket is done with)
+        self.current = self._distinct()
+        self.head = None
+        if tail:
+            self.head = set() if precision is None else self.current
+        # Count of current already in ips, see settle()
+        self._counted = 0
+
+    def _distinct(self):
+        """Return something empty to keep the addresses of a bucket in"""
+        if self.precision is None:
+            return set()
+        return Sketches.HyperLogLog(self.precision)
+
+    def _index(self, when):
+        """Return the array index for wall clock seconds when"""
+        bucket = int(when // self.width)
+        if self.first is None:
+            self.first = bucket
+        index = bucket - self.first
+        if index < 0:
+            # Something older than the first bucket, make room in front
+            self._grow(-index, front=True)
+            self.first = bucket
+            if self.head is not None:
+                self.head = self._distinct()
+            index = 0
+        elif index >= len(self.bytes):
+            if self.bytes and self.seen is None:
+                self.settle()
+                self.current = self._distinct()
+                self._counted = 0
+            self._grow(index + 1 - len(self.bytes))
+        return index
+
+    def _grow(self, num, front=False):
+        """Add num empty buckets at the end (or front)"""
+        for name in ("bytes", "sessions", "ips"):
+            empty = array.array("q", [0]) * num
+            if front:
+                empty.extend(getattr(self, name))
+                setattr(self, name, empty)
+            else:
+                getattr(self, name).extend(empty)
+
+    def connect(self, when):
+        """Count a session starting at when"""
+        self.sessions[self._index(when)] += 1
+
+    def transfer(self, when, nbytes, ipaddr=None, hashed=None):
+        """
+        Count nbytes transferred at when, to ipaddr if the session is
+        known; hashed may be its Sketches.hash64(), if known.
+        """
+        index = self._index(when)
+        self.bytes[index] += nbytes
+        if ipaddr is not None:
+            self._address(index, ipaddr, hashed)
+
+    def address(self, when, ipaddr, hashed=None):
+        """
+        Count ipaddr as seen at when after the fact, e.g. for a transfer
+        of a session opened in an earlier chunk (see Carl.mergestats()).
+        It only counts if the addresses of that bucket are still kept:
+        with keep, or if it is the latest bucket or (with tail) the first.
+        """
+        if self.first is None:
+            return
+        index = int(when // self.width) - self.first
+        if 0 <= index < len(self.bytes):
+            self._address(index, ipaddr, hashed)
+
+    def _address(self, index, ipaddr, hashed=None):
+        """Count ipaddr in the bucket at index, see address()"""
+        if self.seen is not None:
+            if (self.released is not None and
+                    index + self.first < self.released):
+                return
+            addresses = self.seen.get(index + self.first)
+            if addresses is None:
+                addresses = self.seen[index + self.first] = self._distinct()
+            if self.precision is None:
+                addresses.add(ipaddr)
+            else:
+                addresses.addhash(hashed if hashed is not None
+                                  else Sketches.hash64(ipaddr))
+            return
+        latest = index == len(self.bytes) - 1
+        if not latest and (index != 0 or self.head is None):
+            return
+        if self.precision is not None:
+            if hashed is None:
+                hashed = Sketches.hash64(ipaddr)
+            if latest:
+                # Also the head while that is the latest, see settle()
+                self.current.addhash(hashed)
+            else:
+                before = int(round(self.head.count()))
+                self.head.addhash(hashed)
+                self.ips[0] += int(round(self.head.count())) - before
+            return
+        if latest:
+            if ipaddr in self.current:
+                return
+            self.current.add(ipaddr)
+            if index == 0 and self.head is not None:
+                self.head.add(ipaddr)
+        elif ipaddr in self.head:
+            return
+        else:
+            self.head.add(ipaddr)
+        self.ips[index] += 1
+
+    def settle(self):
+        """
+        Bring the unique addresses of the latest bucket (with keep, of all
+        of them) up to date (only needed with precision or keep, before
+        reading ips directly).
+        """
+        if self.seen is not None:
+            for bucket, addresses in self.seen.items():
+                self.ips[bucket - self.first] = (
+                    len(addresses) if self.precision is None
+                    else int(round(addresses.count())))
+            return
+        if self.precision is None or not self.bytes:
+            return
+        count = int(round(self.current.count()))
+        self.ips[-1] += count - self._counted
+        self._counted = count
+
+    def _union(self, one, other):
+        """Return the addresses in the sets or sketches one and other"""
+        if self.precision is None:
+            return one | other
+        union = Sketches.HyperLogLog(self.precision)
+        union.merge(one)
+        union.merge(other)
+        return union
+
+    def merge(self, other):
+        """
+        Add the buckets of other, which covers the part of the log right
+        after this one. other should have been set up with tail, or
+        addresses in the bucket both have seen are counted twice. It is
+        done with after this.
+        """
+        head, other.head = other.head, None
+        if other.first is None:
+            return
+        other.settle()
+        if self.first is None:
+            tail = self.tail
+            self.__dict__.update(other.__dict__)
+            self.tail = tail
+            self.head = head if tail else None
+            return
+        self.settle()
+        last = self.first + len(self.bytes) - 1
+        current = self.current
+        self.add(other)
+        if other.first == last and head is not None:
+            # Addresses in the bucket both have seen were counted twice
+            index = other.first - self.first
+            if self.precision is None:
+                self.ips[index] -= len(head & current)
+            else:
+                both = self._union(current, head)
+                self.ips[index] += (int(round(both.count())) -
+                                    int(round(current.count())) -
+                                    int(round(head.count())))
+            if len(other.bytes) == 1:
+                self.current = self._union(current, other.current)
+                if self.precision is not None:
+                    self._counted = int(round(self.current.count()))
+                return
+        if self.precision is None:
+            self.current = set(other.current)
+        else:
+            self.current = other.current
+            self._counted = other._counted
+
+    def add(self, other):
+        """
+        Add the buckets of other, which may cover any part of the log or
+        even another log (e.g. of another mirror). Unlike with merge(),
+        addresses seen by both are counted twice.
+        """
+        if other.first is None:
+            return
+        other.settle()
+        self.settle()
+        current, counted = self.current, self._counted
+        latest = self.first is not None and self.first + len(self.bytes)
+        self._index(other.first * self.width)
+        self._index((other.first + len(other.bytes) - 1) * self.width)
+        if (self.precision is None or
+                latest == self.first + len(self.bytes)):
+            self.current, self._counted = current, counted
+        offset = other.first - self.first
+        for name in ("bytes", "sessions", "ips"):
+            mine = getattr(self, name)
+            for index, value in enumerate(getattr(other, name)):
+                mine[offset + index] += value
+
+    def gather(self, other, translate=None):
+        """
+        Add the buckets of other, another log covering any time; both must
+        have been set up with keep. Unlike with add(), addresses seen by
+        both are counted once. translate turns the addresses of other into
+        ours if they differ (e.g. address ids of another table).
+        """
+        if other.first is None:
+            return
+        self.add(other)
+        for bucket, addresses in other.seen.items():
+            self._unite(bucket, addresses, translate)
+        self.settle()
+
+    def _unite(self, bucket, addresses, translate=None):
+        """Add addresses (of another log, see gather()) to those of bucket"""
+        if self.released is not None and bucket < self.released:
+            return
+        mine = self.seen.get(bucket)
+        if mine is None:
+            mine = self.seen[bucket] = self._distinct()
+        if self.precision is not None:
+            mine.merge(addresses)
+        elif translate is not None:
+            mine.update(map(translate, addresses))
+        else:
+            mine.update(addresses)
+
+    def latest(self):
+        """Return the number of the latest bucket, None if there is none"""
+        if self.first is None:
+            return None
+        return self.first + len(self.bytes) - 1
+
+    def handover(self, other, before, translate=None):
+        """
+        Move the addresses of the buckets of other before bucket number
+        before to ours, for gather() to count them once; both must have
+        been set up with keep. other no longer counts them and keeps no
+        addresses of those buckets from now on.
+        """
+        for bucket in [bucket for bucket in other.seen if bucket < before]:
+            addresses = other.seen.pop(bucket)
+            other.ips[bucket - other.first] = 0
+            self._index(bucket * self.width)
+            self._unite(bucket, addresses, translate)
+        other.released = max(before, other.released or before)
+
+    def release(self, before):
+        """
+        Count the unique addresses of the buckets before bucket number
+        before for good and drop them, with keep. Addresses of those
+        buckets gathered or handed over later are ignored.
+        """
+        self.settle()
+        for bucket in [bucket for bucket in self.seen if bucket < before]:
+            del self.seen[bucket]
+        self.released = max(before, self.released or before)
+
+    def rows(self):
+        """Yield (start, bytes, sessions, ips) for all buckets, in order"""
+        self.settle()
+        for index, nbytes in enumerate(self.bytes):
+            yield ((self.first + index) * self.width, nbytes,
+                   self.sessions[index], self.ips[index])
+
+    def peak(self):
+        """Return the row (see rows()) with the most bytes, None if empty"""
+        best = None
+        for row in self.rows():
+            if best is None or row[1] > best[1]:
+                best = row
+        return best
+
+
+class Series:
+
+    """Hourly and daily buckets, see Buckets for precision, tail and keep"""
+
+    # Default for series pickled before there was this
+    precision = None
+
+    def __init__(self, precision=None, tail=False, keep=False):
+        """Setup book keeping"""
+        self.precision = precision
+        self.hours = Buckets(HOUR, precision, tail, keep)
+        self.days = Buckets(DAY, precision, tail, keep)
+
+    def connect(self, when):
+        """Count a session starting at when"""
+        self.hours.connect(when)
+        self.days.connect(when)
+
+    def transfer(self, when, nbytes, ipaddr=None):
+        """Count nbytes transferred at when, see Buckets.transfer()"""
+        hashed = None
+        if self.precision is not None and ipaddr is not None:
+            hashed = Sketches.hash64(ipaddr)
+        self.hours.transfer(when, nbytes, ipaddr, hashed)
+        self.days.transfer(when, nbytes, ipaddr, hashed)
+
+    def address(self, when, ipaddr):
+        """Count ipaddr as seen at when, see Buckets.address()"""
+        hashed = None
+        if self.precision is not None:
+            hashed = Sketches.hash64(ipaddr)
+        self.hours.address(when, ipaddr, hashed)
+        self.days.address(when, ipaddr, hashed)
+
+    def merge(self, other):
+        """Add the buckets of other, see Buckets.merge()"""
+        self.hours.merge(other.hours)
+        self.days.merge(other.days)
+
+    def add(self, other):
+        """Add the buckets of other, see Buckets.add()"""
+        self.hours.add(other.hours)
+        self.days.add(other.days)
+
+    def gather(self, other, translate=None):
+        """Add the buckets of other, see Buckets.gather()"""
+        self.hours.gather(other.hours, translate)
+        self.days.gather(other.days, translate)
+
+    def handover(self, other, when, translate=None):
+        """
+        Move the addresses of the buckets of other before the ones wall
+        clock seconds when fall in to ours, see Buckets.handover()
+        """
+        self.hours.handover(other.hours, int(when // HOUR), translate)
+        self.days.handover(other.days, int(when // DAY), translate)
+
+    def release(self, when):
+        """
+        Drop the addresses of the buckets before the ones wall clock
+        seconds when fall in, see Buckets.release()
+        """
+        self.hours.release(int(when // HOUR))
+        self.days.release(int(when // DAY))
+
+    def get(self, width):
+        """Return the buckets for width, a key of WIDTHS"""
+        return {"hour": self.hours, "day": self.days}[width]
+
+
+def ascsv(buckets):
+    """Return the rows of buckets as CSV text, with a header"""
+    output = [",".join(COLUMNS)]
+    for row in buckets.rows():
+        output.append("%s,%s,%s,%s" % ((stamp(row[0]),) + row[1:]))
+    return "\n".join(output) + "\n"
+
+
+def asjson(buckets):
+    """Return the rows of buckets as a JSON list of objects"""
+    return json.dumps([dict(zip(COLUMNS, (stamp(row[0]),) + row[1:]))
+                       for row in buckets.rows()], indent=2) + "\n"
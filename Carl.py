@@ -9,13 +9,32 @@ An rsync logfile analyzer.
 Intended to be used mainly by Gentoo Rsync Mirror admins
 """
 import argparse
+import array
+import calendar
+import copy
+import csv
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import pickle
 import sys
 import time
 import hashlib  # pylint: disable=import-error
 from random import random
 
 import Accounts
+import Addresses
+import Buckets
+import History
+import Instrument
+import Logfiles
+import LogFormats
+import Server
 import Sessions
+import Sketches
+import Snapshots
 
 __version__ = "0.9"
 
@@ -33,6 +52,11 @@ __SIPREFIXES__ = ["", "k", "M", "G", "T", "P"]
 # the same IP, yet it makes the use of even a partial rainbow table
 # unfeasible
 SALT = "%s" % (random())
+# MD5 obfuscations made so far, by salted data, see obfuscate(). Reports
+# in several outputs (see --output) show the same top lists.
+_FANCY = {}
+# Obfuscations kept at most before starting over
+_FANCYMAX = 65536
 
 
 def crunch(number, div=1024):
@@ -55,11 +79,16 @@ def obfuscate(data, style):
     """
     if data != "" and style == "fancy":
         # This branch doesn't care about v4 vs v6
-        md5sum = hashlib.new("md5")
         data += SALT
-        md5sum.update(data.encode("utf8"))
-        dig = md5sum.hexdigest()
-        result = "%s...%s" % (dig[:8], dig[-8:])
+        result = _FANCY.get(data)
+        if result is None:
+            md5sum = hashlib.new("md5")
+            md5sum.update(data.encode("utf8"))
+            dig = md5sum.hexdigest()
+            result = "%s...%s" % (dig[:8], dig[-8:])
+            if len(_FANCY) >= _FANCYMAX:
+                _FANCY.clear()
+            _FANCY[data] = result
     elif data != "" and style == "simple":
         if ":" in data:  # IPv6
             if data != "::1":
@@ -77,6 +106,106 @@ def obfuscate(data, style):
     return result
 
 
+# What logclock() accepts between hours, minutes and seconds
+_COLONS = (":", b":")
+
+
+def logclock(convert=time.mktime):
+    """
+    Return a function that turns a log timestamp ("2004/02/23 23:11:27")
+    into seconds since the epoch.
+
+    time.strptime() is far too slow to be called for every line, so the
+    returned function only calls it once per hour of log and adds the
+    minutes and seconds itself. Minutes already seen are looked up.
+    convert turns the struct_time of the hour into seconds; with
+    calendar.timegm, the stamp is taken as UTC, which gives the wall clock
+    seconds Buckets uses. Raises ValueError on malformed stamps.
+    """
+    hours = {}
+    minutes = {}
+
+    def clock(stamp):
+        """Convert stamp (str or bytes) to seconds since the epoch"""
+        minute = stamp[:17]
+        try:
+            base = minutes[minute]
+        except KeyError:
+            if len(stamp) < 19 or stamp[13:14] not in _COLONS or \
+                    stamp[16:17] not in _COLONS:
+                raise ValueError("malformed timestamp: %r" % stamp)
+            hour = stamp[:13]
+            try:
+                base = hours[hour]
+            except KeyError:
+                if isinstance(hour, bytes):
+                    hour = hour.decode("ascii", "replace")
+                hours.clear()
+                minutes.clear()
+                base = hours[stamp[:13]] = convert(
+                    time.strptime(hour, "%Y/%m/%d %H"))
+            base = minutes[minute] = base + int(stamp[14:16]) * 60
+        if len(stamp) < 19:
+            raise ValueError("malformed timestamp: %r" % stamp)
+        return base + int(stamp[17:19])
+
+    return clock
+
+
+# Formats --since and --until accept, most precise first
+_BOUNDFORMATS = ["%Y/%m/%d %H:%M:%S", "%Y/%m/%d %H:%M", "%Y/%m/%d %H",
+                 "%Y/%m/%d"]
+
+
+def stampbound(text):
+    """
+    Turn a date and time like "2012/12/01 05:00" (or "2012-12-01T05:00")
+    into the prefix of the log timestamps it stands for, as bytes.
+    """
+    norm = text.strip().replace("-", "/").replace("T", " ")
+    for fmt in _BOUNDFORMATS:
+        try:
+            parsed = time.strptime(norm, fmt)
+        except ValueError:
+            continue
+        return time.strftime(fmt, parsed).encode("ascii")
+    raise argparse.ArgumentTypeError("invalid date: %r (use YYYY/MM/DD "
+                                     "[HH[:MM[:SS]]])" % text)
+
+
+# What --output takes, by key: the values allowed (None: any)
+_OUTPUTKEYS = {"file": None, "obfuscation": ["none", "simple", "fancy"],
+               "order": ["normal", "reverse"], "length": ["full", "short"],
+               "top": None, "format": ["text", "json", "csv"]}
+
+
+def outputspec(text):
+    """
+    Turn an output specification like "file=public.txt,obfuscation=fancy"
+    into a dict by the keys of _OUTPUTKEYS; keys not given are left out.
+    """
+    spec = {}
+    for item in text.split(","):
+        key, sep, value = item.partition("=")
+        key = key.strip()
+        if not sep or key not in _OUTPUTKEYS or (
+                _OUTPUTKEYS[key] and value not in _OUTPUTKEYS[key]):
+            raise argparse.ArgumentTypeError(
+                "invalid output: %r (use comma separated KEY=VALUE, keys: "
+                "%s)" % (item, ", ".join(sorted(_OUTPUTKEYS))))
+        if key == "top":
+            try:
+                value = int(value)
+            except ValueError:
+                value = -1
+            if value < 1:
+                raise argparse.ArgumentTypeError(
+                    "invalid output: %r (top needs a positive number)" %
+                    item)
+        spec[key] = value
+    return spec
+
+
 def parse_cmdline(argv):
     """
     Parse commandline stored in argv
@@ -91,17 +220,183 @@ def parse_cmdline(argv):
                         help="set reverse (classic) display order")
     parser.add_argument("-s", "--short", action="store_true", default=False,
                         dest="shortoutput",
-                        help="display only the two top-10 lists")
+                        help="display only the two top lists")
+    parser.add_argument("-n", "--top", type=int, default=10, metavar="N",
+                        help="list the top N hosts (default: %(default)s)")
     parser.add_argument("-v", "--version", action="store_true", default=False)
-    parser.add_argument("filename", nargs="?", type=argparse.FileType('r'),
-                        default=sys.stdin)
+    parser.add_argument("--output", type=outputspec, action="append",
+                        dest="outputs", metavar="SPEC",
+                        help="write a report as SPEC says, instead of the "
+                        "one on stdout; may be repeated, all reports come "
+                        "from one parse. SPEC is comma separated KEY=VALUE: "
+                        "file (default: - for stdout), obfuscation "
+                        "(none, simple, fancy), order (normal, reverse), "
+                        "length (full, short), top (N) and format (text, "
+                        "json, csv); keys not given are as the options say")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of processes to parse a log file with")
+    parser.add_argument("--readers", type=int, default=Logfiles.READERS,
+                        metavar="N",
+                        help="number of logs of a directory or glob to "
+                        "read at the same time (default: %(default)s)")
+    parser.add_argument("--inflight", type=int, default=Logfiles.INFLIGHT,
+                        metavar="N",
+                        help="number of batches of lines (about 1 MB each) "
+                        "the readers may have waiting (default: "
+                        "%(default)s)")
+    parser.add_argument("--state", metavar="FILE",
+                        help="keep parser state in FILE and only parse what "
+                        "was added to the log since the last run (with the "
+                        "same options)")
+    parser.add_argument("-f", "--follow", action="store_true", default=False,
+                        help="keep reading the log as it grows and print "
+                        "the report periodically")
+    parser.add_argument("--interval", type=float, default=60.0,
+                        metavar="SECONDS",
+                        help="with --follow, report at most this often")
+    parser.add_argument("--every-lines", type=int, default=0,
+                        dest="everylines", metavar="N",
+                        help="with --follow, also report after N new lines")
+    parser.add_argument("--report-file", dest="reportfile", metavar="FILE",
+                        help="with --follow, rewrite FILE with each report "
+                        "instead of printing it")
+    parser.add_argument("--serve", type=Server.address, metavar="ADDRESS",
+                        help="follow the log and answer queries for the "
+                        "top clients, totals and the report over HTTP on "
+                        "ADDRESS: [HOST:]PORT (HOST defaults to "
+                        "localhost) or the path of a UNIX socket")
+    parser.add_argument("--timing", action="store_true", default=False,
+                        help="keep when each session started and ended "
+                        "and report session durations, transfer rates "
+                        "and the clients with the slowest transfers")
+    parser.add_argument("--session-timeout", type=int, default=0,
+                        dest="sessiontimeout", metavar="SECONDS",
+                        help="forget sessions that have not been closed "
+                        "after this many seconds of log time, to bound "
+                        "memory if close lines go missing (default: 0, "
+                        "never)")
+    parser.add_argument("--compact", action="store_true", default=False,
+                        help="store client addresses as packed integers "
+                        "to save memory (they are shown in canonical form)")
+    parser.add_argument("--numpy", action="store_true", default=False,
+                        help="like --compact, but add up the accounts in "
+                        "batches with NumPy; saves memory, not time (falls "
+                        "back to --compact if NumPy is not installed)")
+    parser.add_argument("--spill", type=int, metavar="N",
+                        help="move the accounts to a temporary SQLite "
+                        "database on disk once there are N clients")
+    parser.add_argument("--spill-rss", type=int, dest="spillrss",
+                        metavar="MB",
+                        help="move the accounts to disk once Carl uses "
+                        "more than MB megabytes of memory")
+    parser.add_argument("--log-format", type=LogFormats.LogFormat,
+                        dest="logformat", metavar="FORMAT",
+                        help="the \"log format\" of rsyncd, if transfer "
+                        "logging is on: lines of this format are skipped "
+                        "even if they look like session lines (default "
+                        "format: %s)" % LogFormats.DEFAULT.replace("%", "%%"))
+    parser.add_argument("-m", "--module", action="append", dest="modules",
+                        metavar="NAME",
+                        help="rsync module to analyze (default: %s); may "
+                        "be repeated, or 'all', for a report per module "
+                        "and a combined one" % __MODULE__)
+    parser.add_argument("--since", type=stampbound, metavar="DATE",
+                        help="only analyze lines from DATE (YYYY/MM/DD, "
+                        "optionally followed by HH, HH:MM or HH:MM:SS) on")
+    parser.add_argument("--until", type=stampbound, metavar="DATE",
+                        help="only analyze lines before DATE")
+    parser.add_argument("--dump", metavar="FILE",
+                        help="also write a snapshot of the stats to FILE, "
+                        "for --merge")
+    parser.add_argument("--merge", action="store_true", default=False,
+                        help="the files given are snapshots (see --dump), "
+                        "e.g. of several mirrors: report on all of them")
+    parser.add_argument("--record", metavar="DB",
+                        help="also add bytes and sessions per day and "
+                        "client to the history database DB (SQLite), "
+                        "for --history")
+    parser.add_argument("--history", metavar="DB",
+                        help="report on the days from --since to --until "
+                        "(default: all) recorded in DB instead of on logs")
+    parser.add_argument("--approximate", action="store_true", default=False,
+                        help="use the same memory however many clients "
+                        "there are: estimate the number of unique IPs and "
+                        "only keep the busiest clients (shows error bounds)")
+    parser.add_argument("--capacity", type=int, default=10000, metavar="N",
+                        help="with --approximate, keep N clients per top "
+                        "list (default: %(default)s)")
+    parser.add_argument("--bucket", choices=sorted(Buckets.WIDTHS),
+                        help="also write bytes, sessions and unique IPs "
+                        "per hour or day of the log")
+    parser.add_argument("--bucket-file", dest="bucketfile", default="-",
+                        metavar="FILE",
+                        help="with --bucket, write to FILE instead of "
+                        "after the report")
+    parser.add_argument("--bucket-format", dest="bucketformat",
+                        choices=["csv", "json"], default="csv",
+                        help="with --bucket, the format to write "
+                        "(default: %(default)s)")
+    parser.add_argument("--profile", action="store_true", default=False,
+                        help="show progress while parsing and the time "
+                        "spent in each stage afterwards (on stderr)")
+    parser.add_argument("--stats-json", dest="statsjson", metavar="FILE",
+                        help="write the time spent in each stage and line "
+                        "counts to FILE as JSON")
+    parser.add_argument("--cprofile", metavar="FILE",
+                        help="profile the run with cProfile and save the "
+                        "statistics to FILE")
+    parser.add_argument("--tracemalloc", metavar="FILE",
+                        help="trace memory allocations and write the "
+                        "biggest allocation sites to FILE")
+    parser.add_argument("filenames", nargs="*", default=["-"],
+                        metavar="filename",
+                        help="log files to analyze as one log, oldest "
+                        "first; may be compressed (default: stdin). "
+                        "Directories and glob patterns stand for logs of "
+                        "their own, e.g. of several mirrors")
     args = parser.parse_args(argv)
+    if args.top < 1:
+        parser.error("argument -n/--top: must be at least 1")
+    if args.numpy and Accounts.numpy is None:
+        errmsgs.append("NumPy is not installed, using --compact instead of "
+                       "--numpy.\n")
+    if args.logformat is not None and args.logformat.ambiguous():
+        errmsgs.append("Lines of the log format %r look like session lines, "
+                       "ignoring --log-format.\n" % args.logformat.text)
+        args.logformat = None
 
     return (args, msgs, errmsgs)
 
 
-def mkreport(args, stats):
-    """Generate report from stats dictionary, heeding args."""
+def toplist(accounts, num, tops=None):
+    """
+    Return accounts.top(num). tops (a dict) keeps the top lists made for
+    a round of reports on the same stats (see writeoutputs()), so each is
+    only made once; a shorter one is cut from a longer one.
+    """
+    if tops is None:
+        return accounts.top(num)
+    made = tops.get(id(accounts))
+    if made is None or made[0] < num:
+        made = tops[id(accounts)] = (num, accounts.top(num))
+    return made[1][:num]
+
+
+def topshare(accounts, tops=None):
+    """Return accounts.topfraction(0.05), kept in tops like toplist()"""
+    if tops is None:
+        return accounts.topfraction(0.05)
+    key = ("share", id(accounts))
+    if key not in tops:
+        tops[key] = accounts.topfraction(0.05)
+    return tops[key]
+
+
+def mkreport(args, stats, tops=None):
+    """
+    Generate report from stats dictionary, heeding args. tops is for
+    toplist().
+    """
     output = []
 
     if not args.shortoutput:
@@ -113,17 +408,20 @@ def mkreport(args, stats):
         output.append("Total number of unique IPs: %s" %
                       stats["ipb"].seencount)
         output.append("Log seems to span %0.2f days." % (stats["span"]))
+        if stats.get("buckets") is not None:
+            output.extend(peaks(stats["buckets"]))
         output.append("")
 
-    output.append(" Top 10 Hosts by byte count")
+    output.append(" Top %i Hosts by byte count" % args.top)
     output.append("Rank bytes     ( Bytes )     IP-Address")
     output.append("-----------------------------------------")
 
-    top10list = stats["ipb"].counts()[-10:]
-    ranklist = list(range(1, 11))
+    top10list = toplist(stats["ipb"], args.top, tops)
+    ranklist = list(range(1, args.top + 1))
 
-    if not args.reverse:
+    if args.reverse:
         top10list.reverse()
+    else:
         ranklist.reverse()
     for entry in top10list:
         sbytes, pfxn = crunch(entry[0])
@@ -141,10 +439,13 @@ def mkreport(args, stats):
                       (stats["totaltraffic"] / stats["span"], savg,
                        __SIPREFIXES__[pfxn]))
 
-        ttop5num = int(stats["ipb"].seencount * 0.05)
-        ttop5traffic = 0
-        for entry in stats["ipb"].counts()[-ttop5num:]:
-            ttop5traffic += entry[0]
+        ttop5list = topshare(stats["ipb"], tops)
+        ttop5num = len(ttop5list)
+        if ttop5list:
+            ttop5traffic = sum(entry[0] for entry in ttop5list)
+        else:
+            # Historically, an empty top 5% meant "everyone"
+            ttop5traffic = stats["ipb"].total
 
         stop, pfxn = crunch(ttop5traffic)
         output.append("Top 5%% of IPs (%s) account for %s bytes (%0.2f%sB) "
@@ -155,15 +456,16 @@ def mkreport(args, stats):
 
     output.append("")
 
-    output.append(" Top 10 Hosts by session count")
+    output.append(" Top %i Hosts by session count" % args.top)
     output.append("Rank Sess.   per day    IP-Address")
     output.append("----------------------------------")
 
-    top10list = stats["ipc"].counts()[-10:]
-    ranklist = list(range(1, 11))
+    top10list = toplist(stats["ipc"], args.top, tops)
+    ranklist = list(range(1, args.top + 1))
 
-    if not args.reverse:
+    if args.reverse:
         top10list.reverse()
+    else:
         ranklist.reverse()
 
     for entry in top10list:
@@ -179,114 +481,1392 @@ def mkreport(args, stats):
         output.append("Average number of sessions per day: %0.2f" %
                       (stats["sessions"].seencount / stats["span"]))
 
-        stop5num = int(stats["ipc"].seencount * 0.05)
-        stop5sessions = 0
-
-        for entry in stats["ipc"].counts()[-stop5num:]:
-            stop5sessions += entry[0]
+        stop5list = topshare(stats["ipc"], tops)
+        stop5num = len(stop5list)
+        if stop5list:
+            stop5sessions = sum(entry[0] for entry in stop5list)
+        else:
+            stop5sessions = stats["ipc"].total
 
         output.append("Top 5%% of IPs (%s) account for %s sessions," %
                       (stop5num, stop5sessions))
         output.append("which is %0.2f%% of the total number of sessions." %
                       (stop5sessions / (stats["sessions"].seencount / 100.0)))
+        if stats["sessions"].orphaned or stats["sessions"].evicted:
+            output.append("Sessions without a close: %s replaced (pid "
+                          "reuse), %s timed out, %s still open" %
+                          (stats["sessions"].orphaned,
+                           stats["sessions"].evicted,
+                           stats["sessions"].opencount()))
         output.append("")
 
+        if stats.get("records") is not None:
+            output.extend(timings(args, stats, tops))
+            output.append("")
+
         output.append("Analyzed %s lines in %0.2f seconds, %0.2f lines "
                       "per second" %
                       (stats["linecount"], stats["rtime"],
                        stats["linecount"] / stats["rtime"]))
 
+    if isinstance(stats["ipb"], Accounts.ApproxAccounts):
+        output.append("")
+        output.extend(errorbounds(args, stats, tops))
+
     return "\n".join(output)
 
 
-def parsedata(inputdata):
-    """Parse data in inputdata and return stats dictionary."""
+def mkreports(args, stats, tops=None):
+    """
+    Generate the report from stats dictionary, heeding args. With several
+    modules, the report for all of them is followed by one per module.
+    tops is for toplist().
+    """
+    output = [mkreport(args, stats, tops)]
+    for name in sorted(stats.get("modules") or ()):
+        module = modulestats(stats, name)
+        output.append("")
+        output.append("Module %s" % module["module"])
+        output.append("=" * len(output[-1]))
+        if module["sessions"].seencount:
+            output.append(mkreport(args, module, tops))
+        else:
+            output.append("No sessions.")
+    return "\n".join(output)
+
+
+def outputargs(args, spec):
+    """Return a copy of args, changed as the output spec says."""
+    oargs = copy.copy(args)
+    if "obfuscation" in spec:
+        oargs.ostyle = spec["obfuscation"]
+    if "order" in spec:
+        oargs.reverse = spec["order"] == "reverse"
+    if "length" in spec:
+        oargs.shortoutput = spec["length"] == "short"
+    if "top" in spec:
+        oargs.top = spec["top"]
+    return oargs
+
+
+def totals(stats):
+    """Return the totals of stats, as plain values for JSON."""
+    span = stats["span"]
+    return {"lines": stats["linecount"],
+            "traffic": stats["totaltraffic"],
+            "sessions": stats["sessions"].seencount,
+            "unique_ips": stats["ipb"].seencount,
+            "span_days": None if span == "unknown" else span,
+            "last": stats["laststamp"]}
+
+
+def toprows(args, stats, tops=None):
+    """
+    Yield (list, rank, value, IP, host name) for the entries of the top
+    lists of stats ("bytes", "sessions" and, with --timing, "rate" in bytes
+    per second, slowest first), heeding args. tops is for toplist().
+    """
+    ip2hname = stats["ip2hname"]
+    lists = [(stats["ipb"], "bytes"), (stats["ipc"], "sessions")]
+    if stats.get("records") is not None:
+        lists.append((stats["records"], "rate"))
+    text = keytext(stats)
+    for accounts, unit in lists:
+        entries = list(enumerate(toplist(accounts, args.top, tops), 1))
+        if args.reverse:
+            entries.reverse()
+        for rank, entry in entries:
+            ipaddr = text(entry[-1])
+            yield (unit, rank, entry[0], obfuscate(ipaddr, args.ostyle),
+                   obfuscate(ip2hname.get(ipaddr, ""), args.ostyle))
+
+
+def moduleparts(stats):
+    """
+    Yield (module name, stats) for the report on stats, then, with several
+    modules, for each of them; the name is None for all of them together.
+    """
+    yield None, stats
+    for name in sorted(stats.get("modules") or ()):
+        module = modulestats(stats, name)
+        yield module["module"], module
+
+
+def reportdata(args, stats, tops=None):
+    """
+    Return the report on stats as plain values for JSON, heeding args:
+    the totals (unless args ask for a short one), the top lists and those
+    of each module. tops is for toplist().
+    """
+    data = {}
+    for name, part in moduleparts(stats):
+        entry = {}
+        if not args.shortoutput:
+            entry["totals"] = totals(part)
+            if part.get("records") is not None:
+                durations, rates = timing(part["records"], tops)
+                names = ["p%i" % point for point in Sessions.PERCENTILES]
+                entry["timing"] = {
+                    "sessions": len(part["records"]),
+                    "duration": durations and dict(zip(names, durations)),
+                    "rate": rates and dict(zip(names, rates))}
+        entry["bytes"] = []
+        entry["sessions"] = []
+        if part.get("records") is not None:
+            entry["rate"] = []
+        for unit, rank, value, ipaddr, hname in toprows(args, part, tops):
+            entry[unit].append({"rank": rank, "ip": ipaddr, "host": hname,
+                                unit: value})
+        if name is None:
+            data = entry
+        else:
+            data.setdefault("modules", {})[name] = entry
+    return data
+
+
+def reportcsv(args, stats, tops=None):
+    """
+    Return the top lists of stats (and of each module) as CSV text, with a
+    header, heeding args. tops is for toplist().
+    """
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator="\n")
+    writer.writerow(["module", "list", "rank", "value", "ip", "host"])
+    for name, part in moduleparts(stats):
+        for row in toprows(args, part, tops):
+            writer.writerow((name or "",) + row)
+    return output.getvalue()
+
+
+def renderoutputs(args, stats):
+    """
+    Return the reports on stats args ask for (see --output; the usual
+    report if there are none) as a list of (file name, text). The top
+    lists and obfuscations are made once for all of them.
+    """
+    tops = {}
+    rendered = []
+    for spec in args.outputs or [{}]:
+        oargs = outputargs(args, spec)
+        form = spec.get("format", "text")
+        if form == "json":
+            text = json.dumps(reportdata(oargs, stats, tops), indent=2)
+        elif form == "csv":
+            text = reportcsv(oargs, stats, tops).rstrip("\n")
+        else:
+            text = mkreports(oargs, stats, tops)
+        rendered.append((spec.get("file", "-"), text + "\n"))
+    return rendered
+
+
+def writeoutputs(rendered, output=None):
+    """
+    Write the reports of renderoutputs() to their files; - is output,
+    stdout by default.
+    """
+    for fname, text in rendered:
+        if fname == "-":
+            (output or sys.stdout).write(text)
+        else:
+            with open(fname, "w") as fobj:
+                fobj.write(text)
+
+
+def peaks(series):
+    """Return the lines on the peak hour and day of series (Buckets)."""
+    output = []
+    for name, buckets, length in (("hour", series.hours, 16),
+                                  ("day", series.days, 10)):
+        peak = buckets.peak()
+        if peak is None:
+            continue
+        sbytes, pfxn = crunch(peak[1])
+        output.append("Peak %s: %s with %.2f %sBytes in %s sessions from %s "
+                      "IPs" % (name, Buckets.stamp(peak[0])[:length], sbytes,
+                               __SIPREFIXES__[pfxn], peak[2], peak[3]))
+    return output
+
+
+def timing(records, tops=None):
+    """
+    Return the percentiles (see Sessions.PERCENTILES) of the durations
+    and transfer rates of records (a Sessions.Records), each None if there
+    are no records. They are kept in tops like toplist() does.
+    """
+    key = ("timing", id(records))
+    if tops is not None and key in tops:
+        return tops[key]
+    made = (Sessions.percentiles(records.duration),
+            Sessions.percentiles(records.rates()))
+    if tops is not None:
+        tops[key] = made
+    return made
+
+
+def timings(args, stats, tops=None):
+    """
+    Return the lines on session durations and transfer rates and the
+    clients with the lowest transfer rate (see --timing). tops is for
+    toplist().
+    """
+    output = []
+    records = stats["records"]
+    durations, rates = timing(records, tops)
+    if durations is None:
+        return ["No session timings (no sessions were closed)."]
+    names = ["p%i" % point for point in Sessions.PERCENTILES]
+    output.append("Session duration: %s (of %s closed sessions)" % (
+        ", ".join("%s %ss" % (name, value)
+                  for name, value in zip(names, durations)), len(records)))
+    parts = []
+    for name, value in zip(names, rates):
+        srate, pfxn = crunch(value)
+        parts.append("%s %.2f %sB/s" % (name, srate, __SIPREFIXES__[pfxn]))
+    output.append("Transfer rate: %s" % ", ".join(parts))
+    output.append("")
+    output.append(" Top %i slowest Hosts (of %i or more sessions)" %
+                  (args.top, Sessions.SLOWSESSIONS))
+    output.append("Rank (  rate   )  seconds  Sess.     IP-Address")
+    output.append("---------------------------------------------")
+    text = keytext(stats)
+    entries = list(enumerate(toplist(records, args.top, tops), 1))
+    if args.reverse:
+        entries.reverse()
+    for rank, (rate, seconds, sessions, _, key) in entries:
+        srate, pfxn = crunch(rate)
+        ipaddr = text(key)
+        output.append("%2s (%7.2f%sB/s) %8s %6s %15s %s" %
+                      (rank, srate, __SIPREFIXES__[pfxn], seconds, sessions,
+                       obfuscate(ipaddr, args.ostyle),
+                       obfuscate(stats["ip2hname"].get(ipaddr, ""),
+                                 args.ostyle)))
+    output.append("---------------------------------------------")
+    return output
+
+
+def errorbounds(args, stats, tops=None):
+    """
+    Return the lines on how far off an --approximate report may be. tops
+    is for toplist().
+    """
+    output = []
+    ipb = stats["ipb"]
+    ipc = stats["ipc"]
+    if not args.shortoutput:
+        output.append("Number of unique IPs is within +-%0.2f%% (two "
+                      "standard errors)." % (200.0 * ipb.seenerror()))
+    berror = max([ipb.error(entry[1]) for entry
+                  in toplist(ipb, args.top, tops)] or [0])
+    serror = max([ipc.error(entry[1]) for entry
+                  in toplist(ipc, args.top, tops)] or [0])
+    sbytes, pfxn = crunch(berror)
+    output.append("Top %i byte counts are at most %s bytes (%0.2f%sB) too "
+                  "high, session counts at most %s sessions." %
+                  (args.top, berror, sbytes, __SIPREFIXES__[pfxn], serror))
+    if not args.shortoutput and \
+            int(ipb.seencount * 0.05) > ipb.summary.capacity:
+        output.append("Top 5%% of IPs are limited to the %s busiest clients "
+                      "kept." % ipb.summary.capacity)
+    return output
+
+
+def iterlines(inputdata):
+    """
+    Return an iterator over the lines of inputdata, line endings included.
+
+    inputdata may be a string, a bytes object, a file object or any other
+    iterable of lines. Lines are read lazily and come out as they are,
+    i.e. as str or as bytes.
+    """
+    if isinstance(inputdata, str):
+        inputdata = io.StringIO(inputdata)
+    elif isinstance(inputdata, bytes):
+        inputdata = io.BytesIO(inputdata)
+    return iter(inputdata)
+
+
+def newstats(args):
+    """Return an empty stats dictionary set up according to args."""
     stats = {}
-    stats["ipc"] = Accounts.Accounts()
-    stats["ipb"] = Accounts.Accounts()
-    stats["sessions"] = Sessions.Sessions()
-    stats["ip2hname"] = {}
+    if args.approximate:
+        stats["ipc"] = Accounts.ApproxAccounts(args.capacity)
+        stats["ipb"] = Accounts.ApproxAccounts(args.capacity)
+        # Only the names of clients that may still make a top list
+        stats["ip2hname"] = Sketches.TrackedDict(
+            2 * args.capacity, [stats["ipc"].summary, stats["ipb"].summary])
+    elif args.compact or args.numpy:
+        # Addresses are interned, everything else refers to them by id
+        table = stats["addresses"] = Addresses.AddressTable()
+        kind = Accounts.CompactAccounts
+        if args.numpy and Accounts.numpy is not None:
+            kind = Accounts.VectorAccounts
+        stats["ipc"] = kind(table)
+        stats["ipb"] = kind(table)
+        stats["ip2hname"] = Addresses.HostNames(table)
+    elif args.spill or args.spillrss:
+        rsslimit = args.spillrss and args.spillrss * 1024
+        stats["ipc"] = Accounts.SpillAccounts(args.spill, rsslimit)
+        stats["ipb"] = Accounts.SpillAccounts(args.spill, rsslimit)
+        stats["ip2hname"] = {}
+    else:
+        stats["ipc"] = Accounts.Accounts()
+        stats["ipb"] = Accounts.Accounts()
+        stats["ip2hname"] = {}
+    stats["sessions"] = Sessions.Sessions(args.sessiontimeout or None)
+    if args.approximate:
+        # Unique addresses per bucket are estimated like those overall
+        stats["buckets"] = Buckets.Series(stats["ipc"].distinct.precision)
+    else:
+        stats["buckets"] = Buckets.Series()
+    if args.record:
+        stats["days"] = History.Days()
+    if args.logformat is not None:
+        stats["logformat"] = args.logformat
+    if args.timing:
+        stats["records"] = Sessions.Records()
 
     stats["linecount"] = 0
     stats["totaltraffic"] = 0
-    stats["rtime"] = time.time()
-    line = ""
-    ldate = None
-    ltime = None
+    stats["rtime"] = 0.0
+    stats["start"] = None
+    stats["laststamp"] = None
+    # Lines of each kind, see Instrument.linecounts()
+    stats["counts"] = {"connect": 0, "sent": 0, "error": 0, "malformed": 0}
+    stats["stages"] = newstages(args)
+
+    modules = args.modules or [__MODULE__]
+    if len(modules) == 1 and modules[0] != "all":
+        stats["module"] = modules[0]
+    else:
+        # Several modules: the stats above are for all of them together,
+        # those of each module are kept in stats["modules"] by name.
+        stats["module"] = None
+        stats["modules"] = {}
+        stats["owners"] = {}
+        stats["wanted"] = None
+        if "all" not in modules:
+            stats["wanted"] = set(name.encode(Logfiles.ENCODING)
+                                  for name in modules)
+            for name in stats["wanted"]:
+                addmodule(stats, name)
+    return stats
+
 
+def pruneowners(stats):
+    """
+    Forget the modules of sessions of stats that are no longer open, e.g.
+    because they were evicted (see Sessions) before they were closed.
+    """
+    owners = stats["owners"]
+    opensessions = stats["sessions"].accounts
+    for pid in [pid for pid in owners if pid not in opensessions]:
+        del owners[pid]
+
+
+def addmodule(stats, name):
+    """
+    Add the stats of the module name (bytes) to the stats of several
+    modules and return them. They keep their own accounts, sessions and
+    traffic, set up like those of stats; the rest is shared with stats.
+    """
+    module = {"sessions": Sessions.Sessions(stats["sessions"].maxage),
+              "totaltraffic": 0}
+    for key in ("ipc", "ipb"):
+        accounts = stats[key]
+        if isinstance(accounts, Accounts.ApproxAccounts):
+            module[key] = Accounts.ApproxAccounts(accounts.summary.capacity)
+            stats["ip2hname"].summaries.append(module[key].summary)
+        elif isinstance(accounts, Accounts.CompactAccounts):
+            # or VectorAccounts
+            module[key] = type(accounts)(stats["addresses"])
+        elif isinstance(accounts, Accounts.SpillAccounts):
+            module[key] = Accounts.SpillAccounts(accounts.limit,
+                                                 accounts.rsslimit)
+        else:
+            module[key] = Accounts.Accounts()
+    stats["modules"][name] = module
+    return module
+
+
+def modulestats(stats, name):
+    """
+    Return a stats dictionary for the module name (bytes) of the stats of
+    several modules, one that mkreport() can use.
+    """
+    module = dict(stats, **stats["modules"][name])
+    module["module"] = name.decode(Logfiles.ENCODING, "replace")
+    # Peaks and timings are only known for all modules together
+    module["buckets"] = None
+    module["records"] = None
+    del module["modules"]
+    return module
+
+
+def newstages(args):
+    """Return an Instrument.Stages if args ask for timings, else None."""
+    if args.profile or args.statsjson:
+        return Instrument.Stages()
+    return None
+
+
+def grammar(module=__MODULE__):
+    """
+    Return a dict of the constant byte strings parselines() looks for in
+    the log of module; with module None, those for any module.
+    """
+    consts = {
+        "rsyncon": "rsync on %s" % (module or ""),
+        "metadata": " %s/metadata" % (module or ""),
+        "sent": "sent",
+        "error": "rsync error",
+        "warning": "rsync: ",
+        "comma": ",",
+        "empty": "",
+        "unknown": "UNKNOWN",
+        "eol": "\r\n",
+        "space": " ",
+    }
+    for key, value in consts.items():
+        consts[key] = value.encode("ascii")
+    return consts
+
+
+# Kinds of lines parselines() cares about
+_CONNECT = 1
+_TRANSFER = 2
+# Module owners of sessions no longer open kept before pruneowners()
+_OWNERSLACK = 1024
+
+# Single bytes parselines() looks at
+_SPACE = ord(" ")
+_LBRACKET = ord("[")
+_RBRACKET = ord("]")
+_DELETE = ord("\x7f")
+_LETTER_R = ord("r")
+_LETTER_S = ord("s")
+
+
+def parselines(stats, inputdata, progress=None, rankings=None):
+    """
+    Parse the lines in inputdata (see iterlines()) and add them to stats.
+
+    Lines may be str or bytes; str lines are encoded and parsed as bytes.
+    Lines are never decoded as a whole, only the IP and hostname fields
+    that end up in stats are, so invalid characters elsewhere do no harm.
+    Session ids (pids) are kept as bytes. Lines before the first one with
+    a valid timestamp are skipped.
+
+    If stats has stages (see newstages()), the time spent is accounted to
+    them and progress (an Instrument.Progress) is kept up to date.
+    rankings (a dict of Server.Ranking by "ipc" and "ipb") are told which
+    accounts change. With stats["logformat"] (a LogFormats.LogFormat),
+    per-file lines that look like session lines are skipped.
+    """
+    lines = iterlines(inputdata)
     try:
-        for line in inputdata.splitlines():
-            if not line:
-                continue
-            stats["linecount"] += 1
-            try:
-                ldate, ltime = line.split(None, 2)[0:2]
-            except ValueError:
-                continue
+        line = next(lines)
+    except StopIteration:
+        return
+    lines = itertools.chain([line], lines)
+    encoding = Logfiles.ENCODING
+    if not isinstance(line, bytes):
+        lines = (line.encode(encoding, "surrogateescape") for line in lines)
+
+    consts = grammar(stats.get("module", __MODULE__))
+    rsyncon = consts["rsyncon"]
+    metadata = consts["metadata"]
+    sent = consts["sent"]
+    errors = (consts["error"], consts["warning"])
+    comma = consts["comma"]
+    empty = consts["empty"]
+    unknown = consts["unknown"]
+    eol = consts["eol"]
+    space = consts["space"]
+
+    ipcincr = stats["ipc"].incr
+    ipbincr = stats["ipb"].incr
+    if rankings is not None:
+        ipcincr = rankings["ipc"].wrap(ipcincr)
+        ipbincr = rankings["ipb"].wrap(ipbincr)
+    # With --numpy, the address ids of connects and those and the bytes of
+    # transfers are collected here and added up a batch at a time, see
+    # Accounts.VectorAccounts.addbatch(); rankings need every increment.
+    connids = xferids = xferbytes = None
+    if (rankings is None and
+            isinstance(stats["ipc"], Accounts.VectorAccounts) and
+            isinstance(stats["ipb"], Accounts.VectorAccounts)):
+        connids = array.array("q")
+        xferids = array.array("q")
+        xferbytes = array.array("q")
+        ipcincr = connids.append
+
+        def addbatches():
+            """Add up the increments collected so far"""
+            stats["ipc"].addbatch(connids)
+            stats["ipb"].addbatch(xferids, xferbytes)
+            del connids[:], xferids[:], xferbytes[:]
+    push = stats["sessions"].push
+    pop = stats["sessions"].pop
+    bucketconnect = stats["buckets"].connect
+    buckettransfer = stats["buckets"].transfer
+    stages = stats.get("stages")
+    if stages is not None:
+        began = stages.snapshot()
+        lines = stages.lines("read", lines, progress)
+        ipcincr = stages.wrap("accounts", ipcincr)
+        ipbincr = stages.wrap("accounts", ipbincr)
+        if connids is not None:
+            addbatches = stages.wrap("accounts", addbatches)
+        push = stages.wrap("sessions", push)
+        pop = stages.wrap("sessions", pop)
+        bucketconnect = stages.wrap("buckets", bucketconnect)
+        buckettransfer = stages.wrap("buckets", buckettransfer)
+    ip2hname = stats["ip2hname"]
+    # Only set for several modules, see newstats()
+    modules = stats.get("modules")
+    owners = stats.get("owners")
+    wanted = stats.get("wanted")
+    opensessions = stats["sessions"].accounts
+    # Only set in compact mode, see newstats()
+    intern = None
+    if "addresses" in stats:
+        intern = stats["addresses"].intern
+    linecount = stats["linecount"]
+    totaltraffic = stats["totaltraffic"]
+    start = stats["start"]
+    counts = stats["counts"]
+    connects = transfers = errorlines = malformed = 0
+    # The last line that had a date and a time, for stats["laststamp"]
+    lastsplit = None
+    clock = logclock()
+    wallclock = logclock(calendar.timegm)
+    # Timestamps repeat a lot, so only convert new ones
+    laststamp = None
+    when = wall = None
+    # Only set when parsing a chunk of a log, see parsechunk()
+    pending = stats.get("pending")
+    firstpushes = stats.get("firstpushes")
+    # Only set with --record, see newstats()
+    days = stats.get("days")
+    # Only set with --log-format: matches messages of per-file lines
+    perfile = None
+    if "logformat" in stats:
+        perfile = stats["logformat"].regex.match
+    # Only set with --timing, see newstats()
+    records = stats.get("records")
+    started = stats["sessions"].started
 
-            if stats["linecount"] == 1:
+    try:
+        for line in lines:
+            # Fast path: a line starting with "<date> <time> [" has at least
+            # two fields and counts. The message is classified by its first
+            # letter, which rejects most lines cheaply. Indexing bytes gives
+            # ints, which is a lot faster than slicing.
+            if (start is not None and len(line) > 21 and
+                    line[19] == _SPACE and line[20] == _LBRACKET and
+                    line[18] > _SPACE):
+                linecount += 1
+                lastsplit = line
+                spc = line.find(space, 21)
+                if 0 < spc < len(line) - 1:
+                    first = line[spc + 1]
+                else:
+                    # No space or nothing after it (e.g. a line still
+                    # being written), which the long way sorts out
+                    first = _SPACE
+                if (line[spc - 1] != _RBRACKET or
+                        not _SPACE < first < _DELETE):
+                    # Odd spacing, let the long way sort it out
+                    pid = None
+                elif first == _LETTER_R:
+                    if not line.startswith(rsyncon, spc + 1):
+                        if line.startswith(errors, spc + 1):
+                            errorlines += 1
+                        continue
+                    pid = line[20:spc]
+                    msg = line[spc + 1:]
+                    if modules is None and metadata in msg:
+                        continue
+                    kind = _CONNECT
+                elif first == _LETTER_S:
+                    if not line.startswith(sent, spc + 1):
+                        continue
+                    pid = line[20:spc]
+                    msg = line[spc + 1:]
+                    kind = _TRANSFER
+                else:
+                    continue
+
+            else:
+                # Everything else takes the long way round
+                line = line.rstrip(eol)
+                if not line:
+                    continue
+                linecount += 1
                 try:
-                    # timefmt: 2004/02/23 23:11:27
-                    stats["start"] = time.mktime(
-                        time.strptime("%s %s" % (ldate, ltime),
-                                      "%Y/%m/%d %H:%M:%S"))
+                    ldate, ltime = line.split(None, 2)[0:2]
                 except ValueError:
-                    stats["linecount"] = 0  # Make sure we try the next one
+                    if start is None:
+                        linecount -= 1
+                    else:
+                        malformed += 1
                     continue
+                lastsplit = line
 
-            try:
-                pid, msg = line[20:].split(None, 1)
-            except ValueError:
-                continue
-            msg = msg.strip()
-            if not msg or msg.startswith("rsync error: "):
-                continue
-            if (msg.startswith("rsync on %s" % (__MODULE__)) and
-                    (" %s/metadata" % (__MODULE__) not in msg)):
+                if start is None:
+                    try:
+                        # timefmt: 2004/02/23 23:11:27
+                        start = time.mktime(
+                            time.strptime("%s %s" % (ldate.decode("ascii"),
+                                                     ltime.decode("ascii")),
+                                          "%Y/%m/%d %H:%M:%S"))
+                    except (ValueError, UnicodeDecodeError):
+                        linecount -= 1  # Make sure we try the next one
+                        continue
+                pid = None
 
+            if pid is None:
                 try:
-                    hname, ipaddr = msg.split(None, 6)[4:6]
+                    pid, msg = line.rstrip(eol)[20:].split(None, 1)
                 except ValueError:
+                    malformed += 1
+                    continue
+                msg = msg.strip()
+                if msg.startswith(rsyncon):
+                    if modules is None and metadata in msg:
+                        continue
+                    kind = _CONNECT
+                elif msg.startswith(sent):
+                    kind = _TRANSFER
+                else:
+                    if msg.startswith(errors):
+                        errorlines += 1
                     continue
-                ipaddr = ipaddr[1:-2]  # remove ()
-                # Do some hostname caching which can be used for
-                # output later
-                if hname != "UNKNOWN" and not stats["ip2hname"].get(ipaddr):
-                    stats["ip2hname"][ipaddr] = hname
-                stats["ipc"].incr(ipaddr)
-                stats["sessions"].push(pid, '%s' % (ipaddr))
 
-            elif msg.startswith("sent"):
+            if perfile is not None and perfile(msg) is not None:
+                # A file name (or the like) that looks like a session line
+                continue
+
+            stamp = line[:19]
+            if stamp != laststamp:
+                laststamp = stamp
+                try:
+                    when = clock(stamp)
+                    wall = wallclock(stamp)
+                except ValueError:
+                    when = wall = None
+
+            if kind == _CONNECT:
+                fields = msg.split(None, 6)
                 try:
-                    values = msg.split(None, 11)
-                    wbytes = values[1].replace(",", "")
-                    rbytes = values[4].replace(",", "")
+                    hname, ipaddr = fields[4:6]
                 except ValueError:
+                    malformed += 1
                     continue
-                ipaddr = stats["sessions"].pop(pid)
-                stats["ipb"].incr(ipaddr, int(wbytes) + int(rbytes))
-                stats["totaltraffic"] += int(rbytes) + int(wbytes)
+                if modules is not None:
+                    name = fields[2].split(b"/", 1)[0]
+                    if fields[2].startswith(name + b"/metadata"):
+                        continue
+                    module = modules.get(name)
+                    if module is None:
+                        if wanted is not None:
+                            continue
+                        module = addmodule(stats, name)
+                connects += 1
+                ipaddr = ipaddr[1:-1].decode(encoding, "replace")  # no ()
+                if intern is not None:
+                    ipaddr = intern(ipaddr)
+                # Do some hostname caching which can be used for
+                # output later
+                if hname != unknown and not ip2hname.get(ipaddr):
+                    ip2hname[ipaddr] = hname.decode(encoding, "replace")
+                ipcincr(ipaddr)
+                if connids is not None and len(connids) >= Accounts.BATCH:
+                    addbatches()
+                if wall is not None:
+                    bucketconnect(wall)
+                    if days is not None:
+                        days.connect(wall, ipaddr)
+                if firstpushes is not None:
+                    firstpushes.note(pid, when)
+                push(pid, ipaddr, when)
+                if modules is not None:
+                    module["ipc"].incr(ipaddr)
+                    module["sessions"].push(pid, ipaddr, when)
+                    owners[pid] = name
+                    # Sessions that were evicted instead of closed
+                    if len(owners) > 2 * len(opensessions) + _OWNERSLACK:
+                        pruneowners(stats)
+
+            else:
+                values = msg.split(None, 5)
+                sentbytes = int(values[1].replace(comma, empty))
+                received = int(values[4].replace(comma, empty))
+                nbytes = sentbytes + received
+                if records is not None:
+                    since = started.get(pid)
+                ipaddr = pop(pid, when)
+                if ipaddr is not None:
+                    if xferids is None:
+                        ipbincr(ipaddr, nbytes)
+                    else:
+                        xferids.append(ipaddr)
+                        xferbytes.append(nbytes)
+                        if len(xferids) >= Accounts.BATCH:
+                            addbatches()
+                    if days is not None and wall is not None:
+                        days.transfer(wall, ipaddr, nbytes)
+                    if (records is not None and since is not None and
+                            when is not None):
+                        records.add(since, when, sentbytes, received, ipaddr)
+                elif pending is not None and not firstpushes.get(pid)[0]:
+                    # The session was opened in an earlier chunk
+                    pending.append((pid, when, wall, sentbytes, received))
+                if wall is not None:
+                    # Addresses count where the accounts count them
+                    buckettransfer(wall, nbytes, ipaddr)
+                if owners is not None and pid in owners:
+                    module = modules[owners.pop(pid)]
+                    module["totaltraffic"] += nbytes
+                    ipaddr = module["sessions"].pop(pid, when)
+                    if ipaddr is not None:
+                        module["ipb"].incr(ipaddr, nbytes)
+                totaltraffic += nbytes
+                transfers += 1
 
-        stats["span"] = "unknown"
-        if ldate and ltime:
+    except ValueError:
+        sys.stderr.write("Your logfile has a strange format (line %i).\n" %
+                         (linecount))
+        sys.stderr.write("Line seen:\n" +
+                         line.rstrip(eol).decode(encoding, "replace") + "\n")
+        raise
+    finally:
+        if connids is not None:
+            addbatches()
+        stats["linecount"] = linecount
+        stats["totaltraffic"] = totaltraffic
+        stats["start"] = start
+        counts["connect"] += connects
+        counts["sent"] += transfers
+        counts["error"] += errorlines
+        counts["malformed"] += malformed
+        if stages is not None:
+            stages.rest("classify", began)
+
+    if lastsplit is not None:
+        ldate, ltime = lastsplit.split(None, 2)[0:2]
+        stats["laststamp"] = "%s %s" % (ldate.decode(encoding, "replace"),
+                                        ltime.decode(encoding, "replace"))
+
+
+def finishstats(stats):
+    """Fill in the values of stats that depend on the whole log."""
+    stats["span"] = "unknown"
+    with Instrument.stage(stats.get("stages"), "span"):
+        if stats["laststamp"] and stats["start"] is not None:
             try:
                 stats["span"] = (
-                    (time.mktime(time.strptime("%s %s" % (ldate, ltime),
+                    (time.mktime(time.strptime(stats["laststamp"],
                                                "%Y/%m/%d %H:%M:%S")) -
                      stats["start"]) / (24 * 3600))
             except ValueError:
                 pass
 
-        stats["rtime"] = time.time() - stats["rtime"]
-    except ValueError:
-        sys.stderr.write("Your logfile has a strange format (line %i).\n" %
-                         (stats["linecount"]))
-        sys.stderr.write("Line seen:\n" + line + "\n")
-        raise
 
+def parsedata(inputdata, args=None, progress=None):
+    """
+    Parse data in inputdata and return stats dictionary.
+
+    inputdata may be a string, a file object or any iterable of lines (see
+    iterlines()); it is consumed as a stream. args are the parsed command
+    line options, the defaults are used if it is None. progress is passed
+    on to parselines().
+    """
+    if args is None:
+        args = parse_cmdline([])[0]
+    began = time.time()
+    stats = newstats(args)
+    parselines(stats, inputdata, progress)
+    finishstats(stats)
+    stats["rtime"] = time.time() - began
+
+    return stats
+
+
+def chunkbounds(fname, parts, begin=0, end=None):
+    """
+    Split the file fname (or the part of it from offset begin to end, both
+    on line boundaries) into at most parts byte ranges that start and end
+    on line boundaries. Returns a list of (begin, end) offsets.
+    """
+    if end is None:
+        end = os.path.getsize(fname)
+    offsets = [begin]
+    with open(fname, "rb") as fobj:
+        for part in range(1, parts):
+            offset = begin + (end - begin) * part // parts
+            if offset <= offsets[-1]:
+                continue
+            # Look at the preceding byte, so a chunk that happens to
+            # start on a line boundary is not cut short by a line.
+            fobj.seek(offset - 1)
+            fobj.readline()
+            offset = fobj.tell()
+            if offsets[-1] < offset < end:
+                offsets.append(offset)
+    offsets.append(end)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def readrange(fname, begin, end):
+    """Yield the lines of fname between the byte offsets begin and end."""
+    with open(fname, "rb") as fobj:
+        fobj.seek(begin)
+        left = end - begin
+        for line in fobj:
+            if left <= 0:
+                break
+            left -= len(line)
+            yield line
+
+
+def parsechunk(job):
+    """
+    Parse one byte range of a log file, usually in a worker process.
+
+    job is a tuple (fname, begin, end, args[, first]); first tells if this
+    is the first chunk of what is parsed, by default the one at the start
+    of the file. Closes of sessions that were opened before begin cannot be
+    attributed here; they are collected in stats["pending"] for
+    mergestats().
+    """
+    fname, begin, end, args = job[:4]
+    first = job[4] if len(job) > 4 else not begin
+    stats = newstats(args)
+    stats["pending"] = []
+    stats["firstpushes"] = Sessions.FirstPushes()
+    if not first:
+        # The real start of the log is in the first chunk. Pretend it is
+        # known so no lines are skipped looking for it.
+        stats["start"] = 0.0
+        # Keeps the addresses of its first buckets for mergestats()
+        stats["buckets"] = Buckets.Series(stats["buckets"].precision,
+                                          tail=True)
+    parselines(stats, readrange(fname, begin, end))
     return stats
 
 
+def mergestats(stats, part):
+    """
+    Merge the stats of a chunk of a log (see parsechunk()) into the stats
+    of the part of the log directly preceding it.
+    """
+    sessions = stats["sessions"]
+    owners = stats.get("owners")
+    days = stats.get("days")
+    records = stats.get("records")
+    # Addresses of transfers part could not put a client to, see below
+    late = []
+    for pid, when, wall, sent, received in part["pending"]:
+        nbytes = sent + received
+        since = sessions.started.get(pid)
+        ipaddr = sessions.pop(pid, when)
+        if ipaddr is not None:
+            stats["ipb"].incr(ipaddr, nbytes)
+            if wall is not None:
+                late.append((wall, ipaddr))
+            if days is not None and wall is not None:
+                days.transfer(wall, ipaddr, nbytes)
+            if (records is not None and since is not None and
+                    when is not None):
+                records.add(since, when, sent, received, ipaddr)
+        if owners is not None and pid in owners:
+            module = stats["modules"][owners.pop(pid)]
+            module["totaltraffic"] += nbytes
+            ipaddr = module["sessions"].pop(pid, when)
+            if ipaddr is not None:
+                module["ipb"].incr(ipaddr, nbytes)
+    mergesessions(stats, part, sessions, part["sessions"])
+    for name, partmodule in part.get("modules", {}).items():
+        module = stats["modules"].get(name) or addmodule(stats, name)
+        mergesessions(stats, part, module["sessions"],
+                      partmodule["sessions"])
+        module["ipc"].merge(partmodule["ipc"])
+        module["ipb"].merge(partmodule["ipb"])
+        module["totaltraffic"] += partmodule["totaltraffic"]
+    if owners is not None:
+        owners.update(part["owners"])
+        pruneowners(stats)
+
+    stats["ipc"].merge(part["ipc"])
+    stats["ipb"].merge(part["ipb"])
+    for ipaddr, hname in part["ip2hname"].items():
+        if not stats["ip2hname"].get(ipaddr):
+            stats["ip2hname"][ipaddr] = hname
+    translate = idmap(stats, part)
+    if translate is not None:
+        # So do the addresses the buckets keep to count unique IPs
+        for buckets in (part["buckets"].hours, part["buckets"].days):
+            buckets.current = set(map(translate, buckets.current))
+            if buckets.head is not None:
+                buckets.head = set(map(translate, buckets.head))
+    for wall, ipaddr in late:
+        part["buckets"].address(wall, ipaddr)
+    stats["buckets"].merge(part["buckets"])
+    if days is not None:
+        days.merge(part["days"], translate)
+    if records is not None:
+        records.extend(part["records"], translate)
+    stats["linecount"] += part["linecount"]
+    stats["totaltraffic"] += part["totaltraffic"]
+    for kind, count in part["counts"].items():
+        stats["counts"][kind] += count
+    if stats["stages"] is not None:
+        stats["stages"].merge(part["stages"])
+    if part["laststamp"]:
+        stats["laststamp"] = part["laststamp"]
+
+
+def mergesessions(stats, part, sessions, newer):
+    """
+    Merge the Sessions newer, of the chunk stats part, into the Sessions
+    sessions, of the stats of the part of the log preceding it.
+    """
+    for sid in list(sessions.accounts):
+        seen, when = part["firstpushes"].get(sid)
+        if seen:
+            sessions.supersede(sid, when)
+    translate = idmap(stats, part)
+    if translate is not None:
+        # The open sessions of part refer to addresses by its own ids
+        for sid, addrid in newer.accounts.items():
+            newer.accounts[sid] = translate(addrid)
+    sessions.adopt(newer)
+
+
+def idmap(stats, part):
+    """
+    Return a function turning the address ids of the stats part into those
+    of stats, None if they have none (see --compact).
+    """
+    if "addresses" not in part:
+        return None
+    key = part["addresses"].key
+    internkey = stats["addresses"].internkey
+
+    def translate(addrid):
+        """Return our id for addrid of part"""
+        return internkey(key(addrid))
+    return translate
+
+
+def gatherstats(stats, part, tag):
+    """
+    Add the stats part of another log (e.g. of another mirror) to stats.
+    The open sessions of part get tagged with tag, see Sessions.gather().
+    Both need buckets set up with keep, see spoolparse().
+    """
+    stats["ipc"].merge(part["ipc"])
+    stats["ipb"].merge(part["ipb"])
+    for ipaddr, hname in part["ip2hname"].items():
+        if not stats["ip2hname"].get(ipaddr):
+            stats["ip2hname"][ipaddr] = hname
+    stats["sessions"].gather(part["sessions"], tag)
+    stats["buckets"].gather(part["buckets"], idmap(stats, part))
+    if "days" in stats:
+        stats["days"].merge(part["days"], idmap(stats, part))
+    if "records" in stats:
+        stats["records"].extend(part["records"], idmap(stats, part))
+    stats["linecount"] += part["linecount"]
+    stats["totaltraffic"] += part["totaltraffic"]
+    for kind, count in part["counts"].items():
+        stats["counts"][kind] += count
+    if stats["stages"] is not None and part["stages"] is not stats["stages"]:
+        stats["stages"].merge(part["stages"])
+    if part["start"] is not None and (stats["start"] is None or
+                                      part["start"] < stats["start"]):
+        stats["start"] = part["start"]
+    if part["laststamp"] and (not stats["laststamp"] or
+                              part["laststamp"] > stats["laststamp"]):
+        stats["laststamp"] = part["laststamp"]
+    for name, partmodule in part.get("modules", {}).items():
+        module = stats["modules"].get(name) or addmodule(stats, name)
+        module["ipc"].merge(partmodule["ipc"])
+        module["ipb"].merge(partmodule["ipb"])
+        module["totaltraffic"] += partmodule["totaltraffic"]
+        module["sessions"].gather(partmodule["sessions"], tag)
+
+
+def releasebuckets(stats, parts):
+    """
+    Move the addresses the buckets of the stats parts, of the logs still
+    being spooled, keep of the hours and days all of them have moved past
+    to those of stats, and drop them there (see Buckets.release()).
+    """
+    latest = [part["buckets"].hours.latest() for part in parts.values()]
+    if not latest or None in latest:
+        return
+    if min(latest) == stats["buckets"].hours.released:
+        return
+    before = min(latest) * Buckets.HOUR
+    for part in parts.values():
+        stats["buckets"].handover(part["buckets"], before,
+                                  idmap(stats, part))
+    stats["buckets"].release(before)
+
+
+def spoolparse(fnames, args):
+    """
+    Parse the logs fnames, e.g. of several mirrors, at the same time and
+    return the stats of all of them. Every log has sessions of its own, so
+    pids from different hosts never mix.
+
+    args.readers threads read (and decompress) the logs, the lines are
+    parsed here as they come in.
+    """
+    began = time.time()
+    stats = newstats(args)
+    precision = stats["buckets"].precision
+    # Addresses of all buckets, so clients of several logs count once
+    stats["buckets"] = Buckets.Series(precision, keep=True)
+    parts = {}
+    # Logs not read to the end yet
+    left = len(fnames)
+    spool = Logfiles.Spool(fnames, args.readers, args.inflight)
+    spool.start()
+    for index, batch in spool:
+        part = parts.get(index)
+        if part is None:
+            part = parts[index] = newstats(args)
+            part["buckets"] = Buckets.Series(precision, keep=True)
+            # Timings go straight to stats
+            part["stages"] = stats["stages"]
+        if batch is None:
+            gatherstats(stats, parts.pop(index), index)
+            left -= 1
+        else:
+            parselines(part, batch)
+        if len(parts) == left:
+            releasebuckets(stats, parts)
+    finishstats(stats)
+    stats["rtime"] = time.time() - began
+    return stats
+
+
+def splittable(fnames):
+    """Return True if fnames is a single uncompressed, seekable log file."""
+    if len(fnames) != 1 or fnames[0] == "-":
+        return False
+    with open(fnames[0], "rb") as fobj:
+        return fobj.seekable() and Logfiles.compression(fobj) is None
+
+
+def parallelparse(fname, args, begin=0, end=None):
+    """
+    Parse the log file fname (or the byte range begin to end of it) using
+    args.jobs worker processes and return the same stats dictionary
+    parsedata() would.
+    """
+    began = time.time()
+    # Some more chunks than workers even out differences in line mix.
+    bounds = chunkbounds(fname, args.jobs * 4, begin, end)
+    jobs = [(fname, cbegin, cend, args, cbegin == bounds[0][0])
+            for cbegin, cend in bounds]
+
+    stats = None
+    pool = multiprocessing.Pool(args.jobs)
+    try:
+        for part in pool.imap(parsechunk, jobs):
+            if stats is None:
+                # Nothing precedes the first chunk, so whatever it could
+                # not attribute is lost for good.
+                stats = part
+                del stats["pending"]
+                del stats["firstpushes"]
+            else:
+                mergestats(stats, part)
+    finally:
+        pool.close()
+        pool.join()
+
+    if stats is None or stats["start"] is None:
+        # No valid timestamp in the first chunk, so the others were parsed
+        # under a wrong assumption. Rare enough to just do it again.
+        return parsedata(readrange(fname, begin, end or
+                                   os.path.getsize(fname)), args)
+
+    finishstats(stats)
+    stats["rtime"] = time.time() - began
+    return stats
+
+
+def mergesnapshots(fnames, args):
+    """
+    Return the stats of the snapshots (see Snapshots) in the files fnames
+    merged, as if they were the logs of mirrors of one site.
+    """
+    began = time.time()
+    stats = None
+    for fname in fnames:
+        snap = Snapshots.load(fname)
+        if stats is None:
+            stats = Snapshots.newstats(snap, args.compact or args.numpy)
+            stats["stages"] = newstages(args)
+        Snapshots.add(stats, snap)
+    finishstats(stats)
+    # Time spent parsing the logs, plus the merge
+    stats["rtime"] += time.time() - began
+    return stats
+
+
+def historystats(args):
+    """
+    Return the stats of the days from args.since to args.until recorded in
+    the history args.history, see History.load().
+    """
+    began = time.time()
+    stats = History.load(args.history, args.since, args.until)
+    stats["stages"] = newstages(args)
+    stats["rtime"] = time.time() - began
+    return stats
+
+
+def stateoptions(args):
+    """
+    Return the options in args the stats depend on, which a saved parser
+    state must have been made with to be picked up again.
+    """
+    return {"approximate": args.approximate and args.capacity,
+            "compact": args.compact, "numpy": args.numpy,
+            "spill": (args.spill, args.spillrss),
+            "sessiontimeout": args.sessiontimeout,
+            "modules": sorted(set(args.modules or [__MODULE__])),
+            "logformat": args.logformat and args.logformat.text,
+            "record": bool(args.record), "timing": args.timing}
+
+
+def loadstate(fname, args):
+    """
+    Return the parser state saved in fname by savestate(), None if there
+    is none or it is unusable, e.g. because it was saved with options that
+    change the stats (see stateoptions()) other than those in args.
+    """
+    try:
+        with open(fname, "rb") as fobj:
+            state = pickle.load(fobj)
+    except (EnvironmentError, EOFError, pickle.UnpicklingError,
+            AttributeError, ImportError):
+        return None
+    if not isinstance(state, dict) or state.get("version") != __version__:
+        return None
+    if state.get("options") != stateoptions(args):
+        return None
+    return state
+
+
+def resumestats(state, args):
+    """Return the stats saved in state, ready to go on parsing."""
+    stats = state["stats"]
+    # Timings are for this run only
+    stats["stages"] = newstages(args)
+    # States saved before there were buckets
+    stats.setdefault("buckets", Buckets.Series())
+    return stats
+
+
+def savestate(fname, cursor, stats, args):
+    """
+    Save the stats and log position of cursor to fname, along with the
+    options in args they were made with.
+    """
+    state = {"version": __version__, "options": stateoptions(args),
+             "cursor": cursor.state(), "stats": stats}
+    tmpname = "%s.tmp" % fname
+    with open(tmpname, "wb") as fobj:
+        pickle.dump(state, fobj, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmpname, fname)
+
+
+def incrementalparse(fname, args):
+    """
+    Parse the log file fname, picking up where the previous run with the
+    same state file (args.state) left off. If the log was rotated or
+    truncated since, it is parsed from the beginning.
+    """
+    began = time.time()
+    state = loadstate(args.state, args)
+    cursor = Logfiles.Cursor(fname, state and state["cursor"])
+    if cursor.resumed:
+        stats = resumestats(state, args)
+    else:
+        stats = newstats(args)
+    try:
+        parselines(stats, cursor.lines())
+    finally:
+        cursor.close()
+    stats["rtime"] += time.time() - began
+    savestate(args.state, cursor, stats, args)
+    finishstats(stats)
+    return stats
+
+
+def writereport(args, stats, output):
+    """
+    Write the report on stats to output, or replace args.reportfile with
+    it if that is set.
+    """
+    report = mkreports(args, stats)
+    if args.reportfile:
+        tmpname = "%s.tmp" % args.reportfile
+        with open(tmpname, "w") as fobj:
+            fobj.write(report + "\n")
+        os.replace(tmpname, args.reportfile)
+    else:
+        output.write(report + "\n\n")
+        output.flush()
+
+
+def writebuckets(args, stats):
+    """Write the buckets args ask for to args.bucketfile (- is stdout)."""
+    buckets = stats["buckets"].get(args.bucket)
+    if args.bucketformat == "json":
+        text = Buckets.asjson(buckets)
+    else:
+        text = Buckets.ascsv(buckets)
+    if args.bucketfile == "-":
+        sys.stdout.write("\n" + text)
+    else:
+        with open(args.bucketfile, "w") as fobj:
+            fobj.write(text)
+
+
+def tail(cursor, stats, rankings=None):
+    """
+    Parse what was added to the log of cursor (a Logfiles.Cursor) into
+    stats, moving on to the new file if the log was rotated. rankings are
+    passed on to parselines().
+    """
+    began = time.time()
+    parselines(stats, cursor.lines(), rankings=rankings)
+    if cursor.rotated():
+        # Whatever made it into the old file before the switch
+        parselines(stats, cursor.lines(), rankings=rankings)
+        cursor.reopen()
+        parselines(stats, cursor.lines(), rankings=rankings)
+    stats["rtime"] += time.time() - began
+
+
+def follow(fname, args, output=sys.stdout, sleep=time.sleep, now=time.time):
+    """
+    Parse the log file fname as it grows, reporting every args.interval
+    seconds or args.everylines lines (whichever comes first) if there was
+    anything new. Rotated and truncated logs are followed to the new file.
+    Runs until interrupted.
+    """
+    state = args.state and loadstate(args.state, args)
+    cursor = Logfiles.Cursor(fname, state and state["cursor"])
+    if cursor.resumed:
+        stats = resumestats(state, args)
+    else:
+        stats = newstats(args)
+    lastreport = now()
+    reported = stats["linecount"]
+    try:
+        while True:
+            tail(cursor, stats)
+            newlines = stats["linecount"] - reported
+            due = now() - lastreport >= args.interval or (
+                args.everylines and newlines >= args.everylines)
+            if newlines and due:
+                finishstats(stats)
+                # mkreport() needs a log that spans some time
+                if stats["span"] != "unknown" and stats["span"] > 0:
+                    writereport(args, stats, output)
+                    if args.state:
+                        savestate(args.state, cursor, stats, args)
+                    lastreport = now()
+                    reported = stats["linecount"]
+            sleep(min(1.0, args.interval))
+    finally:
+        cursor.close()
+
+
+def keytext(stats):
+    """Return a function turning the account keys of stats into text."""
+    if "addresses" not in stats:
+        return str
+    text = stats["addresses"].text
+
+    def addrtext(key):
+        """Return the address text for key, an id or already text"""
+        if isinstance(key, str):
+            return key
+        return text(key)
+    return addrtext
+
+
+def answers(args, stats, rankings):
+    """
+    Return the totals of stats and the entries of rankings (see serve())
+    for Server.publish(), obfuscated as args ask.
+    """
+    entries = {}
+    for key, unit in (("ipb", "bytes"), ("ipc", "sessions")):
+        entries[key] = [
+            {"ip": obfuscate(ipaddr, args.ostyle),
+             "host": obfuscate(stats["ip2hname"].get(ipaddr, ""),
+                               args.ostyle),
+             unit: value}
+            for value, ipaddr in rankings[key].top(Server.RANKED)]
+    return totals(stats), entries
+
+
+def serve(fname, args, server, sleep=time.sleep, now=time.time):
+    """
+    Parse the log file fname as it grows, like follow(), and keep server
+    (see Server.listen()) up to date: the rankings and totals after every
+    poll that found something new, the report every args.interval seconds
+    at most. Runs until interrupted.
+    """
+    state = args.state and loadstate(args.state, args)
+    cursor = Logfiles.Cursor(fname, state and state["cursor"])
+    if cursor.resumed:
+        stats = resumestats(state, args)
+    else:
+        stats = newstats(args)
+    text = keytext(stats)
+    rankings = {"ipc": Server.Ranking(stats["ipc"], text),
+                "ipb": Server.Ranking(stats["ipb"], text)}
+    # Accounts parsed before are all candidates
+    for key, ranking in rankings.items():
+        ranking.touched.update(value for _, value in stats[key].top(
+            Server.RANKED))
+    report = None
+    lastreport = None
+    published = None
+    try:
+        while True:
+            tail(cursor, stats, rankings)
+            if stats["linecount"] != published:
+                finishstats(stats)
+                for ranking in rankings.values():
+                    ranking.update()
+                # mkreport() needs a log that spans some time
+                if (stats["span"] != "unknown" and stats["span"] > 0 and
+                        (lastreport is None or
+                         now() - lastreport >= args.interval)):
+                    report = mkreports(args, stats) + "\n"
+                    if args.state:
+                        savestate(args.state, cursor, stats, args)
+                    lastreport = now()
+                current, entries = answers(args, stats, rankings)
+                Server.publish(server, current, entries, report)
+                published = stats["linecount"]
+            sleep(min(1.0, args.interval))
+    finally:
+        cursor.close()
+
+
 def main():
     """
     Main program.
@@ -299,7 +1879,7 @@ def main():
                          (__version__))
         sys.exit(0)
 
-    if not args.shortoutput:
+    if not args.shortoutput and not args.outputs:
         msgs.append("Carl (Carl Analyzes Rsync Logfiles) %s" % __version__)
         msgs.append("(C) Tobias Klausmann")
 
@@ -310,14 +1890,143 @@ def main():
 
     sys.stdout.flush()
 
-    inputdata = args.filename.read()
-
+    windowed = args.since is not None or args.until is not None
+    spooled = any(Logfiles.isspool(name) for name in args.filenames)
     try:
-        print(mkreport(args, parsedata(inputdata)))
+        with Instrument.dumps(args.cprofile, args.tracemalloc):
+            if (args.spill or args.spillrss) and (
+                    args.compact or args.numpy or args.approximate):
+                sys.stderr.write("--spill and --spill-rss cannot be used "
+                                 "with --compact, --numpy or "
+                                 "--approximate.\n")
+                sys.exit(1)
+            if windowed and (args.follow or args.state or args.serve):
+                sys.stderr.write("--since and --until cannot be used with "
+                                 "--follow, --serve or --state.\n")
+                sys.exit(1)
+            if spooled and (args.follow or args.state or windowed or
+                            args.merge or args.serve):
+                sys.stderr.write("Directories and glob patterns cannot be "
+                                 "used with --follow, --serve, --state, "
+                                 "--since, --until or --merge.\n")
+                sys.exit(1)
+            if args.outputs and (args.follow or args.serve):
+                sys.stderr.write("--output cannot be used with --follow or "
+                                 "--serve.\n")
+                sys.exit(1)
+            if args.record and (args.follow or args.serve or args.state or
+                                args.merge or args.history):
+                sys.stderr.write("--record cannot be used with --follow, "
+                                 "--serve, --state, --merge or "
+                                 "--history.\n")
+                sys.exit(1)
+            if args.history:
+                if args.filenames != ["-"] or args.follow or args.serve or \
+                        args.state or args.merge:
+                    sys.stderr.write("--history takes no log files and no "
+                                     "--follow, --serve, --state or "
+                                     "--merge.\n")
+                    sys.exit(1)
+                stats = historystats(args)
+                if stats["span"] == "unknown":
+                    sys.stderr.write("No recorded days in the given time "
+                                     "window.\n")
+                    sys.exit(1)
+            elif args.merge:
+                if args.filenames == ["-"] or args.follow or args.state or \
+                        windowed or args.serve:
+                    sys.stderr.write("--merge needs snapshot files and no "
+                                     "--follow, --serve, --state, --since "
+                                     "or --until.\n")
+                    sys.exit(1)
+                try:
+                    stats = mergesnapshots(args.filenames, args)
+                except ValueError as err:
+                    sys.stderr.write("Could not merge snapshots: %s\n" % err)
+                    sys.exit(1)
+            elif args.serve:
+                if len(args.filenames) != 1 or args.filenames[0] == "-":
+                    sys.stderr.write("--serve needs a single log file.\n")
+                    sys.exit(1)
+                server = Server.listen(args.serve)
+                try:
+                    serve(args.filenames[0], args, server)
+                except KeyboardInterrupt:
+                    # The usual way to stop serving
+                    sys.exit(0)
+                finally:
+                    server.shutdown()
+                    server.server_close()
+            elif args.follow:
+                if len(args.filenames) != 1 or args.filenames[0] == "-":
+                    sys.stderr.write("--follow needs a single log file.\n")
+                    sys.exit(1)
+                try:
+                    follow(args.filenames[0], args)
+                except KeyboardInterrupt:
+                    # The usual way to stop following
+                    sys.exit(0)
+            elif args.state:
+                if not splittable(args.filenames):
+                    sys.stderr.write("--state needs a single uncompressed "
+                                     "log file.\n")
+                    sys.exit(1)
+                stats = incrementalparse(args.filenames[0], args)
+            elif spooled:
+                fnames = Logfiles.expand(args.filenames)
+                if not fnames:
+                    sys.stderr.write("No log files found.\n")
+                    sys.exit(1)
+                stats = spoolparse(fnames, args)
+            elif windowed and splittable(args.filenames):
+                fname = args.filenames[0]
+                begin, end = Logfiles.window(fname, args.since, args.until)
+                if args.jobs > 1:
+                    stats = parallelparse(fname, args, begin, end)
+                else:
+                    progress = None
+                    if args.profile:
+                        progress = Instrument.Progress(end - begin)
+                    stats = parsedata(Logfiles.maprange(fname, begin, end),
+                                      args, progress)
+            elif args.jobs > 1 and splittable(args.filenames):
+                stats = parallelparse(args.filenames[0], args)
+            else:
+                progress = None
+                if args.profile:
+                    progress = Instrument.Progress(
+                        Logfiles.inputsize(args.filenames))
+                lines = Logfiles.readlogs(args.filenames)
+                if windowed:
+                    lines = Logfiles.clip(lines, args.since, args.until)
+                stats = parsedata(lines, args, progress)
+            if windowed and stats["span"] == "unknown":
+                sys.stderr.write("No log lines in the given time window.\n")
+                sys.exit(1)
+            if args.merge and stats["span"] == "unknown":
+                sys.stderr.write("No log lines in the snapshots.\n")
+                sys.exit(1)
+            with Instrument.stage(stats["stages"], "report"):
+                rendered = renderoutputs(args, stats)
+        writeoutputs(rendered)
+        if args.dump:
+            Snapshots.dump(stats, args.dump)
+        if args.record:
+            History.record(args.record, stats, keytext(stats))
+        if args.bucket:
+            writebuckets(args, stats)
+        if args.profile:
+            sys.stderr.write(Instrument.report(stats) + "\n")
+        if args.statsjson:
+            with open(args.statsjson, "w") as fobj:
+                fobj.write(Instrument.asjson(stats, args.filenames) + "\n")
 
     except KeyboardInterrupt:
         sys.stderr.write("Interrupted. Probably your fault.\n")
         sys.exit(1)
+    except EnvironmentError as err:
+        sys.stderr.write("Could not read log: %s\n" % err)
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
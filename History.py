@@ -0,0 +1,341 @@
+"""
+Historical stats module
+
+A history is an SQLite database that the runs of Carl add their stats to
+(see record()): bytes and sessions per day and client, the clients of each
+hour, host names, and the totals of each day. Reports on any range of days
+can then be made from it (see load()) instead of from the logs, however
+long ago they were rotated away. Days are those of the log's timestamps,
+like with Buckets.
+"""
+
+import array
+import calendar
+import sqlite3
+import time
+
+import Accounts
+import Buckets
+import Snapshots
+
+__revision__ = "3"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS days (
+    day TEXT PRIMARY KEY,
+    traffic INTEGER NOT NULL,
+    sessions INTEGER NOT NULL,
+    ips INTEGER NOT NULL,
+    first INTEGER NOT NULL,
+    last INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS hours (
+    day TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    traffic INTEGER NOT NULL,
+    sessions INTEGER NOT NULL,
+    ips INTEGER NOT NULL,
+    PRIMARY KEY (day, start)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS clients (
+    day TEXT NOT NULL,
+    ip TEXT NOT NULL,
+    bytes INTEGER,
+    sessions INTEGER,
+    PRIMARY KEY (day, ip)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS clients_ip ON clients (ip, day);
+CREATE TABLE IF NOT EXISTS hourclients (
+    start INTEGER NOT NULL,
+    ip TEXT NOT NULL,
+    PRIMARY KEY (start, ip)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS hosts (
+    ip TEXT PRIMARY KEY,
+    name TEXT NOT NULL) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS runs (
+    recorded INTEGER NOT NULL,
+    firstday TEXT NOT NULL,
+    lastday TEXT NOT NULL,
+    lines INTEGER NOT NULL,
+    orphaned INTEGER NOT NULL,
+    evicted INTEGER NOT NULL,
+    open INTEGER NOT NULL);
+"""
+
+
+def dayname(day):
+    """Return the day number day (wall clock seconds // DAY) as text"""
+    return Buckets.stamp(day * Buckets.DAY)[:10]
+
+
+class Days:
+
+    """
+    Sessions and bytes per day and client, the clients of each hour, and
+    when each day's first and last of them were, in wall clock seconds (see
+    Carl.logclock()). Keys are whatever the parser counts clients by.
+    """
+
+    def __init__(self):
+        """Setup book keeping"""
+        # By day number, dicts by key
+        self.sessions = {}
+        self.bytes = {}
+        self.first = {}
+        self.last = {}
+        # By hour number, sets of keys
+        self.hours = {}
+
+    def __setstate__(self, state):
+        """Unpickle, also what was pickled before there were hours"""
+        state.setdefault("hours", {})
+        self.__dict__.update(state)
+
+    def _day(self, when):
+        """Return the day number of when, noting when was seen"""
+        day = int(when // Buckets.DAY)
+        if day not in self.first or when < self.first[day]:
+            self.first[day] = when
+        if day not in self.last or when > self.last[day]:
+            self.last[day] = when
+        return day
+
+    def connect(self, when, key):
+        """Count a session of key starting at when"""
+        counts = self.sessions.setdefault(self._day(when), {})
+        counts[key] = counts.get(key, 0) + 1
+
+    def transfer(self, when, key, nbytes):
+        """
+        Count nbytes transferred to key at when; like the accounts, the
+        unique addresses of days and hours are those with transfers.
+        """
+        counts = self.bytes.setdefault(self._day(when), {})
+        counts[key] = counts.get(key, 0) + nbytes
+        self.hours.setdefault(int(when // Buckets.HOUR), set()).add(key)
+
+    def merge(self, other, translate=None):
+        """
+        Add the counts of other; translate turns its keys into ours if
+        they differ (e.g. address ids of another table).
+        """
+        for mine, theirs in ((self.sessions, other.sessions),
+                             (self.bytes, other.bytes)):
+            for day, counts in theirs.items():
+                ours = mine.setdefault(day, {})
+                for key, num in counts.items():
+                    if translate is not None:
+                        key = translate(key)
+                    ours[key] = ours.get(key, 0) + num
+        for hour, keys in other.hours.items():
+            if translate is not None:
+                keys = map(translate, keys)
+            self.hours.setdefault(hour, set()).update(keys)
+        for day, when in other.first.items():
+            self.first[day] = min(self.first.get(day, when), when)
+        for day, when in other.last.items():
+            self.last[day] = max(self.last.get(day, when), when)
+
+
+def connect(fname):
+    """Return a connection to the history fname, creating it if needed"""
+    database = sqlite3.connect(fname)
+    database.executescript(_SCHEMA)
+    return database
+
+
+def record(fname, stats, text=str):
+    """
+    Add the stats of a run (with stats["days"], see Days) to the history
+    fname. text turns the keys of the accounts into addresses. A log
+    recorded twice counts twice, except for unique addresses, which are
+    counted from the clients of each day and hour recorded.
+    """
+    days = stats["days"]
+    if not days.first:
+        return
+    # The log may start and end with lines of other kinds
+    first = dict(days.first)
+    last = dict(days.last)
+    if stats["start"] is not None:
+        when = calendar.timegm(time.localtime(stats["start"]))
+        day = when // Buckets.DAY
+        first[day] = min(first.get(day, when), when)
+    if stats["laststamp"]:
+        when = calendar.timegm(time.strptime(stats["laststamp"],
+                                             "%Y/%m/%d %H:%M:%S"))
+        day = when // Buckets.DAY
+        last[day] = max(last.get(day, when), when)
+    database = connect(fname)
+    try:
+        with database:
+            totals = dict((start // Buckets.DAY, row) for start, *row
+                          in stats["buckets"].days.rows())
+            database.executemany(
+                "INSERT INTO days VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (day) DO UPDATE SET "
+                "traffic = traffic + excluded.traffic, "
+                "sessions = sessions + excluded.sessions, "
+                "first = min(first, excluded.first), "
+                "last = max(last, excluded.last)",
+                ((dayname(day),) + tuple(totals.get(day, (0, 0, 0))) +
+                 (int(first[day]), int(last.get(day, first[day])))
+                 for day in sorted(days.first)))
+            database.executemany(
+                "INSERT INTO hours VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (day, start) DO UPDATE SET "
+                "traffic = traffic + excluded.traffic, "
+                "sessions = sessions + excluded.sessions",
+                ((dayname(row[0] // Buckets.DAY),) + row
+                 for row in stats["buckets"].hours.rows()
+                 if row[0] // Buckets.DAY in days.first))
+            hours = [hour for hour in sorted(days.hours)
+                     if hour * Buckets.HOUR // Buckets.DAY in days.first]
+            for hour in hours:
+                database.executemany(
+                    "INSERT OR IGNORE INTO hourclients VALUES (?, ?)",
+                    ((hour * Buckets.HOUR, text(key))
+                     for key in days.hours[hour]))
+            for day in sorted(days.first):
+                sessions = days.sessions.get(day, {})
+                nbytes = days.bytes.get(day, {})
+                # bytes and sessions stay NULL if there were none, so
+                # clients are counted like the accounts of a parse do
+                database.executemany(
+                    "INSERT INTO clients VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (day, ip) DO UPDATE SET "
+                    "bytes = coalesce(bytes + excluded.bytes, bytes, "
+                    "excluded.bytes), "
+                    "sessions = coalesce(sessions + excluded.sessions, "
+                    "sessions, excluded.sessions)",
+                    ((dayname(day), text(key), nbytes.get(key),
+                      sessions.get(key))
+                     for key in set(sessions) | set(nbytes)))
+            # A client seen by several runs (e.g. before and after a
+            # rotation) is still one address
+            database.executemany(
+                "UPDATE hours SET ips = (SELECT count(*) FROM hourclients "
+                "WHERE start = ?) WHERE start = ?",
+                ((hour * Buckets.HOUR,) * 2 for hour in hours))
+            database.executemany(
+                "UPDATE days SET ips = (SELECT count(*) FROM clients "
+                "WHERE day = ? AND bytes IS NOT NULL) WHERE day = ?",
+                ((dayname(day),) * 2 for day in sorted(days.first)))
+            database.executemany(
+                "INSERT INTO hosts VALUES (?, ?) "
+                "ON CONFLICT (ip) DO UPDATE SET name = excluded.name",
+                stats["ip2hname"].items())
+            counts = stats["sessions"]
+            database.execute(
+                "INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (int(time.time()), dayname(min(days.first)),
+                 dayname(max(days.last)),
+                 stats["linecount"], counts.orphaned, counts.evicted,
+                 counts.opencount()))
+    finally:
+        database.close()
+
+
+class StoredNames:
+
+    """Host names by address in a history, looked up when asked for"""
+
+    def __init__(self, database):
+        """Setup book keeping"""
+        self.database = database
+
+    def get(self, key, default=None):
+        """Return the host name for key, default if there is none"""
+        row = self.database.execute("SELECT name FROM hosts WHERE ip = ?",
+                                    (key,)).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    def items(self):
+        """Yield (address, host name) pairs"""
+        return iter(self.database.execute("SELECT ip, name FROM hosts"))
+
+
+def window(since=None, until=None, first="day", last="day"):
+    """
+    Return the SQL condition and its parameters for rows with days from
+    first to last (columns) to be in the window given by the log timestamp
+    prefixes since and until (see Carl.stampbound()). Days are whole: one
+    is in if any part of it is.
+    """
+    conditions = ["1"]
+    params = []
+    if since is not None:
+        conditions.append("%s >= ?" % last)
+        params.append(since[:10].decode("ascii"))
+    if until is not None:
+        conditions.append("%s %s ?" % (first, "<" if len(until) == 10
+                                       else "<="))
+        params.append(until[:10].decode("ascii"))
+    return " AND ".join(conditions), params
+
+
+def _fill(buckets, rows):
+    """
+    Set the empty buckets (a Buckets.Buckets) to rows, (start, bytes,
+    sessions, ips) in order of start (wall clock seconds).
+    """
+    if not rows:
+        return
+    width = buckets.width
+    buckets.first = rows[0][0] // width
+    for name in ("bytes", "sessions", "ips"):
+        setattr(buckets, name, array.array("q", [0]) * (
+            rows[-1][0] // width + 1 - buckets.first))
+    for start, nbytes, sessions, ips in rows:
+        index = start // width - buckets.first
+        buckets.bytes[index] = nbytes
+        buckets.sessions[index] = sessions
+        buckets.ips[index] = ips
+
+
+def load(fname, since=None, until=None):
+    """
+    Return stats, like those of a parse, for the days of the history fname
+    from since to until (see window()). The accounts are exact; the
+    session counters are those of the runs that have days in the window.
+    stats["span"] is "unknown" if there are no such days.
+    """
+    database = connect(fname)
+    where, params = window(since, until)
+    stats = {"ipc": Accounts.Accounts(), "ipb": Accounts.Accounts(),
+             "ip2hname": StoredNames(database),
+             "sessions": Snapshots.SessionCounts(),
+             "buckets": Buckets.Series(), "totaltraffic": 0,
+             "linecount": 0, "start": None, "laststamp": None,
+             "span": "unknown", "module": None,
+             "counts": {"connect": 0, "sent": 0, "error": 0,
+                        "malformed": 0}}
+    rows = database.execute(
+        "SELECT first, last, traffic, sessions, ips FROM days WHERE %s "
+        "ORDER BY day" % where, params).fetchall()
+    if not rows:
+        return stats
+    _fill(stats["buckets"].days, [(row[0],) + row[2:] for row in rows])
+    _fill(stats["buckets"].hours, database.execute(
+        "SELECT start, traffic, sessions, ips FROM hours WHERE %s "
+        "ORDER BY start" % where, params).fetchall())
+    for _, _, traffic, sessions, _ in rows:
+        stats["totaltraffic"] += traffic
+        stats["sessions"].seencount += sessions
+    stats["start"] = rows[0][0]
+    stats["laststamp"] = Buckets.stamp(rows[-1][1])
+    stats["span"] = (rows[-1][1] - rows[0][0]) / Buckets.DAY
+    for name, column in (("ipb", "bytes"), ("ipc", "sessions")):
+        incr = stats[name].incr
+        for key, num in database.execute(
+                "SELECT ip, sum(%s) FROM clients WHERE %s AND %s IS NOT NULL "
+                "GROUP BY ip" % (column, where, column), params):
+            incr(key, num)
+    where, params = window(since, until, "firstday", "lastday")
+    for lines, orphaned, evicted, still in database.execute(
+            "SELECT lines, orphaned, evicted, open FROM runs WHERE %s" %
+            where, params):
+        stats["linecount"] += lines
+        stats["sessions"].orphaned += orphaned
+        stats["sessions"].evicted += evicted
+        stats["sessions"].open += still
+    return stats
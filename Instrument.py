@@ -0,0 +1,262 @@
+"""
+Run time instrumentation module
+
+Keeps wall clock and CPU time for the stages of a run (reading, line
+classification, Accounts, Sessions and Buckets book keeping, span
+computation and the report) and shows progress while a log is being
+parsed. This is what --profile and --stats-json report. Lines are timed in
+batches, book keeping calls one by one, so an instrumented run is somewhat
+slower.
+"""
+
+import contextlib
+import cProfile
+import itertools
+import json
+import sys
+import time
+import tracemalloc
+
+__revision__ = "1"
+
+# Stages in the order they are reported
+STAGES = ["read", "classify", "accounts", "sessions", "buckets", "span",
+          "report"]
+# Kinds of lines counted by parselines(); "skipped" is all the others
+LINEKINDS = ["connect", "sent", "error", "skipped", "malformed"]
+# Lines read per timed batch
+BATCHSIZE = 1024
+# Seconds between progress messages
+PROGRESS = 10.0
+# Allocation sites listed in a tracemalloc dump
+TRACEMALLOC_TOP = 30
+
+
+class Stages:
+
+    """
+    Wall clock and CPU time spent per stage
+
+    Only plain values are kept, so instances can be pickled along with the
+    stats they belong to.
+    """
+
+    def __init__(self):
+        """Setup book keeping"""
+        self.wall = {}
+        self.cpu = {}
+        self.calls = {}
+
+    def add(self, name, wall, cpu, calls=1):
+        """Account wall and cpu seconds (and calls) to stage name"""
+        self.wall[name] = self.wall.get(name, 0.0) + wall
+        self.cpu[name] = self.cpu.get(name, 0.0) + cpu
+        self.calls[name] = self.calls.get(name, 0) + calls
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager that accounts the time spent in it to name"""
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - wall,
+                     time.process_time() - cpu)
+
+    def wrap(self, name, func):
+        """Return func wrapped so every call is accounted to name"""
+        perf_counter = time.perf_counter
+        process_time = time.process_time
+        add = self.add
+
+        def timed(*args):
+            """Call the wrapped function and time it"""
+            wall = perf_counter()
+            cpu = process_time()
+            try:
+                return func(*args)
+            finally:
+                add(name, perf_counter() - wall, process_time() - cpu)
+
+        return timed
+
+    def lines(self, name, lines, progress=None):
+        """
+        Yield the lines of the iterator lines, accounting the time it takes
+        to get them to name (one call per batch). progress (a Progress) is
+        updated as it goes.
+        """
+        while True:
+            wall = time.perf_counter()
+            cpu = time.process_time()
+            batch = list(itertools.islice(lines, BATCHSIZE))
+            self.add(name, time.perf_counter() - wall,
+                     time.process_time() - cpu, len(batch) and 1)
+            if not batch:
+                return
+            if progress is not None:
+                progress.update(batch)
+            for line in batch:
+                yield line
+
+    def snapshot(self):
+        """Return the current time and time accounted so far, see rest()"""
+        return (time.perf_counter(), time.process_time(),
+                sum(self.wall.values()), sum(self.cpu.values()))
+
+    def rest(self, name, snapshot):
+        """
+        Account the time since snapshot (see snapshot()) that has not been
+        accounted to any other stage to name.
+        """
+        wall, cpu, accounted, accountedcpu = snapshot
+        wall = time.perf_counter() - wall - (sum(self.wall.values()) -
+                                             accounted)
+        cpu = time.process_time() - cpu - (sum(self.cpu.values()) -
+                                           accountedcpu)
+        self.add(name, max(wall, 0.0), max(cpu, 0.0))
+
+    def merge(self, other):
+        """Add the times of other, e.g. from another process"""
+        for name in other.wall:
+            self.add(name, other.wall[name], other.cpu[name],
+                     other.calls[name])
+
+    def names(self):
+        """Return the stage names seen, in reporting order"""
+        return ([name for name in STAGES if name in self.wall] +
+                sorted(name for name in self.wall if name not in STAGES))
+
+    def asdict(self):
+        """Return the stages as a dict of dicts"""
+        return dict((name, {"wall": self.wall[name], "cpu": self.cpu[name],
+                            "calls": self.calls[name]})
+                    for name in self.names())
+
+
+@contextlib.contextmanager
+def stage(stages, name):
+    """Like Stages.stage(), but does nothing if stages is None"""
+    if stages is None:
+        yield
+    else:
+        with stages.stage(name):
+            yield
+
+
+def linecounts(stats):
+    """Return the number of lines of each kind (see LINEKINDS) in stats"""
+    counts = dict(stats["counts"])
+    counts["skipped"] = stats["linecount"] - sum(counts.values())
+    return counts
+
+
+class Progress:
+
+    """
+    Progress messages while reading lines
+
+    total is the size of the input in bytes, if known; then the messages
+    include how far along the run is and an estimate of the time left.
+    """
+
+    def __init__(self, total=None, interval=PROGRESS, output=sys.stderr,
+                 now=time.time):
+        """Setup book keeping; the clock starts now"""
+        self.total = total
+        self.interval = interval
+        self.output = output
+        self.now = now
+        self.began = now()
+        self.due = self.began + interval
+        self.lines = 0
+        self.bytes = 0
+
+    def update(self, batch):
+        """Note that the lines in batch were read, report if it is time"""
+        self.lines += len(batch)
+        self.bytes += sum(map(len, batch))
+        now = self.now()
+        if now >= self.due:
+            self.due = now + self.interval
+            self.output.write(self.message(now) + "\n")
+            self.output.flush()
+
+    def message(self, now):
+        """Return the progress message for the time now"""
+        elapsed = max(now - self.began, 1e-9)
+        msg = "Progress: %i lines, %.0f lines/s" % (self.lines,
+                                                    self.lines / elapsed)
+        if self.total and self.bytes:
+            left = max(self.total - self.bytes, 0) * elapsed / self.bytes
+            msg += ", %.1f%%, ETA %s" % (
+                min(100.0, 100.0 * self.bytes / self.total),
+                time.strftime("%H:%M:%S", time.gmtime(left)))
+        return msg
+
+
+def report(stats):
+    """Return a text table of the stages and line counts in stats"""
+    stages = stats["stages"]
+    output = ["Stage        Wall (s)    CPU (s)      Calls",
+              "---------------------------------------------"]
+    for name in stages.names():
+        output.append("%-10s %10.3f %10.3f %10i" %
+                      (name, stages.wall[name], stages.cpu[name],
+                       stages.calls[name]))
+    counts = linecounts(stats)
+    output.append("")
+    output.append("Lines: %i (%s)" % (stats["linecount"], ", ".join(
+        "%s %i" % (kind, counts[kind]) for kind in LINEKINDS)))
+    if stats["rtime"] > 0:
+        output.append("Parsed %.0f lines/s" %
+                      (stats["linecount"] / stats["rtime"]))
+    return "\n".join(output)
+
+
+def asjson(stats, filenames):
+    """Return the stages and line counts in stats as JSON"""
+    rate = None
+    if stats["rtime"] > 0:
+        rate = stats["linecount"] / stats["rtime"]
+    return json.dumps({"files": filenames,
+                       "lines": stats["linecount"],
+                       "kinds": linecounts(stats),
+                       "traffic": stats["totaltraffic"],
+                       "seconds": stats["rtime"],
+                       "lines_per_sec": rate,
+                       "stages": stats["stages"].asdict()},
+                      indent=2, sort_keys=True)
+
+
+@contextlib.contextmanager
+def dumps(cprofile=None, allocations=None):
+    """
+    Context manager that profiles the code in it with cProfile, writing
+    the statistics to the file cprofile (for pstats), and/or traces memory
+    allocations, writing the biggest allocation sites to the file
+    allocations. Does nothing for files that are None.
+    """
+    profiler = None
+    if cprofile:
+        profiler = cProfile.Profile()
+    if allocations:
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(cprofile)
+        if allocations:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(allocations, "w") as fobj:
+                fobj.write("Traced memory: %i bytes, peak %i bytes\n" %
+                           (current, peak))
+                for entry in snapshot.statistics("lineno")[:TRACEMALLOC_TOP]:
+                    fobj.write("%s\n" % entry)
@@ -0,0 +1,127 @@
+"""
+Log format module
+
+With "transfer logging" on, rsyncd writes a line per file, shaped by its
+"log format" setting (e.g. "%o %h [%a] %m (%u) %f %l"). Carl only counts
+the lines rsyncd writes for each session, which look the same whatever the
+setting. But file, user and module names in the per-file lines come from
+clients, so such a line can look like one of those. A LogFormat is compiled
+once from the setting; it recognizes the per-file lines so they can be
+skipped.
+"""
+
+import re
+
+__revision__ = "1"
+
+# rsyncd's own default
+DEFAULT = "%o %h [%a] %m (%u) %f %l"
+
+_NUMBER = rb"[0-9][0-9,.]*[KMGTP]?"
+# What each escape expands to, by letter
+ESCAPES = {
+    "a": rb"[0-9A-Fa-f:.]+",  # remote IP address
+    "b": _NUMBER,  # bytes transferred
+    "B": rb"[-rwxsStT]+",  # permission bits
+    "c": _NUMBER,  # checksum bytes
+    "C": rb"[0-9a-f]* *",  # full-file checksum
+    "f": rb".*?",  # file name
+    "G": rb"\S+",  # gid
+    "h": rb"\S+",  # remote host name
+    "i": rb"\S+",  # itemized changes
+    "l": _NUMBER,  # file length
+    "L": rb"(?: -> .*?)?",  # " -> target" of links
+    "m": rb"\S+",  # module name
+    "M": rb"\S+",  # modification time
+    "n": rb".*?",  # file name, "/" after directories
+    "o": rb"send|recv|del\.",  # operation
+    "p": rb"[0-9]+",  # pid
+    "P": rb".*?",  # module path
+    "t": rb"[0-9]{4}/[0-9]{2}/[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2}",  # time
+    "u": rb"\S*",  # authenticated user name
+    "U": rb"\S+",  # uid
+}
+# An escape: flags and width (in any order) and letter
+_ESCAPE = re.compile(r"%([-'0-9]*)(.?)", re.DOTALL)
+# Messages of the lines Carl counts, as they might be written
+SAMPLES = (
+    b"rsync on gentoo-portage/ from host.example.org (192.0.2.1)",
+    b"rsync on gentoo-portage/ from UNKNOWN (2001:db8::1)",
+    b"sent 1,234 bytes  received 56 bytes  total size 789",
+)
+
+
+def tokens(text):
+    """
+    Yield the parts of the format text: literal text as str, escapes as
+    (letter, padded) tuples. Raises ValueError for unknown escapes.
+    """
+    pos = 0
+    for escape in _ESCAPE.finditer(text):
+        if escape.start() > pos:
+            yield text[pos:escape.start()]
+        pos = escape.end()
+        flags, letter = escape.groups()
+        if letter == "%" and not flags:
+            yield "%"
+        elif letter in ESCAPES:
+            yield (letter, any(char.isdigit() for char in flags))
+        else:
+            raise ValueError("unknown escape in log format: %s" %
+                             escape.group())
+    if pos < len(text):
+        yield text[pos:]
+
+
+class LogFormat:
+
+    """
+    The per-file lines of an rsyncd "log format" setting
+
+    regex matches their messages (what follows "[pid] "), with a named
+    group for the first of each escape, and nothing else Carl can tell.
+    """
+
+    def __init__(self, text=DEFAULT):
+        """Compile text; raises ValueError if it is no valid log format"""
+        self.text = text
+        self.fields = []
+        pattern = []
+        for token in tokens(text):
+            if isinstance(token, str):
+                pattern.append(re.escape(token.encode("utf-8")))
+                continue
+            letter, padded = token
+            group = rb"(?:%s)" % ESCAPES[letter]
+            if letter not in self.fields:
+                self.fields.append(letter)
+                group = rb"(?P<%s>%s)" % (letter.encode("ascii"),
+                                          ESCAPES[letter])
+            if padded:
+                group = rb" *%s *" % group
+            pattern.append(group)
+        if not self.fields:
+            raise ValueError("log format without escapes: %s" % text)
+        pattern.append(rb"\s*\Z")
+        self.regex = re.compile(b"".join(pattern), re.DOTALL)
+
+    def __repr__(self):
+        """Return the format as given"""
+        return "LogFormat(%r)" % self.text
+
+    def match(self, msg):
+        """
+        Return the fields (bytes by escape letter) of the message msg
+        (bytes) if it is one of a per-file line, None otherwise.
+        """
+        found = self.regex.match(msg)
+        if found is None:
+            return None
+        return found.groupdict()
+
+    def ambiguous(self):
+        """
+        Return if the lines Carl counts could be per-file lines, so the
+        two cannot be told apart.
+        """
+        return any(self.regex.match(sample) for sample in SAMPLES)
@@ -0,0 +1,483 @@
+"""
+Log file input module
+
+Opens plain and compressed (gzip, bzip2, xz) logs. Plain files are
+memory-mapped, compressed ones are read in a background thread, so
+decompression overlaps with parsing. Lines are handed out as bytes.
+Time windows of plain logs are found by binary search, everything else
+is filtered line by line. Directories and glob patterns stand for many
+logs of their own (e.g. of different mirrors), which are read at the same
+time by a pool of threads.
+"""
+
+import bz2
+import glob
+import gzip
+import io
+import itertools
+import locale
+import lzma
+import mmap
+import os
+import queue
+import stat
+import sys
+import threading
+
+__revision__ = "3"
+
+# Compression formats by their leading magic bytes
+MAGIC = [
+    (b"\x1f\x8b", "gzip", gzip.open),
+    (b"BZh", "bzip2", bz2.open),
+    (b"\xfd7zXZ\x00", "xz", lzma.open),
+]
+
+# Encoding of log files, the same that open() uses by default
+ENCODING = locale.getpreferredencoding(False)
+
+# Length of the timestamps ("2004/02/23 23:11:27") that lines start with
+STAMPLEN = 19
+
+# Bytes read per batch and number of batches read ahead
+BATCHSIZE = 1 << 20
+READAHEAD = 8
+# Threads reading logs of a spool and batches they may have waiting
+READERS = 4
+INFLIGHT = 16
+# Characters that make a file name a glob pattern
+_GLOBCHARS = "*?["
+
+
+def compression(fobj):
+    """
+    Return the name of the compression used for the buffered binary file
+    object fobj (None if it is uncompressed) without consuming any data.
+    """
+    head = fobj.peek(6)[:6]
+    for magic, name, _ in MAGIC:
+        if head.startswith(magic):
+            return name
+    return None
+
+
+def decompressed(fobj):
+    """
+    Return a binary file object reading the decompressed contents of the
+    buffered binary file object fobj, which is returned if uncompressed.
+    """
+    head = fobj.peek(6)[:6]
+    for magic, _, opener in MAGIC:
+        if head.startswith(magic):
+            return opener(fobj, "rb")
+    return fobj
+
+
+def openlog(fname):
+    """
+    Open the log fname ("-" being stdin) for reading in binary mode,
+    decompressing it if needed.
+    """
+    if fname == "-":
+        return decompressed(sys.stdin.buffer)
+    fobj = open(fname, "rb")
+    head = fobj.peek(6)[:6]
+    for magic, _, opener in MAGIC:
+        if head.startswith(magic):
+            # Opened by name, the decompressor closes the file with itself
+            fobj.close()
+            return opener(fname, "rb")
+    return fobj
+
+
+class ReadAhead(threading.Thread):
+
+    """
+    Read batches of lines from a sequence of binary file objects in the
+    background. Iterating over an instance yields the lines of all files
+    in order. The files are left open.
+    """
+
+    def __init__(self, fobjs, batchsize=BATCHSIZE, readahead=READAHEAD):
+        """Set up the reader; call start() to get going"""
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.fobjs = fobjs
+        self.batchsize = batchsize
+        self.batches = queue.Queue(readahead)
+
+    def run(self):
+        """Thread body: fill the batch queue"""
+        try:
+            for fobj in self.fobjs:
+                while True:
+                    batch = fobj.readlines(self.batchsize)
+                    if not batch:
+                        break
+                    self.batches.put(batch)
+        except Exception as exc:  # pylint: disable=broad-except
+            self.batches.put(exc)
+        self.batches.put(None)
+
+    def __iter__(self):
+        """Yield lines (as bytes) until all files are exhausted"""
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            for line in batch:
+                yield line
+
+
+def maplines(fobj):
+    """
+    Yield the lines (as bytes) of the plain binary file object fobj, read
+    from a memory map of it without a read-ahead thread. Every line is
+    still copied into a bytes object of its own, so this is no faster than
+    reading the file. fobj is left open.
+    """
+    if not os.fstat(fobj.fileno()).st_size:
+        return
+    mapped = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if hasattr(mapped, "madvise"):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        for line in iter(mapped.readline, b""):
+            yield line
+    finally:
+        mapped.close()
+
+
+def mappable(fobj):
+    """Return True if fobj is a plain file that can be memory-mapped"""
+    try:
+        return (stat.S_ISREG(os.fstat(fobj.fileno()).st_mode) and
+                compression(fobj) is None)
+    except (AttributeError, io.UnsupportedOperation):
+        return False
+
+
+class Cursor:
+
+    """
+    Read position in a plain log file that keeps growing
+
+    Only complete lines are read, so a line that is still being written is
+    picked up in full next time. A cursor can be saved (see state()) and
+    handed to a new instance to resume; that only happens if the file
+    still looks like the one the cursor was on, otherwise reading starts
+    over from the beginning.
+    """
+
+    # Bytes at the start of the file used to recognize it
+    HEADSIZE = 256
+
+    def __init__(self, fname, state=None):
+        """Open fname, resuming at state if it still applies"""
+        self.fname = fname
+        self.fobj = open(fname, "rb")
+        fstat = os.fstat(self.fobj.fileno())
+        self.ident = (fstat.st_dev, fstat.st_ino)
+        self.head = self.fobj.read(self.HEADSIZE)
+        self.offset = 0
+        self.resumed = False
+        if (state and state["ident"] == self.ident and
+                state["offset"] <= fstat.st_size and
+                self.head.startswith(state["head"])):
+            self.offset = state["offset"]
+            self.resumed = True
+
+    def lines(self):
+        """Yield the complete lines (as bytes) added since the last call"""
+        self.fobj.seek(self.offset)
+        if len(self.head) < self.HEADSIZE:
+            self.head = self.fobj.read(self.HEADSIZE)
+            self.fobj.seek(self.offset)
+        for line in self.fobj:
+            if not line.endswith(b"\n"):
+                break
+            self.offset += len(line)
+            yield line
+
+    def rotated(self):
+        """
+        Return True if fname has been replaced by another file or
+        truncated since it was opened.
+        """
+        try:
+            fstat = os.stat(self.fname)
+        except OSError:
+            # Moved away, but the new one is not there yet
+            return False
+        if (fstat.st_dev, fstat.st_ino) != self.ident:
+            return True
+        return fstat.st_size < self.offset
+
+    def reopen(self):
+        """Start over at the beginning of whatever file fname is now"""
+        self.close()
+        self.__init__(self.fname)
+
+    def state(self):
+        """Return the position as a dict of plain values"""
+        return {"ident": self.ident, "offset": self.offset,
+                "head": self.head[:self.offset]}
+
+    def close(self):
+        """Close the file"""
+        self.fobj.close()
+
+
+def inputsize(fnames):
+    """
+    Return the total size in bytes of the logs in fnames, None if that
+    does not tell how much there is to read (compressed files, stdin).
+    """
+    total = 0
+    for fname in fnames:
+        if fname == "-":
+            return None
+        try:
+            with open(fname, "rb") as fobj:
+                if not mappable(fobj):
+                    return None
+                total += os.fstat(fobj.fileno()).st_size
+        except EnvironmentError:
+            return None
+    return total
+
+
+def readlogs(fnames):
+    """
+    Return an iterator over the lines (as bytes) of all logs in fnames,
+    read as one log. Plain files are memory-mapped, everything else is
+    read and decompressed in a background thread, one file at a time, so
+    memory use does not grow with the number of files. All files are
+    opened right away, so errors show up early; each is closed (stdin
+    excepted) once it has been read.
+    """
+    fobjs = []
+    for fname in fnames:
+        if fname == "-":
+            fobj = sys.stdin.buffer
+        else:
+            fobj = open(fname, "rb")
+        fobjs.append(fobj)
+    return itertools.chain.from_iterable(readlog(fobj) for fobj in fobjs)
+
+
+def readlog(fobj):
+    """
+    Yield the lines (as bytes) of the binary file object fobj, see
+    readlogs(), and close it unless it is stdin.
+    """
+    try:
+        if mappable(fobj):
+            for line in maplines(fobj):
+                yield line
+        else:
+            unpacked = decompressed(fobj)
+            reader = ReadAhead([unpacked])
+            reader.start()
+            for line in reader:
+                yield line
+            if unpacked is not fobj:
+                # Closing a decompressor leaves the file it reads open
+                unpacked.close()
+    finally:
+        if fobj is not sys.stdin.buffer:
+            fobj.close()
+
+
+def stamp(line):
+    """Return the timestamp line starts with, None if there is none"""
+    head = line[:STAMPLEN]
+    if (len(head) == STAMPLEN and head[4:5] == b"/" and
+            head[7:8] == b"/" and head[13:14] == b":" and
+            head[16:17] == b":" and head[:4].isdigit()):
+        return head
+    return None
+
+
+def seekstamp(data, bound, begin=0, end=None):
+    """
+    Return the offset of the first line in data[begin:end] (begin being
+    the start of a line) with a timestamp not before bound, end if there
+    is none. data is a bytes-like log in order, e.g. an mmap; bound is a
+    timestamp or a prefix of one ("2004/02/23 23"). Uses binary search, so
+    only a few dozen lines are looked at.
+    """
+    if end is None:
+        end = len(data)
+
+    def nextstamp(pos):
+        """Return (offset, timestamp) of the first stamped line from pos"""
+        if pos > begin:
+            pos = data.find(b"\n", pos - 1, end) + 1 or end
+        while pos < end:
+            eol = data.find(b"\n", pos, end) + 1 or end
+            found = stamp(data[pos:min(eol, pos + STAMPLEN)])
+            if found is not None:
+                return pos, found
+            pos = eol
+        return end, None
+
+    low, high = begin, end
+    while low < high:
+        mid = (low + high) // 2
+        pos, found = nextstamp(mid)
+        if found is None or found >= bound:
+            high = mid
+        else:
+            low = pos + 1
+    return nextstamp(low)[0]
+
+
+def window(fname, since=None, until=None):
+    """
+    Return the byte range (begin, end) of the plain log fname that holds
+    the lines from timestamp since up to, but not including, until (see
+    seekstamp()). Either may be None for no limit.
+    """
+    with open(fname, "rb") as fobj:
+        size = os.fstat(fobj.fileno()).st_size
+        if not size:
+            return 0, 0
+        data = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            begin = 0
+            if since is not None:
+                begin = seekstamp(data, since)
+            end = size
+            if until is not None:
+                end = seekstamp(data, until, begin)
+        finally:
+            data.close()
+    return begin, end
+
+
+def maprange(fname, begin, end):
+    """Yield the lines (as bytes) of fname between the offsets begin, end"""
+    if begin >= end:
+        return
+    with open(fname, "rb") as fobj:
+        mapped = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if hasattr(mapped, "madvise"):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            mapped.seek(begin)
+            readline = mapped.readline
+            while mapped.tell() < end:
+                yield readline()
+        finally:
+            mapped.close()
+
+
+def clip(lines, since=None, until=None):
+    """
+    Yield the lines of the log lines from timestamp since up to, but not
+    including, until, like window() does, but reading all of it.
+    """
+    started = since is None
+    for line in lines:
+        found = stamp(line)
+        if found is not None:
+            if until is not None and found >= until:
+                return
+            if not started and found >= since:
+                started = True
+        if started:
+            yield line
+
+
+def isspool(name):
+    """
+    Return True if the file name name is a directory or a glob pattern,
+    i.e. stands for a number of logs of their own.
+    """
+    return os.path.isdir(name) or any(char in name for char in _GLOBCHARS)
+
+
+def expand(names):
+    """
+    Return the logs the file names in names stand for: the files in
+    directories, the files matching glob patterns (both sorted) and all
+    other names as they are.
+    """
+    fnames = []
+    for name in names:
+        if os.path.isdir(name):
+            fnames.extend(sorted(
+                path for path in (os.path.join(name, entry)
+                                  for entry in os.listdir(name))
+                if os.path.isfile(path)))
+        elif isspool(name):
+            fnames.extend(sorted(path for path in glob.glob(name)
+                                 if os.path.isfile(path)))
+        else:
+            fnames.append(name)
+    return fnames
+
+
+class Spool:
+
+    """
+    Read many logs at the same time, in a pool of threads
+
+    Iterating over an instance yields (index, batch) pairs, index being
+    that of the log in fnames and batch a list of its lines (as bytes),
+    and (index, None) after the last batch of a log. The batches of a log
+    come in order, those of different logs mixed. At most inflight batches
+    are waiting to be picked up at any time.
+    """
+
+    def __init__(self, fnames, readers=READERS, inflight=INFLIGHT,
+                 batchsize=BATCHSIZE):
+        """Set up the readers; call start() to get going"""
+        self.fnames = fnames
+        self.batchsize = batchsize
+        self.batches = queue.Queue(max(1, inflight))
+        self.todo = queue.Queue()
+        for index in range(len(fnames)):
+            self.todo.put(index)
+        self.threads = [threading.Thread(target=self.read)
+                        for _ in range(max(1, min(readers, len(fnames))))]
+        for thread in self.threads:
+            thread.daemon = True
+
+    def start(self):
+        """Start reading"""
+        for thread in self.threads:
+            thread.start()
+
+    def read(self):
+        """Thread body: read logs until there are none left"""
+        while True:
+            try:
+                index = self.todo.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                with openlog(self.fnames[index]) as fobj:
+                    while True:
+                        batch = fobj.readlines(self.batchsize)
+                        if not batch:
+                            break
+                        self.batches.put((index, batch))
+            except Exception as exc:  # pylint: disable=broad-except
+                self.batches.put((index, exc))
+                return
+            self.batches.put((index, None))
+
+    def __iter__(self):
+        """Yield (index, batch) pairs until all logs are read"""
+        left = len(self.fnames)
+        while left:
+            index, batch = self.batches.get()
+            if isinstance(batch, Exception):
+                raise batch
+            if batch is None:
+                left -= 1
+            yield index, batch
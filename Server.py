@@ -0,0 +1,208 @@
+"""
+Stats server module
+
+While Carl follows a log (see Carl.serve()), it keeps the answers to the
+usual questions up to date: the busiest clients by bytes and by sessions,
+the totals and the report. They are served as JSON (or, the report, as
+text) over HTTP, on localhost or on a UNIX socket. A query only picks up
+what was prepared, it never looks at the stats themselves.
+"""
+
+import heapq
+import http.server
+import json
+import os
+import socketserver
+import stat
+import threading
+import urllib.parse
+
+import Accounts
+
+__revision__ = "1"
+
+# Clients kept in each ranking, the most /top can return
+RANKED = 100
+# Clients /top returns by default
+TOPDEFAULT = 10
+# Rankings by the by= parameter of /top
+RANKINGS = {"bytes": "ipb", "sessions": "ipc"}
+
+
+def address(text):
+    """
+    Return the address to serve on given as text: a UNIX socket path (if
+    it contains a slash) or a port, optionally preceded by "HOST:", for
+    HTTP on localhost (or HOST). Raises ValueError for anything else.
+    """
+    if "/" in text:
+        return text
+    host, _, port = text.rpartition(":")
+    port = int(port)
+    if not 0 <= port < 65536:
+        raise ValueError("port out of range: %i" % port)
+    return (host or "127.0.0.1", port)
+
+
+class Ranking:
+
+    """
+    The (value, key) of the size largest accounts, kept up to date
+
+    Only the accounts touched since the last update() are looked at, on
+    top of those ranked: as values only grow, no other account can have
+    overtaken the ranked ones. Approximate accounts may lose keys, so for
+    those the ranking is taken from the accounts each time.
+    """
+
+    def __init__(self, accounts, text=str, size=RANKED):
+        """
+        Setup book keeping. text turns the keys given to incr() into the
+        keys to rank them by, e.g. address ids into addresses.
+        """
+        self.accounts = accounts
+        self.text = text
+        self.size = size
+        self.touched = set()
+        # (value, text, key), largest first
+        self.ranked = []
+
+    def wrap(self, incr):
+        """Return a replacement for incr (of the accounts) that notes keys"""
+        touched = self.touched
+
+        def wrapped(k, num=1):
+            """Note k and increment it"""
+            touched.add(k)
+            incr(k, num)
+        return wrapped
+
+    def update(self):
+        """Take in the accounts touched since the last update()"""
+        if isinstance(self.accounts, Accounts.ApproxAccounts):
+            self.touched.clear()
+            self.ranked = [(value, key, key) for value, key
+                           in self.accounts.top(self.size)]
+            return
+        # Keys may come as ids or as text, so go by text
+        keys = dict((name, key) for _, name, key in self.ranked)
+        text = self.text
+        for key in self.touched:
+            keys.setdefault(text(key), key)
+        self.touched.clear()
+        val = self.accounts.val
+        self.ranked = heapq.nlargest(self.size, (
+            (val(key), name, key) for name, key in keys.items()))
+
+    def top(self, num):
+        """Return the num largest (value, key) tuples, largest first"""
+        return [(value, name) for value, name, _ in self.ranked[:num]]
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+
+    """
+    Answers GET /totals, /top?by=bytes|sessions&n=N and /report from the
+    answers the server was last given (see publish()).
+    """
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Answer a query"""
+        url = urllib.parse.urlsplit(self.path)
+        answers = self.server.answers
+        if answers is None:
+            self.reply(503, "Nothing parsed yet.\n")
+        elif url.path == "/totals":
+            self.reply(200, answers["totals"], "application/json")
+        elif url.path == "/top":
+            query = urllib.parse.parse_qs(url.query)
+            ranking = RANKINGS.get(query.get("by", ["bytes"])[-1])
+            try:
+                num = int(query.get("n", [TOPDEFAULT])[-1])
+            except ValueError:
+                num = -1
+            if ranking is None or not 0 <= num <= RANKED:
+                self.reply(400, "Use by=bytes or by=sessions and n=0 to "
+                           "n=%i.\n" % RANKED)
+            else:
+                self.reply(200, json.dumps(answers[ranking][:num]) + "\n",
+                           "application/json")
+        elif url.path == "/report":
+            if answers["report"] is None:
+                self.reply(503, "No report yet.\n")
+            else:
+                self.reply(200, answers["report"])
+        else:
+            self.reply(404, "Try /totals, /top or /report.\n")
+
+    def reply(self, status, text, ctype="text/plain"):
+        """Send text as the whole response"""
+        body = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "%s; charset=utf-8" % ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """Keep quiet, queries come in every minute"""
+
+
+class TCPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+
+    """HTTP server on a TCP port"""
+
+    daemon_threads = True
+    answers = None
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    """HTTP server on a UNIX socket"""
+
+    daemon_threads = True
+    answers = None
+
+    def server_bind(self):
+        """Replace a socket left behind by an earlier run"""
+        try:
+            if stat.S_ISSOCK(os.stat(self.server_address).st_mode):
+                os.unlink(self.server_address)
+        except FileNotFoundError:
+            pass
+        socketserver.UnixStreamServer.server_bind(self)
+
+    def server_close(self):
+        """Close and remove the socket"""
+        socketserver.UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+def listen(where):
+    """
+    Return a server for where (see address()), answering queries in a
+    thread of its own until it is shut down.
+    """
+    if isinstance(where, str):
+        server = UnixServer(where, Handler)
+    else:
+        server = TCPServer(where, Handler)
+    thread = threading.Thread(target=server.serve_forever, name="server")
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def publish(server, totals, rankings, report):
+    """
+    Give server new answers: the dict totals, the rankings (a dict of lists
+    of JSON-able entries by RANKINGS values) and the report text (None if
+    there is none yet). Queries being answered keep the old ones.
+    """
+    answers = dict(rankings)
+    answers["totals"] = json.dumps(totals, indent=2) + "\n"
+    answers["report"] = report
+    server.answers = answers
@@ -1,22 +1,323 @@
 """Simple session tallying module"""
 
-__revision__ = "2"
+import array
+import collections
+import heapq
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # pylint: disable=invalid-name
+
+__revision__ = "6"
+
+# Percentiles Records reports on
+PERCENTILES = (50, 95, 99)
+# Sessions a client needs to be among the slowest, see Records.top()
+SLOWSESSIONS = 3
+# Stale entries the eviction queue may have beyond twice the open sessions
+_QUEUESLACK = 1024
 
 
 class Sessions:
 
-    """Simple session tallying class"""
+    """
+    Simple session tallying class
 
-    def __init__(self):
+    Open sessions are kept until they are popped. If maxage (in seconds of
+    log time) is set, sessions that have been open for longer than that are
+    evicted, so the table stays bounded even if close lines go missing.
+    """
+
+    def __init__(self, maxage=None):
         """Setup book keeping"""
         self.accounts = {}
+        self.started = {}
         self.seencount = 0
+        self.maxage = maxage
+        self.orphaned = 0
+        self.evicted = 0
+        self.latest = None
+        self._queue = collections.deque()
 
-    def push(self, sid, info):
-        """Push session info into the list"""
+    def push(self, sid, info, when=None):
+        """
+        Push session info into the list
+
+        'when' is the session start in seconds. An open session with the
+        same id (e.g. after pid reuse) is replaced and counted as orphaned.
+        """
         self.seencount += 1
+        if when is None:
+            if sid in self.accounts:
+                self.orphaned += 1
+                self.started.pop(sid, None)
+            self.accounts[sid] = info
+            return
+        if self.latest is None or when > self.latest:
+            self.latest = when
+        queue = self._queue
+        # The queue stays empty if there is no maxage
+        if queue and queue[0][0] < when - self.maxage:
+            self.expire(when)
+        if sid in self.accounts:
+            self.orphaned += 1
         self.accounts[sid] = info
+        self.started[sid] = when
+        if self.maxage is not None:
+            queue.append((when, sid))
+            if len(queue) > 2 * len(self.accounts) + _QUEUESLACK:
+                self._compact()
+
+    def pop(self, sid, when=None):
+        """
+        Return the session for a session id and forget about it
+
+        Returns None for unknown sessions and, if 'when' is given, for
+        sessions that have been open longer than maxage.
+        """
+        info = self.accounts.pop(sid, None)
+        start = self.started.pop(sid, None)
+        if (info is not None and self.maxage is not None and
+                when is not None and start is not None and
+                when - start > self.maxage):
+            self.evicted += 1
+            return None
+        return info
+
+    def expire(self, now):
+        """Evict all sessions that started more than maxage before now"""
+        if self.maxage is None:
+            return
+        cutoff = now - self.maxage
+        queue = self._queue
+        while queue and queue[0][0] < cutoff:
+            when, sid = queue.popleft()
+            # The queue is not updated on pop(), so skip entries for
+            # sessions that have been closed or replaced since.
+            if self.started.get(sid) == when:
+                del self.accounts[sid]
+                del self.started[sid]
+                self.evicted += 1
+
+    def _compact(self):
+        """
+        Rebuild the eviction queue from the open sessions, dropping the
+        entries pop() left behind
+        """
+        self._queue = collections.deque(sorted(
+            (when, sid) for sid, when in self.started.items()))
+
+    def opencount(self):
+        """Return the number of sessions still open"""
+        return len(self.accounts)
+
+    def supersede(self, sid, when):
+        """
+        Drop the open session sid because a new one with the same id
+        started at 'when', counting it as orphaned or evicted just like
+        push() would have.
+        """
+        if sid not in self.accounts:
+            return
+        del self.accounts[sid]
+        start = self.started.pop(sid, None)
+        if (self.maxage is not None and when is not None and
+                start is not None and when - start > self.maxage):
+            self.evicted += 1
+        else:
+            self.orphaned += 1
+
+    def adopt(self, other):
+        """
+        Take over the open sessions and counters of other, which must
+        describe the log following the one seen by this instance.
+        """
+        self.seencount += other.seencount
+        self.orphaned += other.orphaned
+        self.evicted += other.evicted
+        self.accounts.update(other.accounts)
+        for sid in other.accounts:
+            self.started.pop(sid, None)
+        self.started.update(other.started)
+        if other.latest is not None:
+            if self.latest is None or other.latest > self.latest:
+                self.latest = other.latest
+        if self.maxage is not None:
+            self._compact()
+            if self.latest is not None:
+                self.expire(self.latest)
+
+    def gather(self, other, tag):
+        """
+        Take over the counters and open sessions of other, which describes
+        another log (e.g. of another host). Its session ids become
+        (tag, sid), so they never clash with those of this instance.
+        """
+        self.seencount += other.seencount
+        self.orphaned += other.orphaned
+        self.evicted += other.evicted
+        for sid, info in other.accounts.items():
+            self.accounts[(tag, sid)] = info
+        for sid, when in other.started.items():
+            self.started[(tag, sid)] = when
+
+
+class FirstPushes:
+
+    """
+    Remember when each session id was first pushed
+
+    Kept in a dict, so the size (and that of a chunk's pickled stats, see
+    Carl.parsechunk()) follows the number of sessions, not the pids.
+    """
+
+    def __init__(self):
+        """Setup book keeping"""
+        self.times = {}
+
+    def note(self, sid, when):
+        """Record 'when' for sid unless it has been seen before"""
+        self.times.setdefault(sid, when)
+
+    def get(self, sid):
+        """
+        Return (seen, when) for sid; when is None if the push happened at
+        an unknown time.
+        """
+        if sid not in self.times:
+            return (False, None)
+        return (True, self.times[sid])
+
+
+def percentiles(values, points=PERCENTILES):
+    """
+    Return the points (percent) percentiles of the numbers in values (an
+    array or list) by nearest rank, as a list; None if there are none.
+    Sorted with NumPy if it is installed, which takes far less memory.
+    """
+    if not len(values):  # pylint: disable=len-as-condition
+        return None
+    if numpy is not None:
+        ordered = numpy.sort(numpy.asarray(values)).tolist()
+    else:
+        ordered = sorted(values)
+    return [ordered[max(0, int(math.ceil(point * len(ordered) / 100.0)) - 1)]
+            for point in points]
+
+
+class Records:
+
+    """
+    Start, duration, bytes sent and received and client of each session
+
+    Records are kept in typed arrays, 28 bytes a session, with times in
+    whole seconds since the epoch. Clients are numbered in the order they
+    are first seen; keys holds the account key (address or address id)
+    of each number.
+    """
+
+    def __init__(self):
+        """Setup book keeping"""
+        self.start = array.array("I")
+        self.duration = array.array("I")
+        self.sent = array.array("Q")
+        self.received = array.array("Q")
+        self.client = array.array("I")
+        self.keys = []
+        self.ids = {}
+
+    def __len__(self):
+        """Return the number of sessions recorded"""
+        return len(self.start)
+
+    def add(self, start, end, sent, received, key):
+        """
+        Record a session of the client key from start to end (seconds,
+        end before start counts as no time at all).
+        """
+        clientid = self.ids.get(key)
+        if clientid is None:
+            clientid = self.ids[key] = len(self.keys)
+            self.keys.append(key)
+        start = int(start)
+        self.start.append(start)
+        self.duration.append(max(0, int(end) - start))
+        self.sent.append(sent)
+        self.received.append(received)
+        self.client.append(clientid)
+
+    def extend(self, other, translate=None):
+        """
+        Add the records of other; translate turns its keys into ours if
+        they differ (e.g. address ids of another table).
+        """
+        numbers = array.array("I")
+        for key in other.keys:
+            if translate is not None:
+                key = translate(key)
+            clientid = self.ids.get(key)
+            if clientid is None:
+                clientid = self.ids[key] = len(self.keys)
+                self.keys.append(key)
+            numbers.append(clientid)
+        self.start.extend(other.start)
+        self.duration.extend(other.duration)
+        self.sent.extend(other.sent)
+        self.received.extend(other.received)
+        self.client.extend(numbers[clientid] for clientid in other.client)
+
+    def rates(self):
+        """
+        Return the transfer rate of each session in bytes per second, as
+        an array. Sessions of less than a second count as one second, the
+        resolution of the log.
+        """
+        if numpy is not None:
+            nbytes = (numpy.asarray(self.sent, numpy.float64) +
+                      numpy.asarray(self.received, numpy.float64))
+            return array.array("d", (nbytes / numpy.maximum(
+                numpy.asarray(self.duration), 1)).tobytes())
+        return array.array("d", [
+            (sent + received) / (duration or 1) for sent, received, duration
+            in zip(self.sent, self.received, self.duration)])
+
+    def clients(self):
+        """
+        Return the (seconds, sessions, bytes) of all sessions of each
+        client, as a dict by key. Added up with NumPy if it is installed.
+        """
+        if numpy is not None and self.keys:
+            clients = numpy.asarray(self.client)
+            size = len(self.keys)
+            seconds = numpy.zeros(size, numpy.int64)
+            numpy.add.at(seconds, clients, numpy.asarray(self.duration))
+            nbytes = numpy.zeros(size, numpy.uint64)
+            numpy.add.at(nbytes, clients, numpy.asarray(self.sent))
+            numpy.add.at(nbytes, clients, numpy.asarray(self.received))
+            sessions = numpy.bincount(clients, minlength=size)
+            return dict(zip(self.keys, zip(seconds.tolist(),
+                                           sessions.tolist(),
+                                           nbytes.tolist())))
+        totals = [[0, 0, 0] for _ in self.keys]
+        for clientid, duration, sent, received in zip(
+                self.client, self.duration, self.sent, self.received):
+            entry = totals[clientid]
+            entry[0] += duration
+            entry[1] += 1
+            entry[2] += sent + received
+        return dict((key, tuple(entry))
+                    for key, entry in zip(self.keys, totals))
 
-    def pop(self, sid):
-        """Return the session for a session id"""
-        return self.accounts.get(sid)
+    def top(self, num, minsessions=SLOWSESSIONS):
+        """
+        Return the num clients with the lowest transfer rate (the bytes of
+        all their sessions over the seconds of all of them) among those of
+        at least minsessions sessions, as (rate, seconds, sessions, bytes,
+        key) tuples, slowest first.
+        """
+        return heapq.nsmallest(num, (
+            (nbytes / (seconds or 1), seconds, sessions, nbytes, key)
+            for key, (seconds, sessions, nbytes) in self.clients().items()
+            if sessions >= minsessions))
@@ -0,0 +1,223 @@
+"""
+Fixed size summaries of large key streams
+
+HyperLogLog estimates the number of distinct keys, SpaceSaving keeps the
+keys with the largest (weighted) counts. Both take the same memory no
+matter how many keys there are, at the price of some error, which they
+can tell. Keys are hashed with a fixed hash, so summaries made in
+different processes can be merged.
+"""
+
+import hashlib
+import heapq
+import math
+
+__revision__ = "1"
+
+# Bits of the key hashes
+_HASHBITS = 64
+
+
+def hash64(key):
+    """Return a 64 bit hash of the string key, the same in every process"""
+    return int.from_bytes(hashlib.blake2b(
+        key.encode("utf-8", "surrogateescape"), digest_size=8).digest(),
+                          "big")
+
+
+class HyperLogLog:
+
+    """
+    Estimate of the number of distinct keys added
+
+    Uses 2**precision one byte registers; the relative standard error of
+    count() is about 1.04 / sqrt(2**precision), i.e. 0.8% for the default.
+    """
+
+    def __init__(self, precision=14):
+        """Setup book keeping"""
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+        self._estimate = 0
+
+    def add(self, key):
+        """Note that key was seen"""
+        self.addhash(hash64(key))
+
+    def addhash(self, hashed):
+        """Note that a key with the hash64() hashed was seen"""
+        bits = _HASHBITS - self.precision
+        index = hashed >> bits
+        rest = hashed & ((1 << bits) - 1)
+        rank = bits - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            self._estimate = None
+
+    def count(self):
+        """Return the estimated number of distinct keys"""
+        if self._estimate is None:
+            registers = self.registers
+            size = len(registers)
+            alpha = 0.7213 / (1 + 1.079 / size)
+            # Registers by rank, which is at most the bits left over
+            ranks = [registers.count(rank)
+                     for rank in range(_HASHBITS - self.precision + 2)]
+            estimate = alpha * size * size / sum(
+                math.ldexp(num, -rank) for rank, num in enumerate(ranks))
+            zeros = ranks[0]
+            if estimate <= 2.5 * size and zeros:
+                # Few keys: linear counting is better there
+                estimate = size * math.log(size / zeros)
+            self._estimate = int(round(estimate))
+        return self._estimate
+
+    def error(self):
+        """Return the relative standard error of count()"""
+        return 1.04 / math.sqrt(len(self.registers))
+
+    def restore(self, registers):
+        """Start over with the registers (bytes) of another instance"""
+        if len(registers) != len(self.registers):
+            raise ValueError("%i registers for precision %i" %
+                             (len(registers), self.precision))
+        self.registers = bytearray(registers)
+        self._estimate = None
+
+    def merge(self, other):
+        """Add the keys seen by other (of the same precision)"""
+        if other.precision != self.precision:
+            raise ValueError("cannot merge HyperLogLogs of precision %i "
+                             "and %i" % (self.precision, other.precision))
+        self.registers = bytearray(map(max, self.registers,
+                                       other.registers))
+        self._estimate = None
+
+
+class SpaceSaving:
+
+    """
+    The keys with the largest counts, approximately
+
+    At most capacity keys are tracked. A new key replaces the one with
+    the smallest count and takes over that count as a possible error, so
+    counts are never too low and at most error(key) too high. Any key
+    whose true count is more than total / capacity is tracked.
+    """
+
+    def __init__(self, capacity):
+        """Setup book keeping"""
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        # (count, key) of all tracked keys; counts may be out of date
+        self.heap = []
+
+    def add(self, key, num=1):
+        """Add num to the count of key"""
+        counts = self.counts
+        if key in counts:
+            counts[key] += num
+            return
+        if len(counts) < self.capacity:
+            counts[key] = num
+            self.errors[key] = 0
+            heapq.heappush(self.heap, (num, key))
+            return
+        floor, victim = self._smallest()
+        del counts[victim]
+        del self.errors[victim]
+        counts[key] = floor + num
+        self.errors[key] = floor
+        heapq.heapreplace(self.heap, (floor + num, key))
+
+    def _smallest(self):
+        """Return (count, key) of the key with the smallest count"""
+        heap = self.heap
+        counts = self.counts
+        while True:
+            count, key = heap[0]
+            current = counts[key]
+            if current == count:
+                return count, key
+            heapq.heapreplace(heap, (current, key))
+
+    def error(self, key):
+        """Return by how much the count of key may be too high"""
+        return self.errors.get(key, 0)
+
+    def floor(self):
+        """Return the count any key that is not tracked is below"""
+        if len(self.counts) < self.capacity:
+            return 0
+        return self._smallest()[0]
+
+    def merge(self, other):
+        """Add the counts of other and keep the largest"""
+        floor = self.floor()
+        otherfloor = other.floor()
+        counts = {}
+        errors = {}
+        for key in set(self.counts) | set(other.counts):
+            # A key one side does not track may have had up to its floor
+            counts[key] = (self.counts.get(key, floor) +
+                           other.counts.get(key, otherfloor))
+            errors[key] = (self.errors.get(key, floor) +
+                           other.errors.get(key, otherfloor))
+        self.restore(counts, errors)
+
+    def restore(self, counts, errors):
+        """
+        Start over tracking the keys in the dict counts, with the errors in
+        the dict errors, e.g. those of another instance. Only the largest
+        counts are kept if there are more than capacity.
+        """
+        keep = heapq.nlargest(self.capacity, counts, key=counts.get)
+        self.counts = dict((key, counts[key]) for key in keep)
+        self.errors = dict((key, errors.get(key, 0)) for key in keep)
+        self.heap = [(count, key) for key, count in self.counts.items()]
+        heapq.heapify(self.heap)
+
+    def top(self, num):
+        """
+        Return the num (count, key) with the largest counts, largest first
+        """
+        if num <= 0:
+            return []
+        return heapq.nlargest(num, ((count, key) for key, count
+                                    in self.counts.items()))
+
+
+class TrackedDict(dict):
+
+    """
+    A dict that only keeps keys some SpaceSaving summaries track
+
+    As long as it has at most limit entries, it is a plain dict. Once it
+    grows beyond that, the keys that none of the summaries track any
+    more are dropped. While many keys are tracked, the next scan waits
+    until there are twice as many entries as the last scan kept, so
+    scans take constant time per key added.
+    """
+
+    def __init__(self, limit, summaries):
+        """Setup book keeping"""
+        dict.__init__(self)
+        self.limit = limit
+        self.summaries = summaries
+        self.kept = 0
+
+    def __setitem__(self, key, value):
+        """Set key to value, dropping untracked keys if there are too many"""
+        dict.__setitem__(self, key, value)
+        if len(self) > max(self.limit, 2 * self.kept):
+            for old in list(self):
+                if old != key and not any(old in summary.counts
+                                          for summary in self.summaries):
+                    del self[old]
+            self.kept = len(self) - 1
+
+    def __reduce__(self):
+        """Pickle with the limit and summaries"""
+        return (self.__class__, (self.limit, self.summaries), None, None,
+                iter(self.items()))
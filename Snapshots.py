@@ -0,0 +1,250 @@
+"""
+Stats snapshot module
+
+A snapshot holds what a report is made of: the accounts, totals, first
+and last timestamps, host names, session counters and time buckets of a
+parse, but no open sessions or other parser state. Snapshots of the logs
+of several mirrors can be merged into one report. They are a versioned
+header followed by zlib compressed JSON, so reading one never runs code.
+"""
+
+import base64
+import json
+import struct
+import zlib
+
+import Accounts
+import Addresses
+import Buckets
+import Sketches
+
+__revision__ = "1"
+
+MAGIC = b"CARLSNAP"
+VERSION = 1
+# Magic and version
+_HEADER = struct.Struct(">8sH")
+# Module names are bytes in stats, text in snapshots
+_ENCODING = "utf-8"
+
+
+class SessionCounts:
+
+    """The session counters of snapshots, in place of a Sessions"""
+
+    def __init__(self):
+        """Setup book keeping"""
+        self.seencount = 0
+        self.orphaned = 0
+        self.evicted = 0
+        self.open = 0
+
+    def opencount(self):
+        """Return the number of sessions that were still open"""
+        return self.open
+
+
+def _accounts(accounts):
+    """Return accounts (any kind of Accounts) as plain values"""
+    if isinstance(accounts, Accounts.ApproxAccounts):
+        summary = accounts.summary
+        return {"kind": "approximate", "total": accounts.total,
+                "capacity": summary.capacity,
+                "precision": accounts.distinct.precision,
+                "registers": base64.b64encode(
+                    bytes(accounts.distinct.registers)).decode("ascii"),
+                "counts": list(summary.counts.items()),
+                "errors": list(summary.errors.items())}
+    return {"kind": "exact", "items": list(accounts.accounts.items())}
+
+
+def _sessions(sessions):
+    """Return the counters of sessions (a Sessions) as plain values"""
+    return {"seen": sessions.seencount, "orphaned": sessions.orphaned,
+            "evicted": sessions.evicted, "open": sessions.opencount()}
+
+
+def _buckets(buckets):
+    """Return buckets (a Buckets.Buckets) as plain values"""
+    buckets.settle()
+    return {"first": buckets.first, "bytes": list(buckets.bytes),
+            "sessions": list(buckets.sessions), "ips": list(buckets.ips)}
+
+
+def dumps(stats):
+    """Return a snapshot of stats, as bytes"""
+    snap = {"linecount": stats["linecount"],
+            "totaltraffic": stats["totaltraffic"],
+            "rtime": stats["rtime"],
+            "start": stats["start"],
+            "laststamp": stats["laststamp"],
+            "counts": stats["counts"],
+            "ipc": _accounts(stats["ipc"]),
+            "ipb": _accounts(stats["ipb"]),
+            "ip2hname": dict(stats["ip2hname"].items()),
+            "sessions": _sessions(stats["sessions"]),
+            "hours": _buckets(stats["buckets"].hours),
+            "days": _buckets(stats["buckets"].days),
+            "module": stats.get("module")}
+    if stats.get("modules") is not None:
+        snap["modules"] = dict(
+            (name.decode(_ENCODING, "surrogateescape"),
+             {"ipc": _accounts(module["ipc"]),
+              "ipb": _accounts(module["ipb"]),
+              "totaltraffic": module["totaltraffic"],
+              "sessions": _sessions(module["sessions"])})
+            for name, module in stats["modules"].items())
+    return _HEADER.pack(MAGIC, VERSION) + zlib.compress(
+        json.dumps(snap, separators=(",", ":")).encode("ascii"), 9)
+
+
+def loads(data):
+    """
+    Return the snapshot in data (bytes) as plain values; see dumps() and
+    add(). Raises ValueError if it is no snapshot Carl can read.
+    """
+    if len(data) < _HEADER.size:
+        raise ValueError("not a Carl snapshot")
+    magic, version = _HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("not a Carl snapshot")
+    if version != VERSION:
+        raise ValueError("snapshot version %i, expected %i" %
+                         (version, VERSION))
+    try:
+        return json.loads(zlib.decompress(data[_HEADER.size:]).decode(
+            "ascii"))
+    except (zlib.error, UnicodeDecodeError) as err:
+        raise ValueError("broken snapshot: %s" % err)
+
+
+def dump(stats, fname):
+    """Write a snapshot of stats to the file fname"""
+    with open(fname, "wb") as fobj:
+        fobj.write(dumps(stats))
+
+
+def load(fname):
+    """Return the snapshot in the file fname, see loads()"""
+    with open(fname, "rb") as fobj:
+        return loads(fobj.read())
+
+
+def newaccounts(snap, stats):
+    """Return empty accounts of the kind snap (see _accounts()) has"""
+    if snap["kind"] == "approximate":
+        accounts = Accounts.ApproxAccounts(snap["capacity"],
+                                           snap["precision"])
+        if isinstance(stats["ip2hname"], Sketches.TrackedDict):
+            stats["ip2hname"].summaries.append(accounts.summary)
+        return accounts
+    if "addresses" in stats:
+        return Accounts.CompactAccounts(stats["addresses"])
+    return Accounts.Accounts()
+
+
+def newstats(snap, compact=False):
+    """
+    Return empty stats the snapshot snap (see loads()) can be added to,
+    with the accounts of its kind. Exact accounts are kept like --compact
+    does if compact is set.
+    """
+    stats = {}
+    if snap["ipc"]["kind"] == "approximate":
+        stats["ip2hname"] = Sketches.TrackedDict(
+            2 * snap["ipc"]["capacity"], [])
+    elif compact:
+        stats["addresses"] = Addresses.AddressTable()
+        stats["ip2hname"] = Addresses.HostNames(stats["addresses"])
+    else:
+        stats["ip2hname"] = {}
+    stats["ipc"] = newaccounts(snap["ipc"], stats)
+    stats["ipb"] = newaccounts(snap["ipb"], stats)
+    stats["sessions"] = SessionCounts()
+    stats["buckets"] = Buckets.Series()
+    stats["linecount"] = 0
+    stats["totaltraffic"] = 0
+    stats["rtime"] = 0.0
+    stats["start"] = None
+    stats["laststamp"] = None
+    stats["counts"] = {"connect": 0, "sent": 0, "error": 0, "malformed": 0}
+    stats["module"] = snap["module"]
+    if "modules" in snap:
+        stats["modules"] = {}
+    return stats
+
+
+def _addaccounts(accounts, snap):
+    """Add the accounts in snap (see _accounts()) to accounts"""
+    if isinstance(accounts, Accounts.ApproxAccounts):
+        if snap["kind"] != "approximate":
+            raise ValueError("cannot merge exact and approximate snapshots")
+        other = Accounts.ApproxAccounts(snap["capacity"], snap["precision"])
+        other.distinct.restore(base64.b64decode(snap["registers"]))
+        other.summary.restore(dict(snap["counts"]), dict(snap["errors"]))
+        other.total = snap["total"]
+        accounts.merge(other)
+        return
+    if snap["kind"] != "exact":
+        raise ValueError("cannot merge exact and approximate snapshots")
+    incr = accounts.incr
+    for key, value in snap["items"]:
+        incr(key, value)
+
+
+def _addsessions(counts, snap):
+    """Add the session counters in snap to counts (a SessionCounts)"""
+    counts.seencount += snap["seen"]
+    counts.orphaned += snap["orphaned"]
+    counts.evicted += snap["evicted"]
+    counts.open += snap["open"]
+
+
+def _addbuckets(buckets, snap):
+    """Add the buckets in snap to buckets (a Buckets.Buckets)"""
+    other = Buckets.Buckets(buckets.width)
+    other.first = snap["first"]
+    for name in ("bytes", "sessions", "ips"):
+        getattr(other, name).extend(snap[name])
+    buckets.add(other)
+
+
+def add(stats, snap):
+    """
+    Add the snapshot snap (see loads()) to stats (see newstats()), as if
+    it were the log of another mirror.
+    """
+    if snap["module"] != stats["module"] or \
+            ("modules" in snap) != ("modules" in stats):
+        raise ValueError("snapshots are of different modules")
+    for key in ("linecount", "totaltraffic", "rtime"):
+        stats[key] += snap[key]
+    for kind, count in snap["counts"].items():
+        stats["counts"][kind] = stats["counts"].get(kind, 0) + count
+    if snap["start"] is not None and (stats["start"] is None or
+                                      snap["start"] < stats["start"]):
+        stats["start"] = snap["start"]
+    if snap["laststamp"] and (not stats["laststamp"] or
+                              snap["laststamp"] > stats["laststamp"]):
+        stats["laststamp"] = snap["laststamp"]
+    _addaccounts(stats["ipc"], snap["ipc"])
+    _addaccounts(stats["ipb"], snap["ipb"])
+    ip2hname = stats["ip2hname"]
+    for ipaddr, hname in snap["ip2hname"].items():
+        if not ip2hname.get(ipaddr):
+            ip2hname[ipaddr] = hname
+    _addsessions(stats["sessions"], snap["sessions"])
+    _addbuckets(stats["buckets"].hours, snap["hours"])
+    _addbuckets(stats["buckets"].days, snap["days"])
+    for name, modsnap in snap.get("modules", {}).items():
+        name = name.encode(_ENCODING, "surrogateescape")
+        module = stats["modules"].get(name)
+        if module is None:
+            module = stats["modules"][name] = {
+                "ipc": newaccounts(modsnap["ipc"], stats),
+                "ipb": newaccounts(modsnap["ipb"], stats),
+                "sessions": SessionCounts(), "totaltraffic": 0}
+        _addaccounts(module["ipc"], modsnap["ipc"])
+        _addaccounts(module["ipb"], modsnap["ipb"])
+        _addsessions(module["sessions"], modsnap["sessions"])
+        module["totaltraffic"] += modsnap["totaltraffic"]
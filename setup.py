@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 """Setup data for Carl"""
-from distutils.core import setup
+try:
+    from setuptools import setup
+except ImportError:
+    from distutils.core import setup
 
 __version__ = "0.9"
 
@@ -11,7 +14,10 @@ setup(name='carl',
       author='Tobias Klausmann',
       author_email='klausman-carl@schwarzvogel.de',
       url='http://www.schwarzvogel.de/software-misc.shtml',
-      py_modules=['Accounts', 'Sessions'],
+      python_requires='>=3.6',
+      py_modules=['Accounts', 'Addresses', 'Buckets', 'History', 'Instrument',
+                  'Logfiles', 'LogFormats', 'Server', 'Sessions', 'Sketches',
+                  'Snapshots'],
       scripts=['Carl.py'],
       data_files=[
           ("share/doc/carl-%s/" % (__version__), ['COPYING', 'README'])]
@@ -1,7 +1,14 @@
 #!/usr/bin/python -tt
 """Test suite for Accounts.py of Carl"""
+import array
+import gc
+import mock
+import os
+import pickle
+import random
 import unittest
 import Accounts
+import Addresses
 
 # Pylint has a counterproductive idea of proper names in this case. Also,
 # docstrings for tests seem a bit overblown. TODO: find someone who cares
@@ -126,6 +133,245 @@ class AccountsTest(unittest.TestCase):
                          [(4, 'hiskey'), (3, 'theirkey'),
                           (2, 'yourkey'), (1, 'mykey')])
 
+    def testTotal(self):
+        myac = Accounts.Accounts()
+        self.assertEqual(myac.total, 0)
+        for key in self.keynames:
+            myac.incr(key, 3)
+        myac.decr(self.keynames[0])
+        self.assertEqual(myac.total, 3 * len(self.keynames) - 1)
+
+    def testTop(self):
+        myac = Accounts.Accounts()
+        self.assertEqual(myac.top(3), [])
+        incr = 0
+        for key in self.keynames:
+            incr += 1
+            myac.incr(key, incr)
+        self.assertEqual(myac.top(2), [(4, 'hiskey'), (3, 'theirkey')])
+        self.assertEqual(myac.top(10), myac.counts(desc=True))
+        self.assertEqual(myac.top(0), [])
+
+    def testTopFraction(self):
+        myac = Accounts.Accounts()
+        for num in range(100):
+            myac.incr("key%s" % num, num)
+        self.assertEqual(myac.topfraction(0.05), myac.counts(desc=True)[:5])
+        self.assertEqual(myac.topfraction(0.001), [])
+
+
+class CompactAccountsTest(unittest.TestCase):
+
+    """Test CompactAccounts class against Accounts"""
+
+    def setUp(self):
+        rng = random.Random(1)
+        self.keys = (["10.0.%d.%d" % (rng.randrange(4), rng.randrange(256))
+                      for _ in range(300)] +
+                     ["2001:db8::%x" % rng.randrange(1, 50)
+                      for _ in range(100)] + ["not-an-address"])
+        self.values = [rng.randrange(5) for _ in self.keys]
+
+    def fill(self, myac, keys=None):
+        for key, num in zip(keys or self.keys, self.values):
+            myac.incr(key, num)
+        return myac
+
+    def testSameAsAccounts(self):
+        plain = self.fill(Accounts.Accounts())
+        table = Addresses.AddressTable()
+        compact = self.fill(Accounts.CompactAccounts(table),
+                            [table.intern(key) for key in self.keys])
+        self.assertEqual(compact.accounts, plain.accounts)
+        self.assertEqual(compact.seencount, plain.seencount)
+        self.assertEqual(compact.total, plain.total)
+        self.assertEqual(compact.counts(True), plain.counts(True))
+        for num in range(0, len(self.keys), 3):
+            self.assertEqual(compact.top(num), plain.top(num))
+        self.assertEqual(compact.topfraction(0.05), plain.topfraction(0.05))
+        self.assertEqual(compact.val("10.0.0.1"), plain.val("10.0.0.1"))
+        self.assertEqual(compact.val("192.0.2.1"), 0)
+
+    def testMerge(self):
+        plain = self.fill(Accounts.Accounts())
+        plain.merge(self.fill(Accounts.Accounts()))
+        compact = self.fill(Accounts.CompactAccounts(
+            Addresses.AddressTable()))
+        # The other one has ids of its own
+        other = Accounts.CompactAccounts(Addresses.AddressTable())
+        other.incr("192.0.2.1", 0)
+        compact.merge(self.fill(other))
+        self.assertEqual(compact.accounts, dict(plain.accounts,
+                                                **{"192.0.2.1": 0}))
+        self.assertEqual(compact.total, plain.total)
+
+
+class SpillAccountsTest(CompactAccountsTest):
+
+    """Test SpillAccounts class against Accounts"""
+
+    def testSameAsAccounts(self):
+        plain = self.fill(Accounts.Accounts())
+        spill = Accounts.SpillAccounts(50, batch=16)
+        self.fill(spill)
+        self.assertIsNotNone(spill.database)
+        self.assertTrue(spill.cache)
+        self.assertEqual(spill.val("10.0.0.1"), plain.val("10.0.0.1"))
+        self.assertEqual(spill.val("192.0.2.1"), 0)
+        self.assertEqual(spill.accounts, plain.accounts)
+        self.assertEqual(spill.seencount, plain.seencount)
+        self.assertEqual(spill.total, plain.total)
+        self.assertEqual(spill.counts(True), plain.counts(True))
+        self.assertEqual(spill.counts(), plain.counts())
+        for num in range(0, len(self.keys) + 3, 3):
+            self.assertEqual(spill.top(num), plain.top(num))
+        self.assertEqual(spill.topfraction(0.05), plain.topfraction(0.05))
+        self.assertEqual(sorted(spill.getkeys()), sorted(plain.getkeys()))
+
+    def testInMemory(self):
+        plain = self.fill(Accounts.Accounts())
+        spill = self.fill(Accounts.SpillAccounts(len(self.keys)))
+        self.assertIsNone(spill.database)
+        self.assertEqual(spill.accounts, plain.accounts)
+        self.assertEqual(spill.seencount, plain.seencount)
+        self.assertEqual(spill.top(10), plain.top(10))
+
+    def testMerge(self):
+        plain = self.fill(Accounts.Accounts())
+        plain.merge(self.fill(Accounts.Accounts()))
+        spill = self.fill(Accounts.SpillAccounts(10))
+        spill.merge(self.fill(Accounts.SpillAccounts(20, batch=8)))
+        self.assertEqual(spill.accounts, plain.accounts)
+        self.assertEqual(spill.total, plain.total)
+
+    def testRSSLimit(self):
+        with mock.patch.object(Accounts, "_RSSCHECK", 10):
+            spill = Accounts.SpillAccounts(rsslimit=1)
+            for num in range(9):
+                spill.incr("10.0.0.%i" % num)
+            self.assertIsNone(spill.database)
+            spill.incr("10.0.0.9")
+            self.assertIsNotNone(spill.database)
+        self.assertEqual(spill.seencount, 10)
+
+    def testDropped(self):
+        spill = self.fill(Accounts.SpillAccounts(10))
+        path = spill.path
+        self.assertTrue(os.path.exists(path))
+        del spill
+        gc.collect()
+        self.assertFalse(os.path.exists(path))
+
+    def testPickle(self):
+        spill = self.fill(Accounts.SpillAccounts(10, batch=8))
+        copy = pickle.loads(pickle.dumps(spill))
+        self.assertIsNotNone(copy.database)
+        self.assertNotEqual(copy.path, spill.path)
+        self.assertEqual(copy.accounts, spill.accounts)
+        self.assertEqual(copy.total, spill.total)
+
+
+@unittest.skipIf(Accounts.numpy is None, "NumPy is not installed")
+class VectorAccountsTest(CompactAccountsTest):
+
+    """Test VectorAccounts class against Accounts"""
+
+    def testSameAsAccounts(self):
+        plain = self.fill(Accounts.Accounts())
+        table = Addresses.AddressTable()
+        # Small batches, so some are added up while others are pending
+        vector = self.fill(Accounts.VectorAccounts(table, 64),
+                           [table.intern(key) for key in self.keys])
+        self.assertEqual(vector.pending, len(self.keys) % 64)
+        self.assertEqual(vector.accounts, plain.accounts)
+        self.assertEqual(vector.seencount, plain.seencount)
+        self.assertEqual(vector.total, plain.total)
+        self.assertEqual(vector.counts(True), plain.counts(True))
+        for num in range(0, len(self.keys) + 3, 3):
+            self.assertEqual(vector.top(num), plain.top(num))
+        self.assertEqual(vector.topfraction(0.05), plain.topfraction(0.05))
+        self.assertEqual(vector.val("10.0.0.1"), plain.val("10.0.0.1"))
+        self.assertEqual(vector.val("192.0.2.1"), 0)
+
+    def testMerge(self):
+        plain = self.fill(Accounts.Accounts())
+        plain.merge(self.fill(Accounts.Accounts()))
+        vector = self.fill(Accounts.VectorAccounts(Addresses.AddressTable()))
+        vector.merge(self.fill(Accounts.VectorAccounts(
+            Addresses.AddressTable(), 16)))
+        self.assertEqual(vector.accounts, plain.accounts)
+        self.assertEqual(vector.total, plain.total)
+
+    def testAddBatch(self):
+        plain = self.fill(Accounts.Accounts())
+        for key in self.keys:
+            plain.incr(key)
+        table = Addresses.AddressTable()
+        addrids = array.array("q", [table.intern(key) for key in self.keys])
+        vector = Accounts.VectorAccounts(table, 64)
+        vector.incr(self.keys[0], self.values[0])
+        vector.addbatch(addrids[1:], array.array("q", self.values[1:]))
+        vector.addbatch(addrids)
+        vector.addbatch(array.array("q"))
+        self.assertEqual(list(addrids), [table.intern(key)
+                                         for key in self.keys])
+        self.assertEqual(vector.accounts, plain.accounts)
+        self.assertEqual(vector.seencount, plain.seencount)
+        self.assertEqual(vector.total, plain.total)
+
+    def testLargeValues(self):
+        vector = Accounts.VectorAccounts(Addresses.AddressTable(), 4)
+        for _ in range(6):
+            vector.incr("10.0.0.1", (1 << 53) + 1)
+        vector.decr("10.0.0.2", 3)
+        self.assertEqual(vector.val("10.0.0.1"), 6 * ((1 << 53) + 1))
+        self.assertEqual(vector.top(2), [(6 * ((1 << 53) + 1), "10.0.0.1"),
+                                         (-3, "10.0.0.2")])
+
+    def testPickle(self):
+        vector = self.fill(Accounts.VectorAccounts(Addresses.AddressTable(),
+                                                   64))
+        copy = pickle.loads(pickle.dumps(vector))
+        self.assertEqual(copy.pending, 0)
+        self.assertEqual(copy.accounts, vector.accounts)
+        copy.incr("10.0.0.1", 5)
+        self.assertEqual(copy.val("10.0.0.1"), vector.val("10.0.0.1") + 5)
+
+
+class ApproxAccountsTest(CompactAccountsTest):
+
+    """Test ApproxAccounts class against Accounts"""
+
+    def testSameAsAccounts(self):
+        plain = self.fill(Accounts.Accounts())
+        # Room for every key, so only seencount is an estimate
+        approx = self.fill(Accounts.ApproxAccounts(len(self.keys)))
+        self.assertEqual(approx.accounts, plain.accounts)
+        self.assertLessEqual(abs(approx.seencount - plain.seencount), 2)
+        self.assertEqual(approx.total, plain.total)
+        self.assertEqual(approx.counts(True), plain.counts(True))
+        for num in range(0, len(self.keys), 3):
+            self.assertEqual(approx.top(num), plain.top(num))
+        self.assertEqual(approx.val("10.0.0.1"), plain.val("10.0.0.1"))
+        self.assertEqual(approx.error("10.0.0.1"), 0)
+
+    def testMerge(self):
+        plain = self.fill(Accounts.Accounts())
+        plain.merge(self.fill(Accounts.Accounts()))
+        approx = self.fill(Accounts.ApproxAccounts(len(self.keys)))
+        approx.merge(self.fill(Accounts.ApproxAccounts(len(self.keys))))
+        self.assertEqual(approx.accounts, plain.accounts)
+        self.assertEqual(approx.total, plain.total)
+
+    def testBounded(self):
+        plain = self.fill(Accounts.Accounts())
+        approx = self.fill(Accounts.ApproxAccounts(20))
+        self.assertEqual(len(approx.getkeys()), 20)
+        self.assertEqual(len(approx.topfraction(1.0)), 20)
+        for value, key in approx.top(5):
+            self.assertGreaterEqual(value, plain.val(key))
+            self.assertLessEqual(value - approx.error(key), plain.val(key))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/python -tt
+"""Test suite for Addresses.py of Carl"""
+import pickle
+import random
+import unittest
+import Addresses
+
+# Pylint has a counterproductive idea of proper names in this case. Also,
+# docstrings for tests seem a bit overblown. TODO: find someone who cares
+# enough to write them.
+# pylint: disable=invalid-name,missing-docstring,too-many-public-methods,
+
+
+class AddressTableTest(unittest.TestCase):
+
+    """Test AddressTable class"""
+
+    def setUp(self):
+        self.addresses = ["192.0.2.1", "0.0.0.1", "::1", "2001:db8::1",
+                          "ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff",
+                          "::ffff:192.0.2.1", "UNKNOWN", ""]
+
+    def testRoundTrip(self):
+        table = Addresses.AddressTable()
+        ids = [table.intern(text) for text in self.addresses]
+        self.assertEqual(ids, list(range(len(self.addresses))))
+        self.assertEqual(len(table), len(self.addresses))
+        for addrid, text in zip(ids, self.addresses):
+            self.assertEqual(table.text(addrid), text)
+            self.assertEqual(table.intern(text), addrid)
+            self.assertEqual(table.find(text), addrid)
+            self.assertEqual(table.internkey(table.key(addrid)), addrid)
+        self.assertEqual(table.find("192.0.2.2"), None)
+
+    def testReindex(self):
+        table = Addresses.AddressTable()
+        rng = random.Random(1)
+        ids = {}
+        # Enough to have several batches merged into the index
+        for _ in range(5 * Addresses._REINDEX):
+            if rng.random() < 0.5:
+                text = "10.0.%d.%d" % (rng.randrange(64), rng.randrange(256))
+            else:
+                text = "2001:db8:%x::%x" % (rng.randrange(1, 4),
+                                            rng.randrange(1, 4096))
+            addrid = table.intern(text)
+            self.assertEqual(ids.setdefault(text, addrid), addrid)
+        self.assertEqual(sorted(ids.values()), list(range(len(ids))))
+        self.assertTrue(len(table.recent) < len(ids))
+        for text, addrid in ids.items():
+            self.assertEqual(table.find(text), addrid)
+            self.assertEqual(table.text(addrid), text)
+        self.assertEqual(list(table.index4), sorted(table.index4))
+        self.assertEqual(list(zip(table.high6, table.low6)),
+                         sorted(zip(table.high6, table.low6)))
+
+    def testCanonical(self):
+        table = Addresses.AddressTable()
+        addrid = table.intern("2001:DB8:0::1")
+        self.assertEqual(table.intern("2001:db8::1"), addrid)
+        self.assertEqual(table.text(addrid), "2001:db8::1")
+
+    def testPickle(self):
+        table = Addresses.AddressTable()
+        for text in self.addresses:
+            table.intern(text)
+        table = pickle.loads(pickle.dumps(table))
+        self.assertEqual([table.text(addrid) for addrid in range(len(table))],
+                         self.addresses)
+
+
+class HostNamesTest(unittest.TestCase):
+
+    """Test HostNames class"""
+
+    def testHostNames(self):
+        table = Addresses.AddressTable()
+        names = Addresses.HostNames(table)
+        self.assertEqual(names.get("192.0.2.1"), None)
+        names[table.intern("192.0.2.1")] = "one.example.com"
+        names["2001:db8::2"] = "two.example.com"
+        self.assertEqual(names.get("192.0.2.1"), "one.example.com")
+        self.assertEqual(names[table.find("2001:db8::2")], "two.example.com")
+        self.assertEqual(names.get(table.intern("192.0.2.3"), ""), "")
+        self.assertRaises(KeyError, lambda: names["192.0.2.3"])
+        self.assertEqual(len(names), 2)
+        self.assertEqual(names, {"192.0.2.1": "one.example.com",
+                                 "2001:db8::2": "two.example.com"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/python -tt
+"""Test suite for Bench.py from Carl"""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import Bench
+import Carl
+
+# Pylint has a counterproductive idea of proper names in this case. Also,
+# docstrings for tests seem a bit overblown. TODO: find someone who cares
+# enough to write them.
+# pylint: disable=invalid-name,missing-docstring,too-many-public-methods
+
+
+class BenchTest(unittest.TestCase):
+
+    """Test Bench functions"""
+
+    def testDeterministic(self):
+        first = list(Bench.synthlog(2000, seed=1))
+        self.assertEqual(first, list(Bench.synthlog(2000, seed=1)))
+        self.assertNotEqual(first, list(Bench.synthlog(2000, seed=2)))
+
+    def testExactLength(self):
+        for lines in (0, 1, 7, 1234):
+            self.assertEqual(len(list(Bench.synthlog(lines))), lines)
+
+    def testParams(self):
+        lines = list(Bench.synthlog(5000, ips=10, errors=1.0, commas=1.0,
+                                    span=60))
+        self.assertTrue(lines[0].startswith(b"2012/12/01 00:00:00 "))
+        self.assertTrue(lines[-1].startswith(b"2012/12/01 00:00:59 "))
+        self.assertTrue(any(b"rsync error:" in line for line in lines))
+        self.assertFalse(any(b"] sent " in line for line in lines))
+
+        stats = Carl.parsedata(Bench.synthlog(5000, ips=10, commas=1.0))
+        self.assertTrue(0 < stats["ipc"].seencount <= 10)
+        self.assertTrue(stats["totaltraffic"] > 0)
+
+    def testInterleaved(self):
+        pids = set()
+        for line in Bench.synthlog(200, interleave=5):
+            pids.add(line.split()[2])
+            if len(pids) == 5:
+                break
+        self.assertEqual(len(pids), 5)
+
+    def testParsesize(self):
+        self.assertEqual(Bench.parsesize("10k"), 10000)
+        self.assertEqual(Bench.parsesize("1.5M"), 1500000)
+        self.assertEqual(Bench.parsesize("42"), 42)
+
+    def testRunbench(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            record = Bench.runbench((3000, {"seed": 3}, 1, tmpdir))
+            self.assertEqual(os.listdir(tmpdir), [])
+        finally:
+            shutil.rmtree(tmpdir)
+        # Must survive a round trip through the results file
+        record = json.loads(json.dumps(record))
+        self.assertEqual(record["lines"], 3000)
+        self.assertEqual(record["params"]["seed"], 3)
+        for stage in ("parsedata", "mkreport", "accounts", "sessions_ops"):
+            self.assertTrue(record[stage]["wall"] >= 0)
+        self.assertTrue(record["parsedata"]["lines_per_sec"] > 0)
+        self.assertEqual(record["accounts"]["ops"], record["sessions"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+#!/usr/bin/python -tt
+"""Test suite for Buckets.py of Carl"""
+import json
+import unittest
+import Buckets
+
+# Pylint has a counterproductive idea of proper names in this case. Also,
+# docstrings for tests seem a bit overblown. TODO: find someone who cares
+# enough to write them.
+# pylint: disable=invalid-name,missing-docstring,too-many-public-methods,
+
+# 2012/12/01 00:00:00 as wall clock seconds
+MIDNIGHT = 1354320000
+
+
+class BucketsTest(unittest.TestCase):
+
+    """Test Buckets class"""
+
+    def setUp(self):
+        # (seconds after MIDNIGHT, address, bytes)
+        self.events = [(10, "a", 5), (20, "b", 7), (3000, "a", 1),
+                       (3700, "a", 2), (3800, "c", 0), (7300, "b", 9),
+                       (7300, "b", 1), (90000, "a", 4)]
+
+    def fill(self, buckets, events=None):
+        if events is None:
+            events = self.events
+        for offset, ipaddr, nbytes in events:
+            buckets.connect(MIDNIGHT + offset)
+            buckets.transfer(MIDNIGHT + offset, nbytes, ipaddr)
+        return buckets
+
+    def testHours(self):
+        rows = list(self.fill(Buckets.Buckets(Buckets.HOUR)).rows())
+        self.assertEqual(len(rows), 26)
+        self.assertEqual(rows[0], (MIDNIGHT, 13, 3, 2))
+        self.assertEqual(rows[1], (MIDNIGHT + 3600, 2, 2, 2))
+        self.assertEqual(rows[2], (MIDNIGHT + 7200, 10, 2, 1))
+        self.assertEqual(rows[3], (MIDNIGHT + 10800, 0, 0, 0))
+        self.assertEqual(rows[25], (MIDNIGHT + 90000, 4, 1, 1))
+
+    def testDays(self):
+        buckets = self.fill(Buckets.Buckets(Buckets.DAY))
+        self.assertEqual(list(buckets.rows()),
+                         [(MIDNIGHT, 25, 7, 3), (MIDNIGHT + 86400, 4, 1, 1)])
+        self.assertEqual(buckets.peak(), (MIDNIGHT, 25, 7, 3))
+        self.assertEqual(Buckets.Buckets(Buckets.DAY).peak(), None)
+
+    def testMerge(self):
+        for width in (Buckets.HOUR, Buckets.DAY):
+            whole = list(self.fill(Buckets.Buckets(width)).rows())
+            for precision in (None, 14):
+                for cut in range(len(self.events) + 1):
+                    merged = self.fill(Buckets.Buckets(width, precision),
+                                       self.events[:cut])
+                    tail = self.fill(Buckets.Buckets(width, precision,
+                                                     tail=True),
+                                     self.events[cut:])
+                    merged.merge(tail)
+                    self.assertEqual(list(merged.rows()), whole)
+                    self.assertIsNone(merged.head)
+                    self.assertIsNone(tail.head)
+
+    def testAddress(self):
+        # Sessions count where they start, addresses where they transfer
+        buckets = Buckets.Buckets(Buckets.HOUR, tail=True)
+        buckets.connect(MIDNIGHT + 3500)
+        buckets.transfer(MIDNIGHT + 3700, 5, "a")
+        buckets.transfer(MIDNIGHT + 3800, 5)
+        self.assertEqual(list(buckets.rows()),
+                         [(MIDNIGHT, 0, 1, 0), (MIDNIGHT + 3600, 10, 0, 1)])
+        # Addresses found out later count where they are still kept
+        buckets.transfer(MIDNIGHT + 7300, 1, "b")
+        for when, ipaddr in ((10, "c"), (3900, "c"), (7400, "c"),
+                             (7500, "b")):
+            buckets.address(MIDNIGHT + when, ipaddr)
+        self.assertEqual(list(buckets.ips), [1, 1, 2])
+        self.assertEqual(buckets.head, {"c"})
+
+    def testApproximate(self):
+        buckets = Buckets.Buckets(Buckets.DAY, 14)
+        for num in range(5000):
+            buckets.transfer(MIDNIGHT + num, 0, "192.0.2.%i" % (num % 3000))
+        self.assertEqual(list(buckets.ips), [0])
+        self.assertIsNone(buckets.head)
+        ips = buckets.peak()[3]
+        self.assertLess(abs(ips - 3000), 3000 * 3 * 0.0081)
+        buckets.transfer(MIDNIGHT + 86400, 0, "192.0.2.1")
+        self.assertEqual(buckets.ips[0], ips)
+        self.assertEqual(buckets.ips[1], 0)
+        buckets.settle()
+        self.assertEqual(list(buckets.ips), [ips, 1])
+
+    def testHandover(self):
+        first = MIDNIGHT // Buckets.HOUR
+        for precision in (None, 14):
+            whole = Buckets.Buckets(Buckets.HOUR, precision, keep=True)
+            self.fill(whole)
+            whole.gather(self.fill(Buckets.Buckets(Buckets.HOUR, precision,
+                                                   keep=True)))
+            gathered = Buckets.Buckets(Buckets.HOUR, precision, keep=True)
+            parts = [Buckets.Buckets(Buckets.HOUR, precision, keep=True)
+                     for _ in range(2)]
+            for part in parts:
+                self.fill(part, self.events[:6])
+            # Both logs are past the first two hours
+            for part in parts:
+                gathered.handover(part, first + 2)
+                self.assertEqual(sorted(part.seen), [first + 2])
+            gathered.release(first + 2)
+            self.assertEqual(gathered.seen, {})
+            for part in parts:
+                self.fill(part, self.events[6:])
+                gathered.gather(part)
+            self.assertEqual(list(gathered.rows()), list(whole.rows()))
+            # Late transfers to a released hour only count their bytes
+            gathered.transfer(MIDNIGHT + 30, 1, "d")
+            self.assertEqual(gathered.ips[0], 2)
+            self.assertEqual(gathered.bytes[0], 27)
+
+    def testExport(self):
+        series = Buckets.Series()
+        self.fill(series)
+        csv = Buckets.ascsv(series.get("day")).splitlines()
+        self.assertEqual(csv, ["start,bytes,sessions,ips",
+                               "2012/12/01 00:00:00,25,7,3",
+                               "2012/12/02 00:00:00,4,1,1"])
+        rows = json.loads(Buckets.asjson(series.get("hour")))
+        self.assertEqual(len(rows), 26)
+        self.assertEqual(rows[1], {"start": "2012/12/01 01:00:00",
+                                   "bytes": 2, "sessions": 2, "ips": 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
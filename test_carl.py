@@ -1,10 +1,21 @@
 #!/usr/bin/python -tt
 """Test suite for Carl.py from Carl"""
+import argparse
+import csv
+import hashlib
+import io
+import json
 import mock
+import os
+import shutil
+import tempfile
 import unittest
 import Accounts
+import Bench
 import Sessions
 import Carl
+import Instrument
+import Logfiles
 
 # Pylint has a counterproductive idea of proper names in this case. Also,
 # docstrings for tests seem a bit overblown. TODO: find someone who cares
@@ -105,6 +116,18 @@ class CarlHelpersTest(unittest.TestCase):
         self.assertEqual(msgs, [])
         self.assertEqual(errmsgs, [])
 
+    def testParseOutputs(self):
+        argv = ["-n", "5", "--output", "file=a.txt,obfuscation=fancy",
+                "--output", "format=csv,top=3,order=reverse"]
+        options = Carl.parse_cmdline(argv)[0]
+        self.assertEqual(options.top, 5)
+        self.assertEqual(options.outputs, [
+            {"file": "a.txt", "obfuscation": "fancy"},
+            {"format": "csv", "top": 3, "order": "reverse"}])
+        for spec in ("top=0", "format=xml", "color=red", "short"):
+            self.assertRaises(argparse.ArgumentTypeError, Carl.outputspec,
+                              spec)
+
     def testParseCmdlineVerbose(self):
         argv = ["-o", "fancy", "-r"]
         (options, _, errmsgs) = Carl.parse_cmdline(argv)
@@ -205,6 +228,748 @@ def testSession():
     Carl.parsedata(inp)
 
 
+def testAddresses():
+    # The whole address of a connect, without the parentheses
+    stats = Carl.parsedata(open("testdata/test_interleaved.log").read())
+    assert sorted(stats["ipc"].accounts) == [
+        "10.4.2.65", "192.168.23.42", "2001:db8::1"]
+
+
 def testNumbersWithCommas():
     inp = open("testdata/test_commas_in_numbers.log").read()
     Carl.parsedata(inp)
+
+
+def testStreamingInput():
+    fname = "testdata/test_snippet1.log"
+    whole = Carl.parsedata(open(fname).read())
+    for inp in (open(fname), open(fname).readlines()):
+        stats = Carl.parsedata(inp)
+        assert stats["linecount"] == whole["linecount"]
+        assert stats["totaltraffic"] == whole["totaltraffic"]
+        assert stats["ipb"].accounts == whole["ipb"].accounts
+        assert stats["ipc"].accounts == whole["ipc"].accounts
+
+
+def chunkedparse(fname, args, step):
+    """
+    Parse fname in chunks of step lines like parallelparse() would, but in
+    this process; step may also be a list of the lines to start chunks at.
+    """
+    offsets = [0]
+    with open(fname, "rb") as fobj:
+        for line in fobj:
+            offsets.append(offsets[-1] + len(line))
+    if isinstance(step, int):
+        step = range(step, len(offsets) - 1, step)
+    bounds = [0] + [offsets[line] for line in step] + offsets[-1:]
+    stats = None
+    for begin, end in zip(bounds[:-1], bounds[1:]):
+        part = Carl.parsechunk((fname, begin, end, args))
+        if stats is None:
+            stats = part
+        else:
+            Carl.mergestats(stats, part)
+    return stats
+
+
+def testChunkedParse():
+    fname = "testdata/test_interleaved.log"
+    args = Carl.parse_cmdline(["--session-timeout", "3600"])[0]
+    whole = Carl.parsedata(open(fname), args)
+    lines = whole["linecount"]
+    # Split the log into three chunks at every possible pair of lines
+    for first in range(1, lines):
+        for second in range(first, lines):
+            stats = chunkedparse(fname, args, [first, second])
+            Carl.finishstats(stats)
+            for key in ("linecount", "totaltraffic", "start", "span",
+                        "ip2hname", "counts"):
+                assert stats[key] == whole[key]
+            for key in ("ipb", "ipc"):
+                assert stats[key].accounts == whole[key].accounts
+                assert stats[key].seencount == whole[key].seencount
+            for key in ("seencount", "orphaned", "evicted", "accounts"):
+                assert (getattr(stats["sessions"], key) ==
+                        getattr(whole["sessions"], key))
+
+
+def testChunkBounds():
+    fname = "testdata/test_interleaved.log"
+    offsets = set([0])
+    for line in open(fname, "rb"):
+        offsets.add(max(offsets) + len(line))
+    for parts in range(1, 20):
+        bounds = Carl.chunkbounds(fname, parts)
+        assert bounds[0][0] == 0
+        assert bounds[-1][1] == max(offsets)
+        for begin, end in bounds:
+            assert begin in offsets and end in offsets and begin < end
+
+
+def testBytesEngine():
+    fname = "testdata/test_interleaved.log"
+    text = Carl.parsedata(open(fname))
+    binary = Carl.parsedata(open(fname, "rb"))
+    for key in ("linecount", "totaltraffic", "start", "span", "ip2hname",
+                "laststamp"):
+        assert text[key] == binary[key]
+    for key in ("ipb", "ipc"):
+        assert text[key].accounts == binary[key].accounts
+    assert text["sessions"].accounts == binary["sessions"].accounts
+
+
+def testInvalidUTF8():
+    inp = open("testdata/test_snippet1.log", "rb").read()
+    inp = inp.replace(b"examplehost", b"ex\xffmplehost")
+    stats = Carl.parsedata(inp)
+    assert stats["totaltraffic"] == 6442815
+    assert list(stats["ip2hname"].values()) == [
+        "ex�mplehost.example.com"]
+
+
+def testLineCounts():
+    inp = open("testdata/test_interleaved.log").read()
+    inp += "2012/12/01 04:15:12 [105400]\n2012/12/01\n"
+    stats = Carl.parsedata(inp)
+    assert stats["linecount"] == 16
+    assert Instrument.linecounts(stats) == {
+        "connect": 4, "sent": 5, "error": 1, "skipped": 4, "malformed": 2}
+
+
+def testUnfinishedLine():
+    # The last line of a log rsyncd is still writing
+    inp = open("testdata/test_interleaved.log").read()
+    stats = Carl.parsedata(inp + "2012/12/01 04:15:12 [105396] ")
+    whole = Carl.parsedata(inp)
+    assert stats["linecount"] == whole["linecount"] + 1
+    assert stats["counts"]["malformed"] == 1
+    assert stats["totaltraffic"] == whole["totaltraffic"]
+    stats = Carl.parsedata(inp + "2012/12/01 04:15:12 [105396]")
+    assert stats["linecount"] == whole["linecount"] + 1
+
+
+def testCompact():
+    fname = "testdata/test_interleaved.log"
+    args = Carl.parse_cmdline(["--session-timeout", "3600"])[0]
+    plain = Carl.parsedata(open(fname, "rb"), args)
+    args = Carl.parse_cmdline(["--compact", "--session-timeout", "3600"])[0]
+    compact = Carl.parsedata(open(fname, "rb"), args)
+    assert compact["ip2hname"] == plain["ip2hname"]
+    for key in ("ipb", "ipc"):
+        assert compact[key].accounts == plain[key].accounts
+    options = Carl.parse_cmdline([])[0]
+    compact["rtime"] = plain["rtime"]
+    assert (Carl.mkreport(options, compact) ==
+            Carl.mkreport(options, plain))
+
+    # Chunks have address ids of their own
+    stats = chunkedparse(fname, args, 4)
+    whole = Carl.parsedata(open(fname, "rb"), args)
+    for key in ("ipb", "ipc"):
+        assert stats[key].accounts == whole[key].accounts
+    assert stats["ip2hname"] == whole["ip2hname"]
+    for width in ("hour", "day"):
+        assert (list(stats["buckets"].get(width).rows()) ==
+                list(whole["buckets"].get(width).rows()))
+    assert ({sid: stats["addresses"].text(addrid) for sid, addrid
+             in stats["sessions"].accounts.items()} ==
+            {sid: whole["addresses"].text(addrid) for sid, addrid
+             in whole["sessions"].accounts.items()})
+
+
+def testNumpy():
+    # Falls back to --compact without NumPy, the report is the same either way
+    fname = "testdata/test_interleaved.log"
+    args = Carl.parse_cmdline(["--session-timeout", "3600"])[0]
+    plain = Carl.parsedata(open(fname, "rb"), args)
+    args, _, errmsgs = Carl.parse_cmdline(["--numpy", "--session-timeout",
+                                           "3600"])
+    assert bool(errmsgs) == (Accounts.numpy is None)
+    vector = Carl.parsedata(open(fname, "rb"), args)
+    for key in ("ipb", "ipc"):
+        assert vector[key].accounts == plain[key].accounts
+        assert vector[key].seencount == plain[key].seencount
+    # Batches added up while parsing, not just at the end
+    with mock.patch.object(Accounts, "BATCH", 2):
+        batched = Carl.parsedata(open(fname, "rb"), args)
+    for key in ("ipb", "ipc"):
+        assert batched[key].accounts == plain[key].accounts
+        assert batched[key].total == plain[key].total
+    options = Carl.parse_cmdline([])[0]
+    vector["rtime"] = plain["rtime"]
+    assert (Carl.mkreport(options, vector) ==
+            Carl.mkreport(options, plain))
+
+
+def testSpill():
+    fname = "testdata/test_interleaved.log"
+    args = Carl.parse_cmdline(["--session-timeout", "3600"])[0]
+    plain = Carl.parsedata(open(fname, "rb"), args)
+    args = Carl.parse_cmdline(["--spill", "2", "--session-timeout",
+                               "3600"])[0]
+    spill = Carl.parsedata(open(fname, "rb"), args)
+    for key in ("ipb", "ipc"):
+        assert spill[key].database is not None
+        assert spill[key].accounts == plain[key].accounts
+    options = Carl.parse_cmdline([])[0]
+    spill["rtime"] = plain["rtime"]
+    assert (Carl.mkreport(options, spill) ==
+            Carl.mkreport(options, plain))
+
+
+def testLogFormat():
+    inp = open("testdata/test_interleaved.log").read()
+    # Per-file lines of clients with file names like session lines
+    inp += ("2012/12/01 04:15:12 [105396] rsync on gentoo-portage/ from "
+            "evil (203.0.113.9) [192.168.23.42] 12\n"
+            "2012/12/01 04:15:12 [105396] sent 1 bytes  received 1 bytes  "
+            "total size 1 [192.168.23.42] 12\n")
+    plain = Carl.parsedata(inp)
+    assert plain["ipc"].val("203.0.113.9") == 1
+    args, _, errmsgs = Carl.parse_cmdline(["--log-format", "%f [%a] %l"])
+    assert not errmsgs
+    stats = Carl.parsedata(inp, args)
+    assert "203.0.113.9" not in stats["ip2hname"]
+    assert stats["counts"]["connect"] == plain["counts"]["connect"] - 1
+    assert stats["counts"]["sent"] == plain["counts"]["sent"] - 1
+    assert stats["totaltraffic"] == plain["totaltraffic"] - 2
+    expected = Carl.parsedata(open("testdata/test_interleaved.log"))
+    for key in ("ipb", "ipc"):
+        assert stats[key].accounts == expected[key].accounts
+    args, _, errmsgs = Carl.parse_cmdline(["--log-format", "%f"])
+    assert args.logformat is None
+    assert "look like session lines" in errmsgs[0]
+
+
+def testOutputs():
+    fname = "testdata/test_interleaved.log"
+    args = Carl.parse_cmdline([
+        "--output", "obfuscation=fancy",
+        "--output", "length=short,top=2,order=reverse",
+        "--output", "format=json,obfuscation=fancy",
+        "--output", "format=csv,top=1"])[0]
+    stats = Carl.parsedata(open(fname, "rb"), args)
+    Carl._FANCY.clear()  # pylint: disable=protected-access
+    with mock.patch.object(stats["ipb"], "top",
+                           wraps=stats["ipb"].top) as top, \
+            mock.patch.object(hashlib, "new", wraps=hashlib.new) as md5:
+        rendered = Carl.renderoutputs(args, stats)
+    # One top list for all outputs, each address and name hashed once
+    assert top.call_args_list.count(mock.call(10)) == 1
+    assert top.call_count == 2  # The other for the top 5%
+    assert md5.call_count == len(set(
+        [ipaddr for _, ipaddr in stats["ipb"].top(10)] +
+        [ipaddr for _, ipaddr in stats["ipc"].top(10)] +
+        [stats["ip2hname"][ipaddr] for ipaddr in stats["ip2hname"]]))
+    assert [fname for fname, _ in rendered] == ["-"] * 4
+    for spec, (_, text) in zip(
+            (["-o", "fancy"], ["-s", "-n", "2", "-r"]), rendered):
+        options = Carl.parse_cmdline(spec)[0]
+        assert text == Carl.mkreports(options, stats) + "\n"
+    data = json.loads(rendered[2][1])
+    assert data["totals"]["sessions"] == stats["sessions"].seencount
+    assert [entry["bytes"] for entry in data["bytes"]] == [
+        value for value, _ in stats["ipb"].top(10)]
+    assert data["bytes"][0]["ip"] == Carl.obfuscate(
+        stats["ipb"].top(1)[0][1], "fancy")
+    rows = list(csv.reader(io.StringIO(rendered[3][1])))
+    assert rows == [
+        ["module", "list", "rank", "value", "ip", "host"],
+        ["", "bytes", "1", str(stats["ipb"].top(1)[0][0]),
+         stats["ipb"].top(1)[0][1],
+         stats["ip2hname"].get(stats["ipb"].top(1)[0][1], "")],
+        ["", "sessions", "1", str(stats["ipc"].top(1)[0][0]),
+         stats["ipc"].top(1)[0][1],
+         stats["ip2hname"].get(stats["ipc"].top(1)[0][1], "")]]
+
+
+def testOutputModules():
+    fname = "testdata/test_interleaved.log"
+    args = Carl.parse_cmdline(["-m", "all", "--output", "format=json",
+                               "--output", "format=csv"])[0]
+    stats = Carl.parsedata(open(fname, "rb"), args)
+    rendered = Carl.renderoutputs(args, stats)
+    data = json.loads(rendered[0][1])
+    assert sorted(data["modules"]) == sorted(
+        name.decode("ascii") for name in stats["modules"])
+    rows = list(csv.reader(io.StringIO(rendered[1][1])))[1:]
+    assert set(row[0] for row in rows) == set([""]) | set(data["modules"])
+
+
+def testTiming():
+    fname = "testdata/test_interleaved.log"
+    args = Carl.parse_cmdline(["--timing", "--session-timeout", "3600"])[0]
+    whole = Carl.parsedata(open(fname, "rb"), args)
+    records = whole["records"]
+    # Closes of sessions timed out or never opened have no record
+    assert len(records) == 3
+    assert list(records.duration) == [20, 21, 4]
+    byclient = records.clients()
+    for ipaddr, nbytes in whole["ipb"].accounts.items():
+        assert byclient[ipaddr][2] == nbytes
+    report = Carl.mkreport(args, whole)
+    assert "Session duration: p50 " in report
+    assert " Top 10 slowest Hosts (of 3 or more sessions)" in report
+    # Chunks, with address ids of their own, give the same records
+    for options in (args, Carl.parse_cmdline(
+            ["--timing", "--compact", "--session-timeout", "3600"])[0]):
+        stats = chunkedparse(fname, options, 3)
+        text = Carl.keytext(stats)
+        assert sorted((text(key), entry) for key, entry
+                      in stats["records"].clients().items()) == \
+            sorted(byclient.items())
+        assert (Carl.timing(stats["records"]) ==
+                Carl.timing(whole["records"]))
+    data = Carl.reportdata(args, whole)
+    assert data["timing"]["sessions"] == len(records)
+    assert [entry["rate"] for entry in data["rate"]] == [
+        entry[0] for entry in records.top(10)]
+    # The slowest of clients with enough sessions, not the busiest
+    stats = Carl.parsedata(list(Bench.synthlog(3000, ips=40)), args)
+    slowest = stats["records"].top(10)
+    assert slowest
+    assert [entry[0] for entry in slowest] == sorted(
+        entry[0] for entry in slowest)
+    assert min(entry[2] for entry in slowest) >= 3
+
+
+def testApproximate():
+    fname = "testdata/test_interleaved.log"
+    args = Carl.parse_cmdline(["--session-timeout", "3600"])[0]
+    plain = Carl.parsedata(open(fname, "rb"), args)
+    args = Carl.parse_cmdline(["--approximate", "--session-timeout",
+                               "3600"])[0]
+    approx = Carl.parsedata(open(fname, "rb"), args)
+    # Small enough to be kept exactly
+    assert approx["ip2hname"] == plain["ip2hname"]
+    for key in ("ipb", "ipc"):
+        assert approx[key].accounts == plain[key].accounts
+        assert approx[key].seencount == plain[key].seencount
+    approx["rtime"] = plain["rtime"]
+    report = Carl.mkreport(args, approx)
+    assert report.startswith(Carl.mkreport(args, plain) + "\n\n")
+    assert "at most 0 bytes" in report
+
+    # Chunks are merged like the plain accounts
+    stats = chunkedparse(fname, args, 4)
+    for key in ("ipb", "ipc"):
+        assert stats[key].accounts == approx[key].accounts
+
+
+def testBuckets():
+    fname = "testdata/test_interleaved.log"
+    args = Carl.parse_cmdline(["--bucket", "hour"])[0]
+    whole = Carl.parsedata(open(fname, "rb"), args)
+    series = whole["buckets"]
+    assert sum(series.days.bytes) == whole["totaltraffic"]
+    assert sum(series.hours.sessions) == whole["counts"]["connect"]
+    report = Carl.mkreport(args, whole)
+    assert "Peak hour: " in report
+    assert "Peak day: " in report
+
+    stats = chunkedparse(fname, args, 3)
+    for width in ("hour", "day"):
+        assert (list(stats["buckets"].get(width).rows()) ==
+                list(series.get(width).rows()))
+
+
+def testStampBound():
+    assert Carl.stampbound("2012/12/01") == b"2012/12/01"
+    assert Carl.stampbound("2012-12-01T5:07") == b"2012/12/01 05:07"
+    assert Carl.stampbound(" 2012/12/01 23 ") == b"2012/12/01 23"
+    try:
+        Carl.stampbound("yesterday")
+    except Carl.argparse.ArgumentTypeError:
+        pass
+    else:
+        raise AssertionError("no error for an invalid date")
+    args = Carl.parse_cmdline(["--since", "2012/12/01 03:12",
+                               "--until", "2012/12/01 04:15:10"])[0]
+    stats = Carl.parsedata(Logfiles.clip(
+        open("testdata/test_interleaved.log", "rb"), args.since,
+        args.until), args)
+    assert stats["start"] == Carl.time.mktime(
+        Carl.time.strptime("2012/12/01 03:12:01", "%Y/%m/%d %H:%M:%S"))
+    assert stats["laststamp"] == "2012/12/01 04:15:09"
+
+
+def testModules():
+    lines = list(Bench.synthlog(3000, ips=40))
+    plain = Carl.parsedata(lines)
+    args = Carl.parse_cmdline(["-m", "all"])[0]
+    stats = Carl.parsedata(lines, args)
+    assert sorted(stats["modules"]) == [b"distfiles", b"gentoo-portage"]
+    portage = Carl.modulestats(stats, b"gentoo-portage")
+    for key in ("ipb", "ipc"):
+        assert portage[key].accounts == plain[key].accounts
+    assert portage["sessions"].seencount == plain["sessions"].seencount
+    distfiles = Carl.modulestats(stats, b"distfiles")
+    assert (portage["totaltraffic"] + distfiles["totaltraffic"] ==
+            stats["totaltraffic"])
+    assert (portage["sessions"].seencount + distfiles["sessions"].seencount ==
+            stats["sessions"].seencount)
+    report = Carl.mkreports(args, stats)
+    assert "Module distfiles" in report
+    assert report.startswith(Carl.mkreport(args, stats))
+
+    args = Carl.parse_cmdline(["-m", "distfiles", "-m", "nothere"])[0]
+    stats = Carl.parsedata(lines, args)
+    assert stats["sessions"].seencount == distfiles["sessions"].seencount
+    assert "Module nothere\n==============\nNo sessions." in \
+        Carl.mkreports(args, stats)
+    single = Carl.parsedata(lines, Carl.parse_cmdline(["-m", "distfiles"])[0])
+    assert single["ipc"].accounts == distfiles["ipc"].accounts
+
+
+def testSessionTimeout():
+    # Sessions stay open until they are closed unless asked otherwise
+    lines = [b"2012/12/01 00:00:00 [1] rsync on gentoo-portage/ from h "
+             b"(192.0.2.1)\n",
+             b"2012/12/03 00:00:00 [1] sent 1 bytes  received 2 bytes  "
+             b"total size 3\n"]
+    args = Carl.parse_cmdline([])[0]
+    stats = Carl.parsedata(lines, args)
+    assert stats["ipb"].accounts == {"192.0.2.1": 3}
+    assert "Sessions without a close" not in Carl.mkreport(args, stats)
+    args = Carl.parse_cmdline(["--session-timeout", "86400"])[0]
+    stats = Carl.parsedata(lines, args)
+    assert stats["sessions"].evicted == 1
+    assert "1 timed out" in Carl.mkreport(args, stats)
+
+
+def testModuleOwners():
+    # Sessions that never close are evicted, and so are their owners
+    lines = [b"2012/12/01 %02i:%02i:00 [%i] rsync on distfiles/ from h "
+             b"(192.0.2.1)\n" % (num // 600, num // 10 % 60, num)
+             for num in range(5000)]
+    args = Carl.parse_cmdline(["-m", "all", "--session-timeout", "60"])[0]
+    stats = Carl.parsedata(lines, args)
+    assert stats["sessions"].evicted > 4000
+    assert len(stats["owners"]) <= 2 * stats["sessions"].opencount() + 1024
+
+
+def testModulesTiming():
+    lines = list(Bench.synthlog(3000, ips=40))
+    args = Carl.parse_cmdline(["-m", "all", "--timing"])[0]
+    stats = Carl.parsedata(lines, args)
+    assert sorted(stats["modules"]) == [b"distfiles", b"gentoo-portage"]
+    # Every close of the synthetic log has a session start
+    assert len(stats["records"]) == stats["counts"]["sent"]
+    byclient = stats["records"].clients()
+    for ipaddr, nbytes in stats["ipb"].accounts.items():
+        assert byclient[ipaddr][2] == nbytes
+
+
+def testModulesChunked():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmpdir, "rsyncd.log")
+        Bench.writelog(fname, 3000, ips=40)
+        args = Carl.parse_cmdline(["-m", "all", "--compact"])[0]
+        whole = Carl.parsedata(open(fname, "rb"), args)
+        stats = None
+        for begin, end in Carl.chunkbounds(fname, 5):
+            part = Carl.parsechunk((fname, begin, end, args))
+            if stats is None:
+                stats = part
+            else:
+                Carl.mergestats(stats, part)
+        for name in whole["modules"]:
+            for key in ("ipb", "ipc"):
+                assert (stats["modules"][name][key].accounts ==
+                        whole["modules"][name][key].accounts)
+            assert (stats["modules"][name]["totaltraffic"] ==
+                    whole["modules"][name]["totaltraffic"])
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def testSpoolParse():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        logs = []
+        for seed in range(3):
+            fname = os.path.join(tmpdir, "mirror%i.log" % seed)
+            Bench.writelog(fname, 1000, ips=30, seed=seed)
+            logs.append(fname)
+        args = Carl.parse_cmdline(["-m", "all", "--readers", "2",
+                                   "--inflight", "1", tmpdir])[0]
+        stats = Carl.spoolparse(logs, args)
+        expected = Carl.newstats(args)
+        expected["buckets"] = Carl.Buckets.Series(keep=True)
+        for num, fname in enumerate(logs):
+            part = Carl.newstats(args)
+            part["buckets"] = Carl.Buckets.Series(keep=True)
+            with open(fname, "rb") as fobj:
+                Carl.parselines(part, fobj)
+            Carl.gatherstats(expected, part, num)
+        for key in ("ipb", "ipc"):
+            assert stats[key].accounts == expected[key].accounts
+        assert stats["sessions"].seencount == expected["sessions"].seencount
+        assert stats["sessions"].opencount() == \
+            expected["sessions"].opencount()
+        assert stats["totaltraffic"] == expected["totaltraffic"]
+        assert stats["laststamp"] == expected["laststamp"]
+        for name, module in expected["modules"].items():
+            assert stats["modules"][name]["ipb"].accounts == \
+                module["ipb"].accounts
+        assert list(stats["buckets"].hours.rows()) == \
+            list(expected["buckets"].hours.rows())
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def testSpoolUniqueIPs():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # Two mirrors with the same clients at the same times
+        logs = [os.path.join(tmpdir, "mirror%i.log" % num)
+                for num in range(2)]
+        for fname in logs:
+            Bench.writelog(fname, 1000, ips=30, seed=1)
+        for argv in ([], ["--compact"], ["--approximate"]):
+            args = Carl.parse_cmdline(argv + ["--readers", "2"])[0]
+            stats = Carl.spoolparse(logs, args)
+            single = Carl.spoolparse(logs[:1], args)
+            for width in ("hour", "day"):
+                ours = stats["buckets"].get(width)
+                theirs = single["buckets"].get(width)
+                assert list(ours.ips) == list(theirs.ips)
+                assert list(ours.sessions) == [
+                    2 * num for num in theirs.sessions]
+            # Only the addresses of hours both were still reading are left
+            hours = stats["buckets"].hours
+            assert len(hours.seen) < len(hours.bytes) // 2
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def testProfileStages():
+    args = Carl.parse_cmdline(["--profile"])[0]
+    stats = Carl.parsedata(open("testdata/test_interleaved.log", "rb"), args)
+    stages = stats["stages"]
+    assert stages.names() == ["read", "classify", "accounts", "sessions",
+                              "buckets", "span"]
+    assert stages.calls["accounts"] == 4 + 4
+    assert stages.calls["sessions"] == 4 + 5
+    assert stages.calls["buckets"] == 4 + 5
+    assert "classify" in Instrument.report(stats)
+    assert Carl.parsedata(open("testdata/test_interleaved.log"))[
+        "stages"] is None
+    args = Carl.parse_cmdline(["--profile", "--timing"])[0]
+    stats = Carl.parsedata(open("testdata/test_interleaved.log", "rb"), args)
+    assert len(stats["records"]) == 4
+    assert "classify" in Instrument.report(stats)
+
+
+class IncrementalTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.logname = os.path.join(self.tmpdir, "rsyncd.log")
+        self.statename = os.path.join(self.tmpdir, "carl.state")
+        self.args = Carl.parse_cmdline(["--state", self.statename])[0]
+        with open("testdata/test_interleaved.log", "rb") as fobj:
+            self.lines = fobj.readlines()
+        self.whole = Carl.parsedata(b"".join(self.lines))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def writelog(self, data, mode="wb"):
+        with open(self.logname, mode) as fobj:
+            fobj.write(data)
+
+    def assertSameStats(self, stats):
+        for key in ("linecount", "totaltraffic", "start", "span"):
+            self.assertEqual(stats[key], self.whole[key])
+        self.assertEqual(stats["ipb"].accounts, self.whole["ipb"].accounts)
+        self.assertEqual(stats["ipc"].accounts, self.whole["ipc"].accounts)
+
+    def testResume(self):
+        # Stop in the middle of a line, which must be left for next time
+        self.writelog(b"".join(self.lines[:5]) + self.lines[5][:10])
+        stats = Carl.incrementalparse(self.logname, self.args)
+        self.assertEqual(stats["linecount"], 5)
+        self.writelog(self.lines[5][10:] + b"".join(self.lines[6:]), "ab")
+        self.assertSameStats(Carl.incrementalparse(self.logname, self.args))
+        # Nothing new, nothing changes
+        self.assertSameStats(Carl.incrementalparse(self.logname, self.args))
+
+    def testTruncated(self):
+        self.writelog(b"".join(self.lines))
+        Carl.incrementalparse(self.logname, self.args)
+        self.writelog(b"".join(self.lines[:3]))
+        stats = Carl.incrementalparse(self.logname, self.args)
+        self.assertEqual(stats["linecount"], 3)
+
+    def testRotated(self):
+        self.writelog(b"".join(self.lines[:4]))
+        Carl.incrementalparse(self.logname, self.args)
+        os.rename(self.logname, self.logname + ".1")
+        self.writelog(b"".join(self.lines))
+        self.assertSameStats(Carl.incrementalparse(self.logname, self.args))
+
+    def testOtherOptions(self):
+        self.writelog(b"".join(self.lines[:5]))
+        Carl.incrementalparse(self.logname, self.args)
+        self.writelog(b"".join(self.lines))
+        for argv in (["--timing"], ["-m", "all"], ["--compact"],
+                     ["--log-format", "%o %h %m %f %l"]):
+            # Parsed from the start, not with stats made without argv
+            args = Carl.parse_cmdline(["--state", self.statename] + argv)[0]
+            stats = Carl.incrementalparse(self.logname, args)
+            self.assertEqual(stats["linecount"], len(self.lines))
+            self.assertEqual(stats["totaltraffic"],
+                             self.whole["totaltraffic"])
+            if "--timing" in argv:
+                self.assertEqual(len(stats["records"]), 4)
+
+    def testBrokenState(self):
+        with open(self.statename, "wb") as fobj:
+            fobj.write(b"not a pickle")
+        self.writelog(b"".join(self.lines))
+        self.assertSameStats(Carl.incrementalparse(self.logname, self.args))
+
+
+class TailTestCase(unittest.TestCase):
+
+    """Set up a log to read as it grows, for FollowTests and ServeTests"""
+
+    class Done(Exception):
+        pass
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.logname = os.path.join(self.tmpdir, "rsyncd.log")
+        with open("testdata/test_interleaved.log", "rb") as fobj:
+            self.lines = fobj.readlines()
+        self.whole = Carl.parsedata(b"".join(self.lines))
+        self.output = mock.MagicMock()
+        self.clock = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def now(self):
+        return self.clock
+
+    def write(self, data, fname=None):
+        with open(fname or self.logname, "ab") as fobj:
+            fobj.write(data)
+
+
+class FollowTests(TailTestCase):
+
+    def runFollow(self, argv, steps):
+        """Follow the log, running the next of steps at each sleep()"""
+        steps = list(steps)
+
+        def sleep(secs):
+            self.clock += secs
+            if not steps:
+                raise self.Done()
+            steps.pop(0)()
+
+        open(self.logname, "wb").close()
+        args = Carl.parse_cmdline(argv + [self.logname])[0]
+        self.assertRaises(self.Done, Carl.follow, self.logname, args,
+                          self.output, sleep, self.now)
+
+    def reports(self):
+        return [call[0][0] for call in self.output.write.call_args_list]
+
+    def testFollow(self):
+        steps = [lambda: self.write(b"".join(self.lines[:7])),
+                 lambda: self.write(b"".join(self.lines[7:])),
+                 lambda: None]
+        self.runFollow(["--interval", "1"], steps)
+        reports = self.reports()
+        self.assertEqual(len(reports), 2)
+        self.assertIn("Total number of sessions: %s" %
+                      self.whole["sessions"].seencount, reports[-1])
+        self.assertIn("Analyzed %s lines" % self.whole["linecount"],
+                      reports[-1])
+
+    def testFollowRotation(self):
+        def rotate():
+            os.rename(self.logname, self.logname + ".1")
+            self.write(self.lines[7], self.logname + ".1")
+            self.write(b"".join(self.lines[8:]))
+
+        steps = [lambda: self.write(b"".join(self.lines[:7])),
+                 rotate,
+                 lambda: None]
+        self.runFollow(["--interval", "100", "--every-lines", "5"], steps)
+        reports = self.reports()
+        self.assertEqual(len(reports), 2)
+        self.assertIn("Analyzed %s lines" % self.whole["linecount"],
+                      reports[-1])
+        for value, _ in self.whole["ipb"].top(10):
+            self.assertIn(" %s (" % value, reports[-1])
+
+    def testReportFile(self):
+        reportfile = os.path.join(self.tmpdir, "report.txt")
+        steps = [lambda: self.write(b"".join(self.lines))]
+        self.runFollow(["--interval", "1", "--report-file", reportfile],
+                       steps)
+        self.assertEqual(self.reports(), [])
+        with open(reportfile) as fobj:
+            self.assertIn("Total number of sessions", fobj.read())
+
+
+class ServeTests(TailTestCase):
+
+    class FakeServer:
+        answers = None
+
+    def runServe(self, argv, steps):
+        """Serve the log, running the next of steps at each sleep()"""
+        steps = list(steps)
+        self.server = self.FakeServer()
+        seen = []
+
+        def sleep(secs):
+            self.clock += secs
+            seen.append(self.server.answers)
+            if not steps:
+                raise self.Done()
+            steps.pop(0)()
+
+        open(self.logname, "wb").close()
+        args = Carl.parse_cmdline(argv + [self.logname])[0]
+        self.assertRaises(self.Done, Carl.serve, self.logname, args,
+                          self.server, sleep, self.now)
+        return seen
+
+    def checkAnswers(self, answers):
+        self.assertEqual(json.loads(answers["totals"])["lines"],
+                         self.whole["linecount"])
+        self.assertEqual([(entry["bytes"], entry["ip"])
+                          for entry in answers["ipb"][:10]],
+                         self.whole["ipb"].top(10))
+        self.assertEqual([(entry["sessions"], entry["ip"])
+                          for entry in answers["ipc"][:10]],
+                         self.whole["ipc"].top(10))
+
+    def testServe(self):
+        steps = [lambda: self.write(b"".join(self.lines[:7])),
+                 lambda: self.write(b"".join(self.lines[7:])),
+                 lambda: None]
+        seen = self.runServe(["--interval", "100"], steps)
+        # An empty log is something to answer with, too
+        self.assertEqual(json.loads(seen[0]["totals"])["lines"], 0)
+        self.assertIsNone(seen[0]["report"])
+        self.checkAnswers(seen[-1])
+        # The report is only made every --interval seconds
+        self.assertIsNotNone(seen[2]["report"])
+        self.assertIs(seen[-1]["report"], seen[2]["report"])
+
+    def testServeCompact(self):
+        steps = [lambda: self.write(b"".join(self.lines[:9])),
+                 lambda: self.write(b"".join(self.lines[9:]))]
+        seen = self.runServe(["--compact", "--interval", "1"], steps)
+        self.checkAnswers(seen[-1])
+        self.assertIn("Analyzed %s lines" % self.whole["linecount"],
+                      seen[-1]["report"])
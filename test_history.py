@@ -0,0 +1,129 @@
+#!/usr/bin/python -tt
+"""Test suite for History.py of Carl"""
+import os
+import shutil
+import tempfile
+import unittest
+import Bench
+import Carl
+import History
+
+# Pylint has a counterproductive idea of proper names in this case. Also,
+# docstrings for tests seem a bit overblown. TODO: find someone who cares
+# enough to write them.
+# pylint: disable=invalid-name,missing-docstring,too-many-public-methods,
+
+
+class DaysTest(unittest.TestCase):
+
+    """Test Days class"""
+
+    def testCounts(self):
+        days = History.Days()
+        days.connect(86400 * 3 + 10, "a")
+        days.connect(86400 * 3 + 5, "a")
+        days.transfer(86400 * 4 + 1, "a", 100)
+        days.transfer(86400 * 4 + 7, "b", 5)
+        self.assertEqual(days.sessions, {3: {"a": 2}})
+        self.assertEqual(days.bytes, {4: {"a": 100, "b": 5}})
+        self.assertEqual(days.first, {3: 86400 * 3 + 5, 4: 86400 * 4 + 1})
+        self.assertEqual(days.last, {3: 86400 * 3 + 10, 4: 86400 * 4 + 7})
+        self.assertEqual(days.hours, {96: {"a", "b"}})
+
+    def testMerge(self):
+        days = History.Days()
+        days.connect(100, 1)
+        other = History.Days()
+        other.connect(50, 1)
+        other.transfer(200, 2, 10)
+        days.merge(other, {1: 1, 2: 1}.get)
+        self.assertEqual(days.sessions, {0: {1: 2}})
+        self.assertEqual(days.bytes, {0: {1: 10}})
+        self.assertEqual((days.first, days.last), ({0: 50}, {0: 200}))
+        self.assertEqual(days.hours, {0: {1}})
+
+    def testWindow(self):
+        self.assertEqual(History.window(), ("1", []))
+        self.assertEqual(History.window(b"2012/12/01", b"2012/12/03"),
+                         ("1 AND day >= ? AND day < ?",
+                          ["2012/12/01", "2012/12/03"]))
+        self.assertEqual(History.window(None, b"2012/12/03 05", "a", "b"),
+                         ("1 AND a <= ?", ["2012/12/03"]))
+
+
+class HistoryTest(unittest.TestCase):
+
+    """Test recording runs and reporting from them"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dbname = os.path.join(self.tmpdir, "history.db")
+        # Three days, so windows have something to pick
+        self.log = list(Bench.synthlog(3000, ips=40, span=3 * 86400))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def record(self, argv):
+        args = Carl.parse_cmdline(argv + ["--record", self.dbname])[0]
+        stats = Carl.parsedata(self.log, args)
+        History.record(self.dbname, stats, Carl.keytext(stats))
+        return args, stats
+
+    def history(self, since=None, until=None):
+        args = Carl.parse_cmdline(["--history", self.dbname])[0]
+        args.since = since
+        args.until = until
+        return Carl.historystats(args)
+
+    def testRoundTrip(self):
+        for argv in ([], ["--compact"]):
+            args, stats = self.record(argv)
+            loaded = self.history()
+            loaded["rtime"] = stats["rtime"]
+            self.assertEqual(Carl.mkreport(args, loaded),
+                             Carl.mkreport(args, stats))
+            os.unlink(self.dbname)
+
+    def testTwice(self):
+        _, stats = self.record([])
+        self.record([])
+        loaded = self.history()
+        self.assertEqual(loaded["totaltraffic"], 2 * stats["totaltraffic"])
+        self.assertEqual(loaded["ipb"].seencount, stats["ipb"].seencount)
+        self.assertEqual(loaded["linecount"], 2 * stats["linecount"])
+
+    def testSplitDay(self):
+        # Rotated in the middle of a day, with clients on both sides
+        whole = self.log
+        cut = len(whole) // 2
+        fnames = []
+        for num, part in enumerate((whole[:cut], whole[cut:])):
+            self.log = part
+            self.record([])
+            fnames.append(os.path.join(self.tmpdir, "rsyncd.log.%i" % num))
+            with open(fnames[-1], "wb") as fobj:
+                fobj.writelines(part)
+        self.log = whole
+        # Sessions open across the cut have no client in either part,
+        # like with several logs read at once
+        stats = Carl.spoolparse(fnames, Carl.parse_cmdline([])[0])
+        loaded = self.history()
+        for width in ("day", "hour"):
+            self.assertEqual(list(loaded["buckets"].get(width).ips),
+                             list(stats["buckets"].get(width).ips))
+
+    def testWindow(self):
+        self.record([])
+        loaded = self.history(b"2012/12/02", b"2012/12/03")
+        self.assertEqual(loaded["laststamp"][:10], "2012/12/02")
+        self.assertLess(loaded["span"], 1.0)
+        days = Carl.parsedata(Carl.Logfiles.clip(
+            self.log, b"2012/12/02", b"2012/12/03"))
+        self.assertEqual(loaded["buckets"].days.bytes,
+                         days["buckets"].days.bytes)
+        self.assertEqual(self.history(b"2013/01/01")["span"], "unknown")
+
+
+if __name__ == "__main__":
+    unittest.main()
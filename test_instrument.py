@@ -0,0 +1,118 @@
+#!/usr/bin/python -tt
+"""Test suite for Instrument.py from Carl"""
+import io
+import os
+import pickle
+import pstats
+import shutil
+import tempfile
+import unittest
+import Instrument
+
+# Pylint has a counterproductive idea of proper names in this case. Also,
+# docstrings for tests seem a bit overblown. TODO: find someone who cares
+# enough to write them.
+# pylint: disable=invalid-name,missing-docstring,too-many-public-methods
+
+
+class StagesTest(unittest.TestCase):
+
+    """Test Instrument.Stages"""
+
+    def testWrap(self):
+        stages = Instrument.Stages()
+        double = stages.wrap("double", lambda num: 2 * num)
+        self.assertEqual([double(num) for num in range(3)], [0, 2, 4])
+        self.assertEqual(stages.calls["double"], 3)
+        self.assertTrue(stages.wall["double"] >= 0.0)
+
+    def testLines(self):
+        stages = Instrument.Stages()
+        lines = [b"%i\n" % num for num in range(Instrument.BATCHSIZE + 1)]
+        self.assertEqual(list(stages.lines("read", iter(lines))), lines)
+        self.assertEqual(stages.calls["read"], 2)
+
+    def testRest(self):
+        stages = Instrument.Stages()
+        before = stages.snapshot()
+        stages.add("inner", 1000.0, 1000.0)
+        stages.rest("outer", before)
+        # The inner stage is not taken out twice
+        self.assertEqual(stages.wall["outer"], 0.0)
+        self.assertEqual(stages.names(), ["inner", "outer"])
+
+    def testMerge(self):
+        stages = Instrument.Stages()
+        stages.add("read", 1.0, 0.5)
+        other = pickle.loads(pickle.dumps(stages))
+        other.add("span", 2.0, 2.0)
+        stages.merge(other)
+        self.assertEqual(stages.asdict(), {
+            "read": {"wall": 2.0, "cpu": 1.0, "calls": 2},
+            "span": {"wall": 2.0, "cpu": 2.0, "calls": 1}})
+
+    def testStageNone(self):
+        with Instrument.stage(None, "report"):
+            pass
+        stages = Instrument.Stages()
+        with Instrument.stage(stages, "report"):
+            pass
+        self.assertEqual(stages.names(), ["report"])
+
+
+class ProgressTest(unittest.TestCase):
+
+    """Test Instrument.Progress"""
+
+    def setUp(self):
+        self.clock = [100.0]
+        self.output = io.StringIO()
+
+    def now(self):
+        return self.clock[0]
+
+    def testProgress(self):
+        progress = Instrument.Progress(4000, 10.0, self.output, self.now)
+        progress.update([b"x" * 99 + b"\n"] * 10)
+        self.assertEqual(self.output.getvalue(), "")
+        self.clock[0] += 10.0
+        progress.update([b"x" * 99 + b"\n"] * 10)
+        self.assertEqual(self.output.getvalue(),
+                         "Progress: 20 lines, 2 lines/s, 50.0%, "
+                         "ETA 00:00:10\n")
+
+    def testUnknownSize(self):
+        progress = Instrument.Progress(None, 1.0, self.output, self.now)
+        self.clock[0] += 2.0
+        progress.update([b"\n"] * 4)
+        self.assertEqual(self.output.getvalue(),
+                         "Progress: 4 lines, 2 lines/s\n")
+
+
+class DumpsTest(unittest.TestCase):
+
+    """Test Instrument.dumps()"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testDumps(self):
+        cprofile = os.path.join(self.tmpdir, "cprofile")
+        allocations = os.path.join(self.tmpdir, "allocations")
+        with Instrument.dumps(cprofile, allocations):
+            sorted(str(num) for num in range(1000))
+        self.assertTrue(pstats.Stats(cprofile).total_calls > 0)
+        with open(allocations) as fobj:
+            self.assertTrue(fobj.readline().startswith("Traced memory:"))
+
+    def testNoDumps(self):
+        with Instrument.dumps():
+            pass
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+#!/usr/bin/python -tt
+"""Test suite for Logfiles.py from Carl"""
+import bz2
+import gzip
+import io
+import lzma
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import mock
+import Carl
+import Logfiles
+
+# Pylint has a counterproductive idea of proper names in this case. Also,
+# docstrings for tests seem a bit overblown. TODO: find someone who cares
+# enough to write them.
+# pylint: disable=invalid-name,missing-docstring,too-many-public-methods
+
+
+class LogfilesTest(unittest.TestCase):
+
+    """Test Logfiles functions"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        with open("testdata/test_interleaved.log", "rb") as fobj:
+            self.data = fobj.read()
+        self.lines = self.data.splitlines(True)
+        self.fnames = {}
+        for name, opener in (("plain", open), ("gzip", gzip.open),
+                             ("bzip2", bz2.open), ("xz", lzma.open)):
+            fname = os.path.join(self.tmpdir, "rsyncd.log.%s" % name)
+            with opener(fname, "wb") as fobj:
+                fobj.write(self.data)
+            self.fnames[name] = fname
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testCompression(self):
+        for name, fname in self.fnames.items():
+            with open(fname, "rb") as fobj:
+                expected = None if name == "plain" else name
+                self.assertEqual(Logfiles.compression(fobj), expected)
+                self.assertEqual(fobj.tell(), 0)
+
+    def testOpenlog(self):
+        for fname in self.fnames.values():
+            with Logfiles.openlog(fname) as fobj:
+                self.assertEqual(fobj.read(), self.data)
+
+    def testReadlogs(self):
+        for fname in self.fnames.values():
+            self.assertEqual(list(Logfiles.readlogs([fname])), self.lines)
+
+    def testReadlogsMulti(self):
+        fnames = sorted(self.fnames.values())
+        self.assertEqual(list(Logfiles.readlogs(fnames)),
+                         self.lines * len(fnames))
+
+    def testSmallBatches(self):
+        reader = Logfiles.ReadAhead([io.BytesIO(self.data),
+                                     io.BytesIO(self.data)],
+                                    batchsize=10, readahead=1)
+        reader.start()
+        self.assertEqual(list(reader), self.lines * 2)
+
+    def testMaplines(self):
+        with open(self.fnames["plain"], "rb") as fobj:
+            self.assertTrue(Logfiles.mappable(fobj))
+        with open(self.fnames["gzip"], "rb") as fobj:
+            self.assertFalse(Logfiles.mappable(fobj))
+        with open(self.fnames["plain"], "rb") as fobj:
+            self.assertEqual(list(Logfiles.maplines(fobj)), self.lines)
+        empty = os.path.join(self.tmpdir, "empty.log")
+        open(empty, "w").close()
+        with open(empty, "rb") as fobj:
+            self.assertEqual(list(Logfiles.maplines(fobj)), [])
+
+    def testReadlogsCloses(self):
+        opened = []
+        realopen = open
+
+        def tracked(*args):
+            fobj = realopen(*args)
+            opened.append(fobj)
+            return fobj
+        fnames = sorted(self.fnames.values())
+        with mock.patch("builtins.open", tracked):
+            lines = Logfiles.readlogs(fnames)
+            # One file is read at a time
+            self.assertEqual(next(lines), self.lines[0])
+            self.assertLessEqual(sum(
+                isinstance(thread, Logfiles.ReadAhead) and thread.is_alive()
+                for thread in threading.enumerate()), 1)
+            self.assertEqual(list(lines), self.lines[1:] +
+                             self.lines * (len(fnames) - 1))
+        self.assertEqual(len(opened), len(fnames))
+        self.assertTrue(all(fobj.closed for fobj in opened))
+
+    def testReadlogsStdin(self):
+        stdin = io.BufferedReader(io.BytesIO(self.data))
+        with mock.patch.object(Logfiles.sys, "stdin",
+                               mock.Mock(buffer=stdin)):
+            self.assertEqual(list(Logfiles.readlogs(["-"])), self.lines)
+        self.assertFalse(stdin.closed)
+
+    def testMissingFile(self):
+        self.assertRaises(EnvironmentError, Logfiles.readlogs,
+                          [os.path.join(self.tmpdir, "nonexistent")])
+
+    def testWindow(self):
+        lines = []
+        for num in range(200):
+            when = Carl.time.gmtime(1354320000 + 97 * (num // 3))
+            lines.append(Carl.time.strftime("%Y/%m/%d %H:%M:%S ", when)
+                         .encode("ascii") + b"[%d] line %d\n" % (num, num))
+            if num % 17 == 0:
+                lines.append(b"continued without a timestamp\n")
+        fname = os.path.join(self.tmpdir, "window.log")
+        with open(fname, "wb") as fobj:
+            fobj.writelines(lines)
+        bounds = [None, b"2012/11", b"2012/12/01", b"2012/12/01 00:03:14",
+                  b"2012/12/01 00:03:15", b"2012/12/01 01", b"2012/12/02"]
+        for since in bounds:
+            for until in bounds:
+                begin, end = Logfiles.window(fname, since, until)
+                self.assertEqual(list(Logfiles.maprange(fname, begin, end)),
+                                 list(Logfiles.clip(lines, since, until)))
+        empty = os.path.join(self.tmpdir, "empty.log")
+        open(empty, "w").close()
+        self.assertEqual(Logfiles.window(empty, b"2012"), (0, 0))
+        self.assertEqual(Logfiles.stamp(b"not a stamp at all, really"), None)
+
+    def testSpool(self):
+        self.assertTrue(Logfiles.isspool(self.tmpdir))
+        self.assertTrue(Logfiles.isspool("logs/*.gz"))
+        self.assertFalse(Logfiles.isspool(self.fnames["plain"]))
+        fnames = Logfiles.expand([self.tmpdir])
+        self.assertEqual(fnames, sorted(self.fnames.values()))
+        self.assertEqual(
+            Logfiles.expand([os.path.join(self.tmpdir, "*.[gx]z*"), "-"]),
+            [self.fnames["gzip"], self.fnames["xz"], "-"])
+        spool = Logfiles.Spool(fnames, readers=3, inflight=1, batchsize=100)
+        spool.start()
+        lines = dict((index, []) for index in range(len(fnames)))
+        done = []
+        for index, batch in spool:
+            self.assertNotIn(index, done)
+            if batch is None:
+                done.append(index)
+            else:
+                lines[index].extend(batch)
+        self.assertEqual(sorted(done), list(range(len(fnames))))
+        for index in lines:
+            self.assertEqual(lines[index], self.lines)
+        spool = Logfiles.Spool([os.path.join(self.tmpdir, "nonexistent")])
+        spool.start()
+        self.assertRaises(EnvironmentError, list, spool)
+
+    def testParseAsOneLog(self):
+        stats = Carl.parsedata(Logfiles.readlogs(
+            [self.fnames["gzip"], self.fnames["xz"]]))
+        single = Carl.parsedata(self.lines * 2)
+        self.assertEqual(stats["linecount"], single["linecount"])
+        self.assertEqual(stats["totaltraffic"], single["totaltraffic"])
+        self.assertEqual(stats["ipb"].accounts, single["ipb"].accounts)
+        self.assertEqual(stats["span"], single["span"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/python -tt
+"""Test suite for LogFormats.py of Carl"""
+import pickle
+import unittest
+import LogFormats
+
+# Pylint has a counterproductive idea of proper names in this case. Also,
+# docstrings for tests seem a bit overblown. TODO: find someone who cares
+# enough to write them.
+# pylint: disable=invalid-name,missing-docstring,too-many-public-methods
+
+
+class TokensTest(unittest.TestCase):
+
+    """Test tokens()"""
+
+    def testDefault(self):
+        self.assertEqual(list(LogFormats.tokens(LogFormats.DEFAULT)), [
+            ("o", False), " ", ("h", False), " [", ("a", False), "] ",
+            ("m", False), " (", ("u", False), ") ", ("f", False), " ",
+            ("l", False)])
+
+    def testFlags(self):
+        self.assertEqual(list(LogFormats.tokens("%-10o%'b 100%%")), [
+            ("o", True), ("b", False), " 100", "%"])
+
+    def testUnknown(self):
+        for text in ("%o %x", "%o %", "%o %10%"):
+            self.assertRaises(ValueError, list, LogFormats.tokens(text))
+
+
+class LogFormatTest(unittest.TestCase):
+
+    """Test LogFormat class"""
+
+    def testDefault(self):
+        fmt = LogFormats.LogFormat()
+        self.assertEqual(fmt.match(
+            b"send host.example.org [2001:db8::1] gentoo-portage () "
+            b"metadata/timestamp.chk 32\n"),
+            {"o": b"send", "h": b"host.example.org", "a": b"2001:db8::1",
+             "m": b"gentoo-portage", "u": b"",
+             "f": b"metadata/timestamp.chk", "l": b"32"})
+        self.assertEqual(fmt.match(
+            b"recv h [192.0.2.1] mod (joe) a file with spaces 1,024")["f"],
+            b"a file with spaces")
+        self.assertFalse(fmt.ambiguous())
+        for sample in LogFormats.SAMPLES:
+            self.assertIsNone(fmt.match(sample))
+
+    def testPadded(self):
+        fmt = LogFormats.LogFormat("%t %p %-6o %8'b %f")
+        self.assertEqual(fmt.match(
+            b"2012/12/01 03:11:42 105396 del.         1,234 x")["b"],
+            b"1,234")
+        self.assertIsNone(fmt.match(b"2012/12/01 03:11:42 1 open 1 x"))
+
+    def testRepeated(self):
+        fmt = LogFormats.LogFormat("%f -> %f")
+        self.assertEqual(fmt.fields, ["f"])
+        self.assertEqual(fmt.match(b"a -> b"), {"f": b"a"})
+
+    def testAmbiguous(self):
+        self.assertTrue(LogFormats.LogFormat("%f").ambiguous())
+        self.assertTrue(LogFormats.LogFormat("%n %l").ambiguous())
+        self.assertFalse(LogFormats.LogFormat("%f [%a] %l").ambiguous())
+
+    def testInvalid(self):
+        self.assertRaises(ValueError, LogFormats.LogFormat, "%q")
+        self.assertRaises(ValueError, LogFormats.LogFormat, "files")
+
+    def testPickle(self):
+        fmt = pickle.loads(pickle.dumps(LogFormats.LogFormat()))
+        self.assertEqual(fmt.text, LogFormats.DEFAULT)
+        self.assertEqual(fmt.match(b"del. h [::1] m () f 0")["o"], b"del.")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+#!/usr/bin/python -tt
+"""Test suite for Server.py of Carl"""
+import http.client
+import json
+import os
+import random
+import shutil
+import socket
+import tempfile
+import unittest
+import Accounts
+import Addresses
+import Server
+
+# Pylint has a counterproductive idea of proper names in this case. Also,
+# docstrings for tests seem a bit overblown. TODO: find someone who cares
+# enough to write them.
+# pylint: disable=invalid-name,missing-docstring,too-many-public-methods,
+
+
+class RankingTest(unittest.TestCase):
+
+    """Test Ranking class against Accounts.top()"""
+
+    def check(self, accounts, keys, text=str):
+        rng = random.Random(2)
+        plain = Accounts.Accounts()
+        ranking = Server.Ranking(accounts, text, 5)
+        incr = ranking.wrap(accounts.incr)
+        for _ in range(20):
+            for _ in range(50):
+                key = rng.choice(keys)
+                num = rng.randrange(1, 4)
+                incr(key, num)
+                plain.incr(text(key), num)
+            ranking.update()
+            self.assertEqual(ranking.top(5), plain.top(5))
+            self.assertEqual(ranking.top(2), plain.top(2))
+
+    def testRanking(self):
+        self.check(Accounts.Accounts(),
+                   ["10.0.0.%i" % num for num in range(30)])
+
+    def testCompact(self):
+        table = Addresses.AddressTable()
+        keys = [table.intern("10.0.0.%i" % num) for num in range(30)]
+        self.check(Accounts.CompactAccounts(table), keys, table.text)
+
+    def testApproximate(self):
+        accounts = Accounts.ApproxAccounts(100)
+        self.check(accounts, ["10.0.0.%i" % num for num in range(30)])
+
+
+class AddressTest(unittest.TestCase):
+
+    def testAddress(self):
+        self.assertEqual(Server.address("8080"), ("127.0.0.1", 8080))
+        self.assertEqual(Server.address("0.0.0.0:80"), ("0.0.0.0", 80))
+        self.assertEqual(Server.address("./carl.sock"), "./carl.sock")
+        self.assertRaises(ValueError, Server.address, "localhost")
+        self.assertRaises(ValueError, Server.address, "70000")
+
+
+class UnixConnection(http.client.HTTPConnection):
+
+    def __init__(self, path):
+        http.client.HTTPConnection.__init__(self, "localhost")
+        self.sockpath = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX)
+        self.sock.connect(self.sockpath)
+
+
+class ServerTest(unittest.TestCase):
+
+    """Test queries against a running server"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def publish(self):
+        entries = {"ipb": [{"ip": "10.0.0.%i" % num, "host": "",
+                            "bytes": 100 - num} for num in range(20)],
+                   "ipc": [{"ip": "10.0.0.1", "host": "", "sessions": 3}]}
+        Server.publish(self.server, {"lines": 42}, entries, "Report\n")
+
+    def query(self, conn, path):
+        conn.request("GET", path)
+        response = conn.getresponse()
+        return response.status, response.read().decode("utf-8")
+
+    def checkQueries(self, conn):
+        self.assertEqual(self.query(conn, "/totals")[0], 503)
+        self.publish()
+        status, body = self.query(conn, "/totals")
+        self.assertEqual((status, json.loads(body)), (200, {"lines": 42}))
+        status, body = self.query(conn, "/top")
+        self.assertEqual(status, 200)
+        self.assertEqual([entry["bytes"] for entry in json.loads(body)],
+                         list(range(100, 90, -1)))
+        status, body = self.query(conn, "/top?by=sessions&n=100")
+        self.assertEqual(json.loads(body)[0]["sessions"], 3)
+        self.assertEqual(self.query(conn, "/top?n=1000")[0], 400)
+        self.assertEqual(self.query(conn, "/top?by=ips")[0], 400)
+        self.assertEqual(self.query(conn, "/report"), (200, "Report\n"))
+        self.assertEqual(self.query(conn, "/")[0], 404)
+
+    def testTCP(self):
+        self.server = Server.listen(("127.0.0.1", 0))
+        conn = http.client.HTTPConnection(*self.server.server_address)
+        self.checkQueries(conn)
+
+    @unittest.skipUnless(hasattr(socket, "AF_UNIX"), "no UNIX sockets")
+    def testUnix(self):
+        path = os.path.join(self.tmpdir, "carl.sock")
+        # Left behind by an earlier run
+        stale = socket.socket(socket.AF_UNIX)
+        stale.bind(path)
+        stale.close()
+        self.server = Server.listen(path)
+        self.checkQueries(UnixConnection(path))
+        self.server.shutdown()
+        self.server.server_close()
+        self.server = None
+        self.assertFalse(os.path.exists(path))
+
+
+if __name__ == "__main__":
+    unittest.main()
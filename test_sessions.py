@@ -1,6 +1,8 @@
 #!/usr/bin/python -tt
 """Test suite for Sessions.py from Carl"""
+import pickle
 import unittest
+import mock
 import Sessions
 
 # Pylint has a counterproductive idea of proper names in this case. Also,
@@ -47,3 +49,153 @@ class SessionsTest(unittest.TestCase):
         self.assertEqual(myses.seencount, len(self.sessions))
         for (sessid, inf) in self.sessions[::-1]:
             self.assertEqual(myses.pop(sessid), inf)
+
+    def testPopForgets(self):
+        myses = Sessions.Sessions()
+        for (sessid, inf) in self.sessions:
+            myses.push(sessid, inf)
+        self.assertEqual(myses.opencount(), len(self.sessions))
+        for (sessid, inf) in self.sessions:
+            self.assertEqual(myses.pop(sessid), inf)
+            self.assertEqual(myses.pop(sessid), None)
+        self.assertEqual(myses.opencount(), 0)
+        self.assertEqual(myses.accounts, {})
+
+    def testOrphaned(self):
+        myses = Sessions.Sessions()
+        myses.push("ses1", "foobaz", 0)
+        myses.push("ses1", "foobar", 10)
+        self.assertEqual(myses.orphaned, 1)
+        self.assertEqual(myses.pop("ses1"), "foobar")
+
+    def testEviction(self):
+        myses = Sessions.Sessions(maxage=100)
+        myses.push("ses1", "foobaz", 0)
+        myses.push("ses2", "foobar", 50)
+        self.assertEqual(myses.pop("ses2", 100), "foobar")
+        myses.push("ses3", "creamcheese", 150)
+        self.assertEqual(myses.evicted, 1)
+        self.assertEqual(myses.pop("ses1", 160), None)
+        self.assertEqual(myses.opencount(), 1)
+
+    def testQueueCompacted(self):
+        myses = Sessions.Sessions(maxage=10 ** 9)
+        for num in range(100000):
+            myses.push(num, "foobar", num)
+            self.assertEqual(myses.pop(num, num + 1), "foobar")
+        myses.push("ses1", "foobaz", 100000)
+        self.assertLessEqual(len(myses._queue),
+                             2 + Sessions._QUEUESLACK)
+        myses.expire(10 ** 9 + 100001)
+        self.assertEqual((myses.evicted, myses.opencount()), (1, 0))
+
+    def testPopTooLate(self):
+        myses = Sessions.Sessions(maxage=100)
+        myses.push("ses1", "foobaz", 0)
+        self.assertEqual(myses.pop("ses1", 101), None)
+        self.assertEqual(myses.evicted, 1)
+
+    def testSupersede(self):
+        myses = Sessions.Sessions(maxage=100)
+        myses.push("ses1", "foobaz", 0)
+        myses.push("ses2", "foobar", 50)
+        myses.supersede("ses1", 90)
+        myses.supersede("ses2", 200)
+        myses.supersede("ses3", 200)
+        self.assertEqual((myses.orphaned, myses.evicted), (1, 1))
+        self.assertEqual(myses.opencount(), 0)
+
+    def testAdopt(self):
+        first = Sessions.Sessions(maxage=100)
+        first.push("ses1", "foobaz", 0)
+        first.push("ses2", "foobar", 60)
+        second = Sessions.Sessions(maxage=100)
+        second.push("ses3", "creamcheese", 150)
+        first.adopt(second)
+        self.assertEqual(first.seencount, 3)
+        self.assertEqual(first.evicted, 1)
+        self.assertEqual(sorted(first.accounts), ["ses2", "ses3"])
+        self.assertEqual(first.latest, 150)
+
+    def testGather(self):
+        first = Sessions.Sessions()
+        first.push("ses1", "foo", 10)
+        first.push("ses1", "bar", 20)
+        second = Sessions.Sessions()
+        second.push("ses1", "creamcheese", 15)
+        first.gather(second, "host2")
+        self.assertEqual(first.seencount, 3)
+        self.assertEqual(first.orphaned, 1)
+        self.assertEqual(first.opencount(), 2)
+        self.assertEqual(first.pop("ses1"), "bar")
+        self.assertEqual(first.pop(("host2", "ses1")), "creamcheese")
+
+    def testFirstPushes(self):
+        firsts = Sessions.FirstPushes()
+        firsts.note("[42]", 10)
+        firsts.note("[42]", 20)
+        firsts.note("[7]", None)
+        firsts.note("oddball", 30)
+        self.assertEqual(firsts.get("[42]"), (True, 10))
+        self.assertEqual(firsts.get("[7]"), (True, None))
+        self.assertEqual(firsts.get("[8]"), (False, None))
+        self.assertEqual(firsts.get("[99999]"), (False, None))
+        self.assertEqual(firsts.get("oddball"), (True, 30))
+        firsts.note("[4000000]", 40)
+        self.assertLess(len(pickle.dumps(firsts)), 1000)
+
+
+class RecordsTest(unittest.TestCase):
+
+    """Test Records class and percentiles()"""
+
+    def setUp(self):
+        self.records = Sessions.Records()
+        self.records.add(100, 110, 1000, 24, "foo")
+        self.records.add(100, 99, 10, 2, "bar")
+        self.records.add(200, 300.5, 5000, 0, "foo")
+
+    def testAdd(self):
+        records = self.records
+        self.assertEqual(len(records), 3)
+        self.assertEqual(list(records.duration), [10, 0, 100])
+        self.assertEqual(list(records.client), [0, 1, 0])
+        self.assertEqual(records.keys, ["foo", "bar"])
+        self.assertEqual(records.start.itemsize + records.duration.itemsize +
+                         records.sent.itemsize + records.received.itemsize +
+                         records.client.itemsize, 28)
+
+    def check(self):
+        records = self.records
+        self.assertEqual(list(records.rates()), [102.4, 12.0, 50.0])
+        self.assertEqual(records.clients(), {"foo": (110, 2, 6024),
+                                             "bar": (0, 1, 12)})
+        self.assertEqual(records.top(1, 1), [(12.0, 0, 1, 12, "bar")])
+        self.assertEqual(records.top(2, 2), [(6024 / 110, 110, 2, 6024,
+                                              "foo")])
+        self.assertEqual(records.top(1), [])
+        self.assertEqual(Sessions.percentiles(records.duration),
+                         [10, 100, 100])
+        self.assertEqual(Sessions.percentiles(list(range(1, 201))),
+                         [100, 190, 198])
+        self.assertIsNone(Sessions.percentiles([]))
+
+    def testTotals(self):
+        self.check()
+
+    def testTotalsWithoutNumpy(self):
+        with mock.patch.object(Sessions, "numpy", None):
+            self.check()
+
+    def testExtend(self):
+        other = Sessions.Records()
+        other.add(0, 5, 1, 1, 2)
+        other.add(0, 7, 1, 1, 3)
+        self.records.extend(other, {2: "baz", 3: "foo"}.get)
+        self.assertEqual(self.records.keys, ["foo", "bar", "baz"])
+        self.assertEqual(list(self.records.client), [0, 1, 0, 2, 0])
+        self.assertEqual(list(self.records.duration), [10, 0, 100, 5, 7])
+
+    def testPickle(self):
+        copy = pickle.loads(pickle.dumps(self.records))
+        self.assertEqual(copy.clients(), self.records.clients())
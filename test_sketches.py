@@ -0,0 +1,140 @@
+#!/usr/bin/python -tt
+"""Test suite for Sketches.py of Carl"""
+import pickle
+import random
+import unittest
+import mock
+import Sketches
+
+# Pylint has a counterproductive idea of proper names in this case. Also,
+# docstrings for tests seem a bit overblown. TODO: find someone who cares
+# enough to write them.
+# pylint: disable=invalid-name,missing-docstring,too-many-public-methods,
+
+
+class HyperLogLogTest(unittest.TestCase):
+
+    """Test HyperLogLog class"""
+
+    def testEmpty(self):
+        self.assertEqual(Sketches.HyperLogLog().count(), 0)
+
+    def testSmall(self):
+        hll = Sketches.HyperLogLog()
+        for _ in range(3):
+            for num in range(100):
+                hll.add("10.0.0.%i" % num)
+        self.assertEqual(hll.count(), 100)
+
+    def testLarge(self):
+        hll = Sketches.HyperLogLog(12)
+        for num in range(200000):
+            hll.add("key%i" % num)
+        self.assertLess(abs(hll.count() - 200000),
+                        3 * hll.error() * 200000)
+
+    def testMerge(self):
+        one = Sketches.HyperLogLog()
+        other = Sketches.HyperLogLog()
+        both = Sketches.HyperLogLog()
+        for num in range(5000):
+            (one if num % 3 else other).add("key%i" % num)
+            both.add("key%i" % num)
+        one.merge(other)
+        self.assertEqual(one.registers, both.registers)
+        self.assertEqual(one.count(), both.count())
+        self.assertRaises(ValueError, one.merge, Sketches.HyperLogLog(10))
+
+
+class SpaceSavingTest(unittest.TestCase):
+
+    """Test SpaceSaving class"""
+
+    def setUp(self):
+        rng = random.Random(0)
+        self.keys = ["key%i" % (int(rng.paretovariate(1.0)) % 5000)
+                     for _ in range(20000)]
+        self.exact = {}
+        for key in self.keys:
+            self.exact[key] = self.exact.get(key, 0) + 3
+
+    def testExact(self):
+        summary = Sketches.SpaceSaving(len(self.exact) + 1)
+        for key in self.keys:
+            summary.add(key, 3)
+        self.assertEqual(summary.counts, self.exact)
+        self.assertEqual(summary.floor(), 0)
+
+    def testBounds(self):
+        summary = Sketches.SpaceSaving(50)
+        for key in self.keys:
+            summary.add(key, 3)
+        self.assertEqual(len(summary.counts), 50)
+        total = sum(self.exact.values())
+        for key, count in summary.counts.items():
+            self.assertGreaterEqual(count, self.exact[key])
+            self.assertLessEqual(count - summary.error(key), self.exact[key])
+            self.assertLessEqual(summary.error(key), total // 50)
+        for key, count in self.exact.items():
+            if count > total / 50:
+                self.assertIn(key, summary.counts)
+        best = sorted(self.exact.items(), key=lambda item: -item[1])[:3]
+        self.assertEqual([key for _, key in summary.top(3)],
+                         [key for key, _ in best])
+
+    def testMerge(self):
+        one = Sketches.SpaceSaving(50)
+        other = Sketches.SpaceSaving(50)
+        for num, key in enumerate(self.keys):
+            (one if num % 2 else other).add(key, 3)
+        one.merge(other)
+        self.assertEqual(len(one.counts), 50)
+        for key, count in one.counts.items():
+            self.assertGreaterEqual(count, self.exact[key])
+            self.assertLessEqual(count - one.error(key), self.exact[key])
+        # Still usable after a merge
+        one.add("new", 1)
+        self.assertIn("new", one.counts)
+
+
+class TrackedDictTest(unittest.TestCase):
+
+    """Test TrackedDict class"""
+
+    def testPrune(self):
+        summary = Sketches.SpaceSaving(2)
+        names = Sketches.TrackedDict(4, [summary])
+        for num in range(10):
+            key = "key%i" % num
+            names[key] = "name%i" % num
+            summary.add(key, num)
+            self.assertLessEqual(len(names), 4)
+        for key in summary.counts:
+            self.assertEqual(names[key], "name%s" % key[3:])
+
+    def testMoreSummaries(self):
+        summaries = [Sketches.SpaceSaving(2) for _ in range(5)]
+        names = Sketches.TrackedDict(4, summaries[:1])
+        for num, summary in enumerate(summaries):
+            if num:
+                names.summaries.append(summary)
+            for key in ("%i-%i" % (num, index) for index in range(2)):
+                names[key] = key
+                summary.add(key, 1)
+        # All tracked, so nothing is dropped and nothing rescanned
+        with mock.patch.object(Sketches.TrackedDict, "__iter__") as scan:
+            names["untracked"] = "x"
+        self.assertEqual(scan.call_count, 0)
+        self.assertEqual(len(names), 11)
+
+    def testPickle(self):
+        summary = Sketches.SpaceSaving(2)
+        names = Sketches.TrackedDict(4, [summary])
+        names["a"] = "b"
+        copy = pickle.loads(pickle.dumps(names))
+        self.assertEqual(copy, names)
+        self.assertEqual(copy.limit, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
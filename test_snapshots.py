@@ -0,0 +1,93 @@
+#!/usr/bin/python -tt
+"""Test suite for Snapshots.py of Carl"""
+import os
+import shutil
+import tempfile
+import unittest
+import Bench
+import Carl
+import Snapshots
+
+# Pylint has a counterproductive idea of proper names in this case. Also,
+# docstrings for tests seem a bit overblown. TODO: find someone who cares
+# enough to write them.
+# pylint: disable=invalid-name,missing-docstring,too-many-public-methods
+
+
+class SnapshotsTest(unittest.TestCase):
+
+    """Test snapshots and merging them"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.logs = [list(Bench.synthlog(2000, ips=30, seed=seed))
+                     for seed in (1, 2)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def snapshots(self, argv):
+        args = Carl.parse_cmdline(argv)[0]
+        fnames = []
+        parts = []
+        for num, lines in enumerate(self.logs):
+            stats = Carl.parsedata(lines, args)
+            fname = os.path.join(self.tmpdir, "%s%i.snap" %
+                                 ("".join(argv), num))
+            Snapshots.dump(stats, fname)
+            fnames.append(fname)
+            parts.append(stats)
+        return args, fnames, parts
+
+    def testRoundTrip(self):
+        for argv in ([], ["--compact"], ["--approximate"], ["-m", "all"]):
+            args, fnames, parts = self.snapshots(argv)
+            stats = Carl.mergesnapshots(fnames[:1], args)
+            Carl.finishstats(parts[0])
+            stats["rtime"] = parts[0]["rtime"]
+            self.assertEqual(Carl.mkreports(args, stats),
+                             Carl.mkreports(args, parts[0]))
+
+    def testMerge(self):
+        args, fnames, parts = self.snapshots(["-m", "all"])
+        stats = Carl.mergesnapshots(fnames, args)
+        for key in ("ipb", "ipc"):
+            expected = Carl.Accounts.Accounts()
+            for part in parts:
+                expected.merge(part[key])
+            self.assertEqual(stats[key].accounts, expected.accounts)
+        self.assertEqual(stats["totaltraffic"],
+                         sum(part["totaltraffic"] for part in parts))
+        self.assertEqual(stats["sessions"].seencount,
+                         sum(part["sessions"].seencount for part in parts))
+        self.assertEqual(stats["laststamp"],
+                         max(part["laststamp"] for part in parts))
+        self.assertEqual(sum(stats["buckets"].hours.sessions),
+                         stats["sessions"].seencount)
+        for name, module in stats["modules"].items():
+            self.assertEqual(module["totaltraffic"],
+                             sum(part["modules"][name]["totaltraffic"]
+                                 for part in parts))
+        self.assertIn("Module distfiles", Carl.mkreports(args, stats))
+
+    def testMismatch(self):
+        fnames = self.snapshots([])[1] + self.snapshots(
+            ["--approximate"])[1][:1]
+        args = Carl.parse_cmdline([])[0]
+        self.assertRaises(ValueError, Carl.mergesnapshots,
+                          [fnames[0], fnames[2]], args)
+        fnames = self.snapshots([])[1][:1] + self.snapshots(
+            ["-m", "distfiles"])[1][:1]
+        self.assertRaises(ValueError, Carl.mergesnapshots, fnames, args)
+
+    def testBroken(self):
+        data = Snapshots.dumps(Carl.parsedata(self.logs[0]))
+        self.assertRaises(ValueError, Snapshots.loads, b"CARL")
+        self.assertRaises(ValueError, Snapshots.loads, b"X" + data[1:])
+        self.assertRaises(ValueError, Snapshots.loads,
+                          data[:9] + b"\xff" + data[10:])
+        self.assertRaises(ValueError, Snapshots.loads, data[:-10])
+
+
+if __name__ == '__main__':
+    unittest.main()